@@ -0,0 +1,10 @@
+"""Vinci4D worker agent
+
+Runs inside every worker pod: registers with the engine, claims tasks and runs
+the function scripts in its task slots. Only the standard library is used, so
+the agent starts in any Python 3 image without installing anything.
+"""
+import time
+
+# Taken as early as possible, reported to the engine as part of the boot timing
+AGENT_STARTED_AT = time.time()
@@ -0,0 +1,212 @@
+import re
+import ssl
+import time
+import asyncio
+import collections
+import json as jsonlib
+import urllib.parse
+
+from agent.config import BACKEND_ENGINE_URL, HTTP_TIMEOUT
+
+# Number of recent requests per endpoint the latency percentiles are computed over
+LATENCY_WINDOW = 256
+
+class CaseInsensitiveHeaders(dict):
+    """Response headers, looked up by lowercase name"""
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+class Response:
+    """Status, headers and body of an engine API response"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+class LatencyStats:
+    """Request latency per endpoint over a window of recent requests"""
+
+    def __init__(self):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+
+    @staticmethod
+    def endpoint(method, path):
+        """Group requests by route, UIDs in the path are replaced by a placeholder"""
+        path = re.sub(r"/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", "/<uid>", path)
+        return f"{method} {path}"
+
+    def record(self, endpoint, seconds, failed=False):
+        self.samples[endpoint].append(seconds * 1000)
+        self.counts[endpoint] += 1
+        if failed:
+            self.errors[endpoint] += 1
+
+    def snapshot(self):
+        """Count, errors and p50/p95/max latency in ms of each endpoint"""
+        stats = {}
+        for endpoint, samples in self.samples.items():
+            ordered = sorted(samples)
+            stats[endpoint] = {
+                "count": self.counts[endpoint],
+                "errors": self.errors[endpoint],
+                "p50_ms": round(ordered[len(ordered) // 2], 1),
+                "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 1),
+                "max_ms": round(ordered[-1], 1)
+            }
+        return stats
+
+class EngineClient:
+    """Asyncio HTTP/1.1 client keeping one persistent connection to the engine
+
+    HTTP/1.1 has no multiplexing, so concurrent requests from the claim,
+    prefetch, log and slot coroutines take turns on the connection. Waiting
+    for a turn is bounded by HTTP_TIMEOUT like the request itself, and
+    heartbeats use a client of their own so they never queue behind uploads.
+    """
+
+    def __init__(self, base_url):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.port = url.port or (443 if self.ssl else 80)
+        self.base_path = url.path.rstrip("/")
+        self.reader = None
+        self.writer = None
+        self.lock = None
+        self.connections = 0
+        self.latency = LatencyStats()
+
+    async def connect(self):
+        """Open the connection to the engine"""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        self.connections += 1
+
+    async def close(self):
+        """Close the connection, the next request reconnects"""
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self.reader = self.writer = None
+
+    async def read_response(self):
+        """Read the status line, headers and body of a response"""
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the engine")
+        status_code = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            content = b"".join(chunks)
+        elif "content-length" in headers:
+            content = await self.reader.readexactly(int(headers["content-length"]))
+        elif status_code in (204, 304) or 100 <= status_code < 200:
+            content = b""
+        else:
+            content = await self.reader.read()
+            headers["connection"] = "close"
+
+        return Response(status_code, CaseInsensitiveHeaders(headers), content)
+
+    async def exchange(self, request):
+        """Send a request and read its response, reconnecting a stale connection once"""
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not reused:
+                await self.connect()
+            try:
+                self.writer.write(request)
+                await self.writer.drain()
+                return await self.read_response()
+            except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                await self.close()
+                # The engine may have closed an idle connection, retry on a fresh one
+                if not reused or attempt:
+                    raise
+
+    async def request(self, method, path, params=None, json=None, data=None, headers=None):
+        """Send a request to the engine, returns a Response for any HTTP status"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        target = self.base_path + path
+        if params:
+            target = f"{target}?{urllib.parse.urlencode(params)}"
+        if json is not None:
+            data = jsonlib.dumps(json).encode()
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        data = data or b""
+
+        head = [f"{method} {target} HTTP/1.1", f"Host: {self.host}:{self.port}", "Connection: keep-alive"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        if data or method in ("POST", "PUT"):
+            head.append(f"Content-Length: {len(data)}")
+        request = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data
+
+        endpoint = LatencyStats.endpoint(method, path)
+        queued = time.monotonic()
+        try:
+            await asyncio.wait_for(self.lock.acquire(), HTTP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.latency.record(endpoint, time.monotonic() - queued, failed=True)
+            raise
+
+        try:
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(self.exchange(request), HTTP_TIMEOUT)
+            except BaseException:
+                # Half-read responses can't be recovered, drop the connection
+                await self.close()
+                self.latency.record(endpoint, time.monotonic() - started, failed=True)
+                raise
+            self.latency.record(endpoint, time.monotonic() - started, failed=response.status_code >= 500)
+
+            if response.headers.get("connection", "").lower() == "close":
+                await self.close()
+        finally:
+            self.lock.release()
+
+        return response
+
+    async def get(self, path, params=None, headers=None):
+        """Send a GET request"""
+        return await self.request("GET", path, params=params, headers=headers)
+
+    async def post(self, path, json=None, data=None, headers=None):
+        """Send a POST request with a JSON or raw body"""
+        return await self.request("POST", path, json=json, data=data, headers=headers)
+
+engine = EngineClient(BACKEND_ENGINE_URL)
+
+# Heartbeats on their own connection, a slow upload on the shared one must not delay them
+heartbeat_engine = EngineClient(BACKEND_ENGINE_URL)
@@ -0,0 +1,51 @@
+import os
+
+# Worker configuration
+WORKER_UID = os.environ.get('WORKER_UID')
+GRID_UID = os.environ.get('GRID_UID')
+BACKEND_ENGINE_URL = os.environ.get('BACKEND_ENGINE_URL', 'http://backend-engine:8000')
+LOGSTORE_URL = os.environ.get('LOGSTORE_URL', 'http://logstore:8000')
+ARTIFACTORY_URL = os.environ.get('ARTIFACTORY_URL', 'http://artifactory:8000')
+
+# Executor configuration
+# "warm" keeps a function imported in a long-lived child process and calls its
+# entry point per task, "subprocess" runs `python script.py` for every task.
+# Scripts without a top-level entry point always run as a subprocess.
+EXECUTOR_MODE = os.environ.get('EXECUTOR_MODE', 'warm')
+EXECUTOR_ENTRYPOINT = os.environ.get('EXECUTOR_ENTRYPOINT', 'main')
+EXECUTOR_MAX_TASKS = int(os.environ.get('EXECUTOR_MAX_TASKS', '100'))
+EXECUTOR_MAX_RSS_MB = int(os.environ.get('EXECUTOR_MAX_RSS_MB', '1024'))
+EXECUTOR_MAX_WARM = int(os.environ.get('EXECUTOR_MAX_WARM', '2'))
+
+# Concurrent task slots, one task per slot, defaulting to the worker's CPU allocation
+WORKER_CPU = float(os.environ.get('WORKER_CPU') or os.cpu_count() or 1)
+WORKER_SLOTS = int(os.environ.get('WORKER_SLOTS') or max(1, int(WORKER_CPU)))
+
+# Bounded buffer of tasks leased ahead of time, script and inputs included
+PREFETCH_SIZE = int(os.environ.get('PREFETCH_SIZE', '2'))
+PREFETCH_LEASE_SECONDS = int(os.environ.get('PREFETCH_LEASE_SECONDS', '60'))
+
+# Function scripts cached by content hash, evicted LRU beyond the disk budget
+SCRIPT_CACHE_DIR = os.environ.get('SCRIPT_CACHE_DIR', '/data/scripts')
+SCRIPT_CACHE_MAX_BYTES = int(os.environ.get('SCRIPT_CACHE_MAX_MB', '256')) * 1024 * 1024
+
+# Seconds a preempted subprocess task has to write its checkpoint after SIGTERM before it is killed
+PREEMPT_GRACE_SECONDS = float(os.environ.get('PREEMPT_GRACE_SECONDS', '10'))
+
+# Scratch space for task I/O and the stderr tail reported with a result
+TASK_DIR = os.environ.get('TASK_DIR', '/data/tasks')
+MAX_ERROR_CHARS = int(os.environ.get('MAX_ERROR_CHARS', '4000'))
+
+# Streaming of script output to the engine
+LOG_BUFFER_BYTES = int(os.environ.get('LOG_BUFFER_KB', '1024')) * 1024
+LOG_BATCH_BYTES = int(os.environ.get('LOG_BATCH_KB', '64')) * 1024
+LOG_TASK_MAX_BYTES = int(os.environ.get('LOG_TASK_MAX_KB', '1024')) * 1024
+LOG_FLUSH_SECONDS = float(os.environ.get('LOG_FLUSH_SECONDS', '1'))
+LOG_BACKPRESSURE_SECONDS = float(os.environ.get('LOG_BACKPRESSURE_SECONDS', '5'))
+
+# Heartbeats carry the container's measured CPU and memory usage from its cgroup
+HEARTBEAT_INTERVAL = int(os.environ.get('HEARTBEAT_INTERVAL', '10'))
+CGROUP_ROOT = os.environ.get('CGROUP_ROOT', '/sys/fs/cgroup')
+
+# Timeout of requests to the engine
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '30'))
@@ -0,0 +1,195 @@
+import os
+import sys
+import io
+import ast
+import functools
+import importlib.util
+import logging
+import multiprocessing
+import traceback
+
+from agent.config import EXECUTOR_ENTRYPOINT, EXECUTOR_MAX_TASKS, EXECUTOR_MAX_RSS_MB, EXECUTOR_MAX_WARM, WORKER_SLOTS
+
+logger = logging.getLogger(__name__)
+
+def rss_mb():
+    """Resident set size of the current process in MB"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        return 0.0
+
+@functools.lru_cache(maxsize=256)
+def has_entrypoint(script_file, entrypoint):
+    """Check if a script defines a top-level entry point, without running it"""
+    try:
+        with open(script_file, "rb") as f:
+            tree = ast.parse(f.read(), filename=script_file)
+    except (OSError, SyntaxError):
+        return False
+    return any(
+        isinstance(node, ast.FunctionDef) and node.name == entrypoint
+        for node in tree.body
+    )
+
+class PipeWriter(io.TextIOBase):
+    """Text stream that forwards complete lines to the parent as log messages"""
+
+    def __init__(self, conn, stream):
+        self.conn = conn
+        self.stream = stream
+        self.pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.pending += text
+        while "\n" in self.pending:
+            line, self.pending = self.pending.split("\n", 1)
+            self.conn.send(("log", self.stream, line))
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            self.conn.send(("log", self.stream, self.pending))
+            self.pending = ""
+
+def executor_child(conn, script_file, entrypoint):
+    """Import a function script once and serve entry point calls over a pipe"""
+    # Stream the script's output to the parent line by line
+    sys.stdout = PipeWriter(conn, "stdout")
+    sys.stderr = PipeWriter(conn, "stderr")
+
+    try:
+        spec = importlib.util.spec_from_file_location("vinci4d_function", script_file)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        entry = getattr(module, entrypoint)
+    except BaseException:
+        conn.send(("error", traceback.format_exc(), rss_mb()))
+        return
+    conn.send(("ready", None, rss_mb()))
+
+    while True:
+        try:
+            inputs = conn.recv()
+        except EOFError:
+            return
+        if inputs is None:
+            return
+        try:
+            result = ("ok", entry(inputs))
+        except BaseException:
+            result = ("error", traceback.format_exc())
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.send(result + (rss_mb(),))
+
+class WarmExecutor:
+    """Long-lived child process that keeps one function script imported"""
+
+    def __init__(self, script_file):
+        self.script_file = script_file
+        self.process = None
+        self.conn = None
+        self.tasks_run = 0
+        self.rss_mb = 0.0
+
+    def start(self):
+        """Fork the child from the forkserver and wait for the script import"""
+        ctx = multiprocessing.get_context("forkserver")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=executor_child,
+            args=(child_conn, self.script_file, EXECUTOR_ENTRYPOINT),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks_run = 0
+
+        kind, payload = self.receive(None)
+        if kind != "ready":
+            self.close()
+            raise Exception(f"Failed to import {self.script_file}: {payload}")
+        logger.info(f"Warm executor for {self.script_file} started (pid {self.process.pid})")
+
+    def receive(self, on_log):
+        """Receive the child's next reply, passing its output lines to on_log"""
+        while True:
+            kind, payload, extra = self.conn.recv()
+            if kind != "log":
+                self.rss_mb = extra
+                return kind, payload
+            if on_log is not None:
+                on_log(payload, extra)
+            else:
+                logger.info(f"Script {self.script_file} {payload}: {extra}")
+
+    def run(self, inputs, on_log=None):
+        """Call the entry point with the task inputs, returns (ok, result or traceback)"""
+        if self.process is None or not self.process.is_alive():
+            self.start()
+
+        try:
+            self.conn.send(inputs)
+            kind, payload = self.receive(on_log)
+        except (EOFError, OSError) as e:
+            exitcode = self.process.exitcode
+            self.close()
+            return False, f"Warm executor exited with code {exitcode}: {e}"
+
+        # Recycle the child after N tasks or once its memory has grown too much
+        self.tasks_run += 1
+        if self.tasks_run >= EXECUTOR_MAX_TASKS or self.rss_mb >= EXECUTOR_MAX_RSS_MB:
+            logger.info(f"Recycling warm executor for {self.script_file} after {self.tasks_run} tasks ({self.rss_mb:.0f} MB)")
+            self.close()
+
+        return kind == "ok", payload
+
+    def close(self):
+        """Stop the child process"""
+        if self.conn is not None:
+            try:
+                self.conn.send(None)
+            except Exception:
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+            self.process = None
+
+# Warm executors of each slot by function UID, least recently used first.
+# Every slot owns its children, so together they form the worker's process pool.
+warm_executors = [{} for _ in range(WORKER_SLOTS)]
+
+def kill_warm_executor(slot, function_uid):
+    """Kill the child running a slot's task, its run returns as failed. Returns False if there is none"""
+    executor = warm_executors[slot].pop(function_uid, None)
+    if executor is None or executor.process is None:
+        return False
+    executor.process.kill()
+    return True
+
+def get_warm_executor(slot, function_uid, script_file):
+    """Get a slot's warm executor for a function, evicting the least recently used one"""
+    executors = warm_executors[slot]
+    executor = executors.pop(function_uid, None)
+    if executor is not None and executor.script_file != script_file:
+        # The function's script changed, hot-swap the child
+        executor.close()
+        executor = None
+    if executor is None:
+        while len(executors) >= EXECUTOR_MAX_WARM:
+            evicted_uid = next(iter(executors))
+            executors.pop(evicted_uid).close()
+        executor = WarmExecutor(script_file)
+    executors[function_uid] = executor
+    return executor
@@ -0,0 +1,130 @@
+import time
+import json
+import gzip
+import asyncio
+import logging
+import threading
+import collections
+
+from agent.api import engine
+from agent.config import (
+    WORKER_UID,
+    LOG_BUFFER_BYTES,
+    LOG_BATCH_BYTES,
+    LOG_TASK_MAX_BYTES,
+    LOG_FLUSH_SECONDS,
+    LOG_BACKPRESSURE_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+class LogShipper:
+    """Ships task output to the engine in compressed batches
+
+    Lines go into a ring buffer bounded by LOG_BUFFER_BYTES. When it is full
+    writers wait for the shipper to drain it (backpressure on the script) and
+    then overwrite the oldest lines. Writers are the slots' executor threads,
+    the shipping runs on the agent's event loop. Each task ships at most LOG_TASK_MAX_BYTES,
+    dropped lines are counted and reported to the engine. Batches carry
+    worker_uid, set on registration for worker group replicas.
+    """
+
+    def __init__(self):
+        self.worker_uid = WORKER_UID
+        self.cond = threading.Condition()
+        self.ship_lock = None
+        self.loop = None
+        self.wakeup = None
+        self.buffer = collections.deque()
+        self.buffer_bytes = 0
+        self.task_bytes = {}
+        self.dropped = {}
+
+    def write(self, task_uid, stream, line):
+        """Add an output line of a task to the buffer"""
+        if stream == "stderr":
+            line = f"[stderr] {line}"
+        size = len(line) + 1
+
+        with self.cond:
+            if self.task_bytes.get(task_uid, 0) + size > LOG_TASK_MAX_BYTES:
+                self.dropped[task_uid] = self.dropped.get(task_uid, 0) + 1
+                return
+
+            deadline = time.time() + LOG_BACKPRESSURE_SECONDS
+            while self.buffer_bytes + size > LOG_BUFFER_BYTES and time.time() < deadline:
+                self.notify()
+                self.cond.wait(deadline - time.time())
+            while self.buffer_bytes + size > LOG_BUFFER_BYTES and self.buffer:
+                old_uid, old_line = self.buffer.popleft()
+                self.buffer_bytes -= len(old_line) + 1
+                self.dropped[old_uid] = self.dropped.get(old_uid, 0) + 1
+
+            self.buffer.append((task_uid, line))
+            self.buffer_bytes += size
+            self.task_bytes[task_uid] = self.task_bytes.get(task_uid, 0) + size
+            if self.buffer_bytes >= LOG_BATCH_BYTES:
+                self.notify()
+
+    def notify(self):
+        """Wake the shipper up to send a full batch"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def take(self):
+        """Drain the buffer into per-task batches of (lines, dropped)"""
+        batches = {}
+        while self.buffer:
+            task_uid, line = self.buffer.popleft()
+            batches.setdefault(task_uid, ([], 0))[0].append(line)
+        for task_uid, dropped in self.dropped.items():
+            if dropped:
+                lines, _ = batches.get(task_uid, ([], 0))
+                batches[task_uid] = (lines, dropped)
+        self.dropped = {task_uid: 0 for task_uid in self.dropped}
+        self.buffer_bytes = 0
+        self.cond.notify_all()
+        return batches
+
+    async def ship(self):
+        """Send everything buffered to the engine, gzip compressed"""
+        if self.ship_lock is None:
+            self.ship_lock = asyncio.Lock()
+
+        async with self.ship_lock:
+            with self.cond:
+                batches = self.take()
+
+            for task_uid, (lines, dropped) in batches.items():
+                body = gzip.compress(json.dumps({"worker_uid": self.worker_uid, "lines": lines, "dropped": dropped}).encode())
+                try:
+                    response = await engine.post(
+                        f"/api/tasks/{task_uid}/logs",
+                        data=body,
+                        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}
+                    )
+                    if response.status_code != 200:
+                        logger.warning(f"Failed to ship logs of task {task_uid}: {response.text}")
+                except Exception as e:
+                    logger.warning(f"Error shipping logs of task {task_uid}: {e}")
+
+    async def close_task(self, task_uid):
+        """Ship the rest of a finished task's output"""
+        await self.ship()
+        with self.cond:
+            self.task_bytes.pop(task_uid, None)
+            self.dropped.pop(task_uid, None)
+
+    async def run(self):
+        """Ship batches every LOG_FLUSH_SECONDS or as soon as a batch is full"""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), LOG_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.ship()
+
+log_shipper = LogShipper()
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+
+from agent.api import engine
+from agent.config import SCRIPT_CACHE_DIR, SCRIPT_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+class ScriptCache:
+    """On-disk cache of function scripts keyed by content hash, evicted LRU by mtime
+
+    Every script returned by get is in use until it is released, from the
+    task's preparation until it finished or was dropped, and is never evicted
+    while in use.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index_file = os.path.join(cache_dir, "index.json")
+        # Function UID -> script hash, loaded on first use
+        self.index = None
+        self.in_use = collections.Counter()
+
+    def load(self):
+        """Create the cache directory and read the persisted index, so a restarted agent revalidates"""
+        if self.index is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def path(self, script_hash):
+        """Local path of a cached script"""
+        return os.path.join(self.cache_dir, f"{script_hash}.py")
+
+    async def get(self, function_uid):
+        """Return the local path of a function's current script, downloading it if it changed
+
+        The script is in use until it is released.
+        """
+        with self.lock:
+            self.load()
+            cached_hash = self.index.get(function_uid)
+        headers = {}
+        if cached_hash and os.path.exists(self.path(cached_hash)):
+            headers["If-None-Match"] = f'"{cached_hash}"'
+
+        response = await engine.get(f"/api/functions/{function_uid}/script", headers=headers)
+
+        if response.status_code == 304:
+            script_file = self.path(cached_hash)
+            self.touch(script_file)
+            with self.lock:
+                self.in_use[script_file] += 1
+            return script_file
+
+        if response.status_code != 200:
+            raise Exception(f"Failed to get function script: {response.text}")
+
+        # Validate the content against the hash the engine advertised
+        script_content = response.content
+        script_hash = hashlib.sha256(script_content).hexdigest()
+        etag = response.headers.get("ETag", "").strip('"')
+        if etag and etag != script_hash:
+            raise Exception(f"Script of function {function_uid} does not match its hash {etag}")
+
+        script_file = self.path(script_hash)
+        if not os.path.exists(script_file):
+            # Write script to disk, atomically since slots and the prefetcher share it
+            tmp_file = f"{script_file}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(script_content)
+            os.replace(tmp_file, script_file)
+            logger.info(f"Cached script {script_hash} of function {function_uid}")
+        else:
+            self.touch(script_file)
+
+        with self.lock:
+            self.in_use[script_file] += 1
+            self.index[function_uid] = script_hash
+            self.save_index()
+            self.evict()
+
+        return script_file
+
+    def release(self, script_file):
+        """Mark a script returned by get as no longer needed by its task"""
+        if script_file is None:
+            return
+        with self.lock:
+            self.in_use[script_file] -= 1
+            if self.in_use[script_file] <= 0:
+                del self.in_use[script_file]
+
+    def touch(self, script_file):
+        """Mark a script as recently used"""
+        try:
+            os.utime(script_file)
+        except OSError:
+            pass
+
+    def save_index(self):
+        """Persist the function to hash index"""
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+
+    def evict(self):
+        """Delete least recently used scripts not in use until the cache fits its disk budget"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".py"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self.in_use[path] > 0:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted_hash = os.path.basename(path)[:-3]
+            self.index = {uid: h for uid, h in self.index.items() if h != evicted_hash}
+            logger.info(f"Evicted script {evicted_hash} from the cache")
+        self.save_index()
+
+script_cache = ScriptCache(SCRIPT_CACHE_DIR, SCRIPT_CACHE_MAX_BYTES)
@@ -0,0 +1,39 @@
+import threading
+from datetime import datetime
+
+from agent.config import WORKER_SLOTS
+
+slots = [
+    {"slot": i, "status": "idle", "task_uid": None, "function_uid": None, "started_at": None}
+    for i in range(WORKER_SLOTS)
+]
+slots_lock = threading.Lock()
+
+def slot_status():
+    """Snapshot of the per-slot status for heartbeats"""
+    with slots_lock:
+        return [dict(slot) for slot in slots]
+
+def acquire_slot(task):
+    """Mark a free slot busy with a task, returns the slot index or None"""
+    with slots_lock:
+        for slot in slots:
+            if slot["status"] == "idle":
+                slot.update(
+                    status="busy",
+                    task_uid=task["task_uid"],
+                    function_uid=task["function_uid"],
+                    started_at=datetime.utcnow().isoformat()
+                )
+                return slot["slot"]
+    return None
+
+def release_slot(slot):
+    """Mark a slot idle again"""
+    with slots_lock:
+        slots[slot].update(status="idle", task_uid=None, function_uid=None, started_at=None)
+
+def free_slot_count():
+    """Number of idle slots"""
+    with slots_lock:
+        return sum(1 for slot in slots if slot["status"] == "idle")
@@ -0,0 +1,101 @@
+import os
+import time
+
+from agent.config import CGROUP_ROOT, WORKER_CPU, WORKER_SLOTS
+from agent.slots import free_slot_count
+
+def read_cgroup_file(*names):
+    """Read the first cgroup file that exists, returns its content or None"""
+    for name in names:
+        try:
+            with open(os.path.join(CGROUP_ROOT, name)) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+def read_cgroup_stat(name, *keys):
+    """Read the first of keys from a flat keyed cgroup stat file"""
+    content = read_cgroup_file(name)
+    if not content:
+        return None
+    stat = dict(line.split(" ", 1) for line in content.splitlines() if " " in line)
+    for key in keys:
+        if key in stat:
+            return int(stat[key])
+    return None
+
+def cgroup_cpu_usage():
+    """CPU time used by the container in seconds (cgroup v2, then v1)"""
+    usage = read_cgroup_stat("cpu.stat", "usage_usec")
+    if usage is not None:
+        return usage / 1e6
+    usage = read_cgroup_file("cpuacct/cpuacct.usage", "cpu,cpuacct/cpuacct.usage")
+    if usage:
+        return int(usage) / 1e9
+    return None
+
+def cgroup_cpu_limit():
+    """CPU cores the container may use, falling back to WORKER_CPU without a quota"""
+    cpu_max = read_cgroup_file("cpu.max")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max":
+            return int(quota) / int(period)
+    quota = read_cgroup_file("cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us")
+    period = read_cgroup_file("cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return WORKER_CPU
+
+def cgroup_memory():
+    """Working set and limit of the container in bytes, (None, None) without cgroups
+
+    The working set excludes inactive page cache, like the kubelet counts it.
+    """
+    usage = read_cgroup_file("memory.current", "memory/memory.usage_in_bytes")
+    if not usage:
+        return None, None
+    inactive = read_cgroup_stat("memory.stat", "inactive_file") or \
+        read_cgroup_stat("memory/memory.stat", "total_inactive_file") or 0
+    working_set = max(int(usage) - inactive, 0)
+
+    # Unlimited containers report "max" (v2) or a huge number (v1)
+    limit = read_cgroup_file("memory.max", "memory/memory.limit_in_bytes")
+    if not limit or limit == "max" or int(limit) >= 2 ** 60:
+        limit = None
+    else:
+        limit = int(limit)
+    return working_set, limit
+
+class Telemetry:
+    """Samples the container's CPU and memory usage for heartbeats"""
+
+    def __init__(self):
+        self.last_usage = cgroup_cpu_usage()
+        self.last_time = time.monotonic()
+
+    def sample(self):
+        """Current usage, CPU is averaged over the time since the last sample"""
+        usage = cgroup_cpu_usage()
+        now = time.monotonic()
+
+        cpu_used = None
+        if usage is not None and self.last_usage is not None and now > self.last_time:
+            cpu_used = max(usage - self.last_usage, 0) / (now - self.last_time)
+        self.last_usage = usage
+        self.last_time = now
+
+        memory_used, memory_limit = cgroup_memory()
+        busy = WORKER_SLOTS - free_slot_count()
+
+        return {
+            "cpu_limit": round(cgroup_cpu_limit(), 3),
+            "cpu_used": round(cpu_used, 3) if cpu_used is not None else None,
+            "memory_limit_mb": memory_limit // (1024 * 1024) if memory_limit else None,
+            "memory_used_mb": memory_used // (1024 * 1024) if memory_used is not None else None,
+            "slots_total": WORKER_SLOTS,
+            "slots_busy": busy
+        }
+
+telemetry = Telemetry()
@@ -0,0 +1,561 @@
+import os
+import sys
+import time
+import json
+import socket
+import asyncio
+import logging
+import threading
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from agent import AGENT_STARTED_AT
+from agent.api import engine, heartbeat_engine
+from agent.config import (
+    WORKER_UID,
+    GRID_UID,
+    EXECUTOR_MODE,
+    EXECUTOR_ENTRYPOINT,
+    WORKER_SLOTS,
+    PREFETCH_SIZE,
+    PREFETCH_LEASE_SECONDS,
+    TASK_DIR,
+    MAX_ERROR_CHARS,
+    HEARTBEAT_INTERVAL,
+    PREEMPT_GRACE_SECONDS
+)
+from agent.executor import has_entrypoint, get_warm_executor, kill_warm_executor
+from agent.logs import log_shipper
+from agent.scripts import script_cache
+from agent.slots import slot_status, acquire_slot, release_slot, free_slot_count
+from agent.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+class TaskPreempted(Exception):
+    """The engine stopped the task for higher priority work"""
+
+# Worker state
+hostname = socket.gethostname()
+prefetch_buffer = collections.deque()
+# Slots kept idle for the gang ranks the engine reserved on this worker
+reserved_slots = 0
+# Subprocesses of the running tasks, and the tasks the engine preempted
+running_processes = {}
+preempted_tasks = set()
+
+slot_tasks = set()
+slot_freed = None
+
+def container_started_at():
+    """Start time of the container's first process, None without /proc"""
+    try:
+        with open("/proc/1/stat") as f:
+            # starttime is the 22nd field, in clock ticks since boot
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+def boot_timing():
+    """How long the container took from start to registration, in ms"""
+    now = time.time()
+    container_started = container_started_at()
+    timing = {
+        "agent_started_at": datetime.utcfromtimestamp(AGENT_STARTED_AT).isoformat(),
+        "registered_at": datetime.utcfromtimestamp(now).isoformat(),
+        "agent_boot_ms": round((now - AGENT_STARTED_AT) * 1000, 1)
+    }
+    if container_started is not None:
+        timing["container_started_at"] = datetime.utcfromtimestamp(container_started).isoformat()
+        timing["container_boot_ms"] = round((now - container_started) * 1000, 1)
+    return timing
+
+async def register_worker():
+    """Register worker with backend engine
+
+    Worker group replicas have no WORKER_UID, they get it by registering the
+    ordinal of their pod (the suffix of the StatefulSet pod's hostname).
+    """
+    global WORKER_UID
+    try:
+        boot = boot_timing()
+        logger.info(f"Worker booted in {boot.get('container_boot_ms', boot['agent_boot_ms'])} ms")
+        registration = {"hostname": hostname, "slots": WORKER_SLOTS, "boot": boot}
+        if WORKER_UID:
+            logger.info(f"Registering worker {WORKER_UID} with backend engine")
+            response = await engine.post(f"/api/workers/{WORKER_UID}/online", json=registration)
+        else:
+            ordinal = int(hostname.rsplit("-", 1)[1])
+            logger.info(f"Registering replica {ordinal} of the worker group of grid {GRID_UID} with backend engine")
+            response = await engine.post(f"/api/grids/{GRID_UID}/workers/register", json={**registration, "ordinal": ordinal})
+            if response.status_code == 200:
+                WORKER_UID = response.json()["uid"]
+        if response.status_code == 200:
+            log_shipper.worker_uid = WORKER_UID
+            logger.info(f"Worker {WORKER_UID} registered successfully")
+            return True
+        else:
+            logger.error(f"Failed to register worker: {response.text}")
+            return False
+    except Exception as e:
+        logger.error(f"Error registering worker: {e}")
+        return False
+
+async def send_heartbeat():
+    """Send heartbeat to backend engine"""
+    try:
+        sample = telemetry.sample()
+        # Latency of the agent's own requests to the engine, per endpoint
+        sample["http"] = {
+            "connections": engine.connections + heartbeat_engine.connections,
+            "endpoints": {**engine.latency.snapshot(), **heartbeat_engine.latency.snapshot()}
+        }
+
+        response = await heartbeat_engine.post(
+            f"/api/workers/{WORKER_UID}/heartbeat",
+            json={
+                "timestamp": datetime.utcnow().isoformat(),
+                "hostname": hostname,
+                "status": "online",
+                "slots": slot_status(),
+                "telemetry": sample
+            }
+        )
+        if response.status_code == 404:
+            # The engine doesn't know this worker (anymore), register it again
+            logger.warning(f"Engine doesn't know worker {WORKER_UID}, registering again")
+            await register_worker()
+            return
+        if response.status_code != 200:
+            logger.warning(f"Failed to send heartbeat: {response.text}")
+            return
+        for task_uid in response.json().get("preempt", []):
+            preempt_task(task_uid)
+    except Exception as e:
+        logger.warning(f"Error sending heartbeat: {e}")
+
+def preempt_task(task_uid):
+    """Stop a running task the engine preempted
+
+    A subprocess gets SIGTERM and PREEMPT_GRACE_SECONDS to write its checkpoint
+    before it is killed, a warm executor child is killed right away.
+    """
+    if task_uid in preempted_tasks:
+        return
+    slot = next((s for s in slot_status() if s["task_uid"] == task_uid), None)
+    if slot is None:
+        return
+
+    preempted_tasks.add(task_uid)
+    process = running_processes.get(task_uid)
+    if process is not None:
+        logger.info(f"Preempting task {task_uid}, stopping its subprocess")
+        process.terminate()
+        asyncio.get_running_loop().call_later(
+            PREEMPT_GRACE_SECONDS, lambda: process.poll() is None and process.kill()
+        )
+    elif kill_warm_executor(slot["slot"], slot["function_uid"]):
+        logger.info(f"Preempting task {task_uid}, killed its warm executor")
+
+async def report_preempted(task_uid):
+    """Hand a preempted task back to the engine with the checkpoint its script wrote"""
+    checkpoint = None
+    checkpoint_file = os.path.join(TASK_DIR, f"{task_uid}.checkpoint.json")
+    if os.path.exists(checkpoint_file):
+        try:
+            with open(checkpoint_file) as f:
+                checkpoint = json.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable checkpoint of task {task_uid}: {e}")
+        os.remove(checkpoint_file)
+
+    try:
+        response = await engine.post(
+            f"/api/tasks/{task_uid}/preempted",
+            json={"worker_uid": WORKER_UID, "checkpoint": checkpoint}
+        )
+        if response.status_code != 200:
+            logger.warning(f"Failed to requeue preempted task {task_uid}: {response.text}")
+    except Exception as e:
+        logger.error(f"Error requeueing preempted task {task_uid}: {e}")
+
+async def heartbeat_loop():
+    """Send heartbeats every HEARTBEAT_INTERVAL, concurrently with the task work"""
+    while True:
+        await send_heartbeat()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+async def report_failure(task_uid, error):
+    """Report a task as failed"""
+    try:
+        await engine.post(
+            f"/api/tasks/{task_uid}/result",
+            json={"status": "failed", "result": "failed", "worker_uid": WORKER_UID, "error": error}
+        )
+    except Exception as e:
+        logger.error(f"Error reporting task {task_uid} as failed: {e}")
+
+async def prefetch_tasks():
+    """Keep the prefetch buffer filled with leased, prepared tasks while the slots run"""
+    while True:
+        space = PREFETCH_SIZE - len(prefetch_buffer)
+        claimed = []
+
+        if space > 0:
+            try:
+                response = await engine.get(
+                    "/api/tasks",
+                    params={"worker": WORKER_UID, "status": "pending", "count": space, "prefetch": "true"}
+                )
+                if response.status_code == 200:
+                    claimed = response.json().get("tasks", [])
+                else:
+                    logger.warning(f"Failed to prefetch tasks: {response.text}")
+            except Exception as e:
+                logger.warning(f"Error prefetching tasks: {e}")
+
+        for task in claimed:
+            task["leased_at"] = time.time()
+            try:
+                await prepare_task(task)
+            except Exception as e:
+                logger.error(f"Error preparing prefetched task {task['task_uid']}: {e}")
+                script_cache.release(task.pop("script_file", None))
+                await report_failure(task["task_uid"], str(e))
+                continue
+            logger.info(f"Prefetched task {task['task_uid']}")
+            prefetch_buffer.append(task)
+
+        await asyncio.sleep(1 if claimed else 5)
+
+async def start_prefetched_tasks():
+    """Start prefetched tasks in the idle slots, returns the number started"""
+    started = 0
+
+    while free_slot_count() > reserved_slots and prefetch_buffer:
+        task = prefetch_buffer.popleft()
+
+        # The engine hands the task to another worker once the lease expires
+        if time.time() - task["leased_at"] >= PREFETCH_LEASE_SECONDS:
+            logger.info(f"Dropping prefetched task {task['task_uid']}, its lease expired")
+            script_cache.release(task.get("script_file"))
+            continue
+
+        try:
+            response = await engine.post(
+                f"/api/tasks/{task['task_uid']}/start",
+                json={"worker_uid": WORKER_UID}
+            )
+        except Exception as e:
+            logger.warning(f"Error starting prefetched task {task['task_uid']}: {e}")
+            script_cache.release(task.get("script_file"))
+            continue
+        if response.status_code != 200:
+            logger.info(f"Dropping prefetched task {task['task_uid']}: {response.text}")
+            script_cache.release(task.get("script_file"))
+            continue
+
+        start_slot(task)
+        started += 1
+
+    return started
+
+async def check_for_tasks():
+    """Claim enough pending tasks to fill the idle slots, returns the number claimed"""
+    global reserved_slots
+    count = free_slot_count()
+    if count == 0:
+        return 0
+
+    try:
+        response = await engine.get(
+            "/api/tasks",
+            params={"worker": WORKER_UID, "status": "pending", "count": count}
+        )
+        if response.status_code == 200:
+            tasks = response.json().get("tasks", [])
+            reserved_slots = response.json().get("reserved", 0)
+            if not tasks:
+                logger.info("No pending tasks found")
+            for task in tasks:
+                logger.info(f"Task: {task}")
+                start_slot(task)
+            return len(tasks)
+        else:
+            logger.warning(f"Failed to check for tasks: {response.text}")
+    except Exception as e:
+        logger.warning(f"Error checking for tasks: {e}")
+    return 0
+
+def start_slot(task):
+    """Run a task in a free slot in the background"""
+    slot = acquire_slot(task)
+    slot_task = asyncio.create_task(run_slot(slot, task))
+    # Keep a reference until the task is done, the loop only holds weak ones
+    slot_tasks.add(slot_task)
+    slot_task.add_done_callback(slot_tasks.discard)
+
+async def run_slot(slot, task):
+    """Run a task in a slot and free the slot afterwards"""
+    try:
+        await process_task(slot, task)
+    finally:
+        release_slot(slot)
+        slot_freed.set()
+
+async def prepare_task(task):
+    """Fetch the function details and make sure its current script is on disk"""
+    function_uid = task["function_uid"]
+
+    # Get function details
+    response = await engine.get(f"/api/functions/{function_uid}")
+    if response.status_code != 200:
+        raise Exception(f"Failed to get function details: {response.text}")
+
+    function = response.json()
+    task["script_path"] = function["script_path"]
+
+    # Revalidate the cached script, a 304 when it didn't change
+    task["script_file"] = await script_cache.get(function_uid)
+
+    return task
+
+def collect_outputs(inputs, outputs):
+    """Pair each input with its output, inputs without an output are marked as errors"""
+    results = []
+    for i, task_input in enumerate(inputs):
+        if i < len(outputs):
+            results.append({"input": task_input, "output": outputs[i]})
+        else:
+            results.append({"input": task_input, "error": "No output produced for this input"})
+    return results
+
+def run_subprocess(task, inputs):
+    """Run the script as `python script.py`, streaming the inputs as JSON lines on stdin
+
+    The script writes one JSON line per input to the file named by VINCI4D_OUTPUT,
+    its stdout and stderr are streamed to the log shipper. Returns the outputs.
+    """
+    task_uid = task["task_uid"]
+    output_file = os.path.join(TASK_DIR, f"{task_uid}.out.jsonl")
+    os.makedirs(TASK_DIR, exist_ok=True)
+
+    # A preempted script saves its progress here on SIGTERM and resumes from it
+    checkpoint_file = os.path.join(TASK_DIR, f"{task_uid}.checkpoint.json")
+    if task.get("checkpoint") is not None:
+        with open(checkpoint_file, "w") as f:
+            json.dump(task["checkpoint"], f)
+
+    env = dict(os.environ)
+    env.update({
+        "VINCI4D_TASK_UID": task_uid,
+        "VINCI4D_FUNCTION_UID": task["function_uid"],
+        "VINCI4D_INPUT_COUNT": str(len(inputs)),
+        "VINCI4D_OUTPUT": output_file,
+        "VINCI4D_CHECKPOINT": checkpoint_file,
+        "PYTHONUNBUFFERED": "1"
+    })
+    # Ranks of a gang scheduled function start together, each knows its place in the gang
+    gang = task.get("gang")
+    if gang:
+        env.update({
+            "VINCI4D_GANG_UID": gang["uid"],
+            "VINCI4D_GANG_RANK": str(gang["rank"]),
+            "VINCI4D_GANG_SIZE": str(gang["size"])
+        })
+    stdin_data = "".join(json.dumps(task_input) + "\n" for task_input in inputs)
+
+    try:
+        process = subprocess.Popen(
+            ["python", task["script_file"]],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env=env
+        )
+        running_processes[task_uid] = process
+
+        # Stream stdout and stderr line by line, keeping the stderr tail for errors
+        stderr_tail = collections.deque(maxlen=100)
+
+        def pump(stream, name):
+            for line in stream:
+                line = line.rstrip("\n")
+                if name == "stderr":
+                    stderr_tail.append(line)
+                log_shipper.write(task_uid, name, line)
+            stream.close()
+
+        readers = [
+            threading.Thread(target=pump, args=(process.stdout, "stdout"), daemon=True),
+            threading.Thread(target=pump, args=(process.stderr, "stderr"), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+
+        try:
+            process.stdin.write(stdin_data)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+        return_code = process.wait()
+        for reader in readers:
+            reader.join()
+        stderr = "\n".join(stderr_tail)
+
+        # catch the return code of the script
+        if return_code != 0:
+            raise Exception(f"Script {task['function_uid']} returned non-zero exit code: {return_code}: {stderr[-MAX_ERROR_CHARS:]}")
+
+        outputs = []
+        if os.path.exists(output_file):
+            with open(output_file) as f:
+                outputs = [json.loads(line) for line in f if line.strip()]
+        elif inputs:
+            # Scripts that don't write outputs only report success
+            outputs = [None] * len(inputs)
+        return outputs
+    finally:
+        running_processes.pop(task_uid, None)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        if task_uid not in preempted_tasks and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+async def process_task(slot, task):
+    """Process a single task"""
+    task_uid = task["task_uid"]
+    function_uid = task["function_uid"]
+
+    logger.info(f"Processing task {task_uid} for function {function_uid} in slot {slot}")
+
+    try:
+        # Prefetched tasks are already prepared
+        if "script_file" not in task:
+            await prepare_task(task)
+        script_path = task["script_path"]
+        script_file = task["script_file"]
+        inputs = task.get("inputs") or []
+        started = time.time()
+
+        if EXECUTOR_MODE == "warm" and has_entrypoint(script_file, EXECUTOR_ENTRYPOINT):
+            # Call the entry point with the input batch in the warm executor,
+            # it returns one output per input. The slot's thread waits on the
+            # child so the event loop keeps serving the other slots.
+            logger.info(f"Executing {EXECUTOR_ENTRYPOINT}() of script {script_path} in warm executor")
+            ok, output = await asyncio.to_thread(
+                get_warm_executor(slot, function_uid, script_file).run,
+                inputs,
+                on_log=lambda stream, line: log_shipper.write(task_uid, stream, line)
+            )
+
+            if not ok:
+                raise Exception(f"Script {function_uid} raised an exception: {output}")
+            if output is None:
+                output = [None] * len(inputs)
+            if not isinstance(output, (list, tuple)):
+                raise Exception(f"Script {function_uid} must return a list with one output per input, got {type(output).__name__}")
+            outputs = list(output)
+        else:
+            # Execute the script
+            logger.info(f"Executing script {script_path}")
+            outputs = await asyncio.to_thread(run_subprocess, task, inputs)
+
+        if task_uid in preempted_tasks:
+            raise TaskPreempted()
+
+        duration_ms = (time.time() - started) * 1000
+        logger.info(f"Script {function_uid} processed {len(inputs)} inputs in {duration_ms:.1f} ms")
+
+        results = collect_outputs(inputs, outputs)
+        failed = sum(1 for result in results if "error" in result)
+
+        # Update task status and report the per-input results
+        await engine.post(
+            f"/api/tasks/{task_uid}/result",
+            json={
+                "status": "failed" if failed else "completed",
+                "result": {
+                    "outputs": results,
+                    "input_count": len(inputs),
+                    "failed_count": failed,
+                    "duration_ms": round(duration_ms, 1)
+                },
+                "worker_uid": WORKER_UID,
+                "error": ""
+            }
+        )
+
+        logger.info(f"Task {task_uid} finished with {failed} failed inputs")
+    except Exception as e:
+        if task_uid in preempted_tasks:
+            # Stopped by the engine, it goes back to the queue instead of failing
+            logger.info(f"Task {task_uid} preempted")
+            await report_preempted(task_uid)
+        else:
+            logger.error(f"Error processing task {task_uid}: {e}")
+            # Update task status to failed
+            await report_failure(task_uid, str(e)[-MAX_ERROR_CHARS:])
+    finally:
+        preempted_tasks.discard(task_uid)
+        script_cache.release(task.get("script_file"))
+        await log_shipper.close_task(task_uid)
+
+async def run():
+    """Main worker loop"""
+    global slot_freed
+    logger.info(f"Starting worker {WORKER_UID} on {hostname} with {WORKER_SLOTS} task slots")
+    slot_freed = asyncio.Event()
+
+    # Slots wait on their warm executor or subprocess in these threads
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=WORKER_SLOTS, thread_name_prefix="slot")
+    )
+
+    # Register with backend engine
+    if not await register_worker():
+        logger.error("Failed to register worker, exiting")
+        sys.exit(1)
+
+    # Heartbeats, log shipping and prefetching run concurrently with the claims,
+    # all of them share the agent's connection to the engine
+    background = [
+        asyncio.create_task(heartbeat_loop()),
+        asyncio.create_task(log_shipper.run())
+    ]
+
+    # Claim and prepare the next tasks in the background while the slots run
+    if PREFETCH_SIZE > 0:
+        background.append(asyncio.create_task(prefetch_tasks()))
+
+    first_task = True
+
+    while True:
+        slot_freed.clear()
+
+        # Fill the idle slots from the prefetch buffer first, then claim directly
+        claimed = await start_prefetched_tasks()
+        claimed += await check_for_tasks()
+
+        if claimed and first_task:
+            logger.info(f"First task started {(time.time() - AGENT_STARTED_AT) * 1000:.0f} ms after agent start")
+            first_task = False
+
+        # Wait for a slot to free up, polling briefly while there are tasks to claim
+        # or a gang rank reserved here may be released
+        try:
+            await asyncio.wait_for(slot_freed.wait(), 1 if (claimed or reserved_slots) and free_slot_count() > 0 else 5)
+        except asyncio.TimeoutError:
+            pass
+
+def main():
+    """Run the worker agent"""
+    asyncio.run(run())
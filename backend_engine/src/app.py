@@ -6,6 +6,16 @@ from sanic.response import json
 from pathlib import Path
 from dotenv import load_dotenv
 from db import init_db
+from lib.heartbeat import run_heartbeat_flusher, flush_heartbeats
+from lib.failure_detector import run_failure_detector
+from lib.utilization import run_utilization_aggregator, flush_grid_utilization
+from lib.autoscaler import run_autoscaler
+from lib.k8ssdk import K8S_ENABLED, run_deployment_queue
+from lib.reconciler import run_reconciler
+from lib.warmpool import run_warm_pool
+from lib.priority import run_preemptor
+from lib.limits import run_limits_reconciler
+from lib.gang import run_gang_expiry
 
 # Load environment variables
 env_path = Path(__file__).parent.parent.parent / 'config.env'
@@ -29,6 +39,9 @@ app.config.CORS_ORIGINS = os.environ.get("FRONTEND_URL", "http://localhost:3000"
 app.config.CORS_ALLOW_HEADERS = ["Content-Type", "Authorization"]
 app.config.CORS_ALWAYS_SEND = True
 
+# Workers keep one connection open to the engine, don't close it between their polls
+app.config.KEEP_ALIVE_TIMEOUT = int(os.environ.get("KEEP_ALIVE_TIMEOUT", "75"))
+
 # Import blueprints
 from blueprints.grid import grid_bp
 from blueprints.fn import bp as fn_bp
@@ -61,8 +74,32 @@ async def setup_db(app, _):
     await init_db()
     logger.info("Database initialized successfully")
 
-# Register startup listener
+async def start_background_tasks(app, _):
+    logger.info("Starting heartbeat flusher, failure detector, utilization aggregator, autoscaler, preemptor, function limits and gang expiry...")
+    app.add_task(run_heartbeat_flusher())
+    app.add_task(run_failure_detector())
+    app.add_task(run_utilization_aggregator())
+    app.add_task(run_autoscaler())
+    if K8S_ENABLED:
+        logger.info("Starting deployment queue, reconciler and warm pools...")
+        app.add_task(run_deployment_queue())
+        app.add_task(run_reconciler())
+        app.add_task(run_warm_pool())
+    else:
+        logger.info("Kubernetes not configured, workers are not deployed (set K8S_ENABLED=true to force)")
+    app.add_task(run_preemptor())
+    app.add_task(run_limits_reconciler())
+    app.add_task(run_gang_expiry())
+
+async def stop_background_tasks(app, _):
+    # Write the heartbeats and grid counters changed since the last flush
+    await flush_heartbeats()
+    await flush_grid_utilization()
+
+# Register startup and shutdown listeners
 app.register_listener(setup_db, "before_server_start")
+app.register_listener(start_background_tasks, "after_server_start")
+app.register_listener(stop_background_tasks, "before_server_stop")
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
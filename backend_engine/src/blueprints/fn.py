@@ -1,9 +1,10 @@
 import os
 import shutil
 import json
+import hashlib
 from pathlib import Path
 from sanic import Blueprint
-from sanic.response import json as sanic_json, file as send_file
+from sanic.response import json as sanic_json, file as send_file, empty
 from lib.fn import (
     get_all_functions, 
     get_function_by_uid, 
@@ -15,6 +16,8 @@ from lib.fn import (
     delete_function,
     update_script_path
 )
+from lib.priority import priority_value
+from lib.limits import limit_settings, get_limits
 from db import FunctionStatus
 import logging
 from uuid import uuid4
@@ -53,14 +56,39 @@ async def get_function(request, uid):
     
     return sanic_json(function)
 
+# Content hashes of scripts by path, recomputed only when the file changes
+script_hashes = {}
+
+def get_script_hash(script_path):
+    """Get the sha256 content hash of a script"""
+    stat = script_path.stat()
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    cached = script_hashes.get(script_path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(script_path, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
+    script_hashes[script_path] = (key, content_hash)
+    return content_hash
+
 @bp.route("/<uid>/script", methods=["GET"])
 async def get_function_script(request, uid):
-    """Get a function script"""
+    """Get a function script, revalidated by workers through its content hash ETag"""
     # return a file
     script_path = SCRIPTS_DIR / uid / "main.py"
     if not script_path.exists():
         return sanic_json({"error": f"Function script not found for {uid}"}, status=404)
-    return await send_file(script_path)
+
+    etag = f'"{get_script_hash(script_path)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    # The worker already has this version of the script
+    if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        return empty(status=304, headers=headers)
+
+    return await send_file(script_path, headers=headers)
 
 @bp.route("/", methods=["POST"])
 async def create_function_endpoint(request):
@@ -88,6 +116,29 @@ async def create_function_endpoint(request):
             except (ValueError, TypeError):
                 return sanic_json({"error": "batch_size must be an integer"}, status=400)
         
+        # Set gang_size if provided, the function's tasks then start together in gangs of that size
+        if data.get("gang_size") is not None:
+            try:
+                gang_size = int(data["gang_size"])
+                if gang_size < 1:
+                    return sanic_json({"error": "gang_size must be at least 1"}, status=400)
+                data["gang_size"] = gang_size
+            except (ValueError, TypeError):
+                return sanic_json({"error": "gang_size must be an integer"}, status=400)
+        
+        # Set priority if provided, a class name or a number
+        if "priority" in data:
+            try:
+                data["priority"] = priority_value(data["priority"])
+            except ValueError as e:
+                return sanic_json({"error": str(e)}, status=400)
+        
+        # Set concurrency and rate limits if provided
+        try:
+            data.update(limit_settings(data))
+        except ValueError as e:
+            return sanic_json({"error": str(e)}, status=400)
+        
         # Create function in database first to get the UID
         function = await create_new_function(data)
         
@@ -180,6 +231,33 @@ async def update_function_endpoint(request, uid):
     
     return sanic_json(function)
 
+@bp.route("/<uid>/limits", methods=["GET"])
+async def get_function_limits(request, uid):
+    """Get a function's concurrency and rate limits and its current counters"""
+    limits = await get_limits(uid)
+    
+    if not limits:
+        return sanic_json({"error": f"Function with UID {uid} not found"}, status=404)
+    
+    return sanic_json(limits)
+
+@bp.route("/<uid>/limits", methods=["PUT"])
+async def update_function_limits(request, uid):
+    """Update a function's concurrency and rate limits, 0 clears a limit"""
+    data = request.json or {}
+    try:
+        settings = limit_settings(data)
+    except ValueError as e:
+        return sanic_json({"error": str(e)}, status=400)
+    
+    if not settings:
+        return sanic_json({"error": "No limits given"}, status=400)
+    
+    if not await update_function(uid, settings):
+        return sanic_json({"error": f"Function with UID {uid} not found"}, status=404)
+    
+    return sanic_json(await get_limits(uid))
+
 @bp.route("/<uid>/start", methods=["POST"])
 async def start_function_endpoint(request, uid):
     """Start a function"""
@@ -202,7 +280,10 @@ async def start_function_endpoint(request, uid):
                 logger.error(f"Error processing parameters for function {uid}: {e}")
                 return sanic_json({"error": f"Error processing parameters: {str(e)}"}, status=400)
         # Start the function with parameters
-        result = await start_function(uid, params)
+        try:
+            result = await start_function(uid, params)
+        except ValueError as e:
+            return sanic_json({"error": str(e)}, status=400)
         
         if result:
             return sanic_json({"message": "Function started successfully"})
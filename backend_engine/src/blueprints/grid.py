@@ -1,6 +1,9 @@
 from sanic import Blueprint
 from sanic.response import json
-from lib.grid import get_all_grids, get_grid_by_uid, create_new_grid, activate_grid, pause_grid, terminate_grid
+from lib.grid import get_all_grids, get_grid_by_uid, create_new_grid, initialize_grid, activate_grid, pause_grid, terminate_grid, get_grid_capacity
+from lib.provisioning import get_provisioning_progress
+from lib.autoscaler import get_autoscale, update_autoscale
+from lib.workergroup import register_group_worker
 
 grid_bp = Blueprint('grids', url_prefix='/api/grids')
 
@@ -20,6 +23,16 @@ async def get_grid(request, uid):
     
     return json(grid)
 
+@grid_bp.get('/<uid>/capacity')
+async def get_grid_capacity_api(request, uid):
+    """Get the measured capacity of a grid's workers"""
+    capacity = await get_grid_capacity(uid)
+    
+    if not capacity:
+        return json({"error": f"Grid with UID {uid} not found"}, status=404)
+    
+    return json(capacity)
+
 @grid_bp.post('/')
 async def create_grid(request):
     """Create a new grid"""
@@ -34,6 +47,63 @@ async def create_grid(request):
     grid = await create_new_grid(data)
     return json(grid)
 
+@grid_bp.post('/<uid>/initialize')
+async def initialize_grid_api(request, uid):
+    """Create and deploy a worker for each cell of a grid"""
+    progress = await initialize_grid(uid, request.json or {})
+    
+    if not progress:
+        return json({"error": f"Failed to initialize grid {uid}"}, status=400)
+    
+    return json(progress, status=202)
+
+@grid_bp.get('/<uid>/initialize')
+async def get_grid_initialization(request, uid):
+    """Get the progress of a grid's worker provisioning"""
+    progress = get_provisioning_progress(uid)
+    
+    if not progress:
+        return json({"error": f"No provisioning found for grid {uid}"}, status=404)
+    
+    return json(progress)
+
+@grid_bp.post('/<uid>/workers/register')
+async def register_group_worker_api(request, uid):
+    """Register a worker group replica by its pod ordinal, returns the worker's UID"""
+    data = request.json or {}
+    try:
+        ordinal = int(data["ordinal"])
+    except (KeyError, TypeError, ValueError):
+        return json({"error": "Missing or invalid field: ordinal"}, status=400)
+    
+    worker_uid = await register_group_worker(uid, ordinal, data)
+    
+    if not worker_uid:
+        return json({"error": f"Grid {uid} has no worker group replica {ordinal}"}, status=404)
+    
+    return json({"uid": worker_uid})
+
+@grid_bp.get('/<uid>/autoscale')
+async def get_grid_autoscale(request, uid):
+    """Get a grid's autoscaler settings and latest decisions"""
+    limit = int(request.args.get("limit", 20))
+    autoscale = await get_autoscale(uid, limit)
+    
+    if not autoscale:
+        return json({"error": f"Grid with UID {uid} not found"}, status=404)
+    
+    return json(autoscale)
+
+@grid_bp.put('/<uid>/autoscale')
+async def update_grid_autoscale(request, uid):
+    """Update a grid's autoscaler settings"""
+    settings = await update_autoscale(uid, request.json or {})
+    
+    if not settings:
+        return json({"error": f"Failed to update autoscaler of grid {uid}"}, status=400)
+    
+    return json(settings)
+
 @grid_bp.post('/<uid>/activate')
 async def activate_grid_api(request, uid):
     """Activate a grid"""
@@ -1,6 +1,13 @@
+import asyncio
+import gzip
+from uuid import UUID
+from json import loads as json_loads
 from sanic import Blueprint
 from sanic.response import json
-from lib.task import get_all_tasks, get_task_by_uid, create_new_task, assign_task_to_worker, update_task_status
+from lib.task import get_all_tasks, get_task_by_uid, create_new_task, assign_task_to_worker, assign_tasks_to_worker, start_leased_task, update_task_status
+from lib.logstore import get_log_store
+from lib.gang import claim_gang_tasks
+from lib.priority import requeue_preempted_task
 
 bp = Blueprint("task", url_prefix="/api/tasks")
 
@@ -18,6 +25,27 @@ async def get_tasks(request):
     if "status" in request.args:
         filters["status"] = request.args.get("status")
 
+    if "worker" in request.args and "count" in request.args:
+        # Claim enough tasks to fill the worker's idle slots
+        try:
+            count = int(request.args.get("count"))
+        except (ValueError, TypeError):
+            return json({"error": "count must be an integer"}, status=400)
+
+        # With prefetch the tasks are only leased until the worker starts them
+        prefetch = request.args.get("prefetch", "false").lower() in ["1", "true"]
+
+        # Released gang ranks come first, slots holding a gang reservation stay idle
+        worker_uid = request.args.get("worker")
+        count = max(count, 1)
+        try:
+            tasks, reserved = ([], 0) if prefetch else await claim_gang_tasks(worker_uid, count)
+            if count - len(tasks) - reserved > 0:
+                tasks += await assign_tasks_to_worker(worker_uid, count - len(tasks) - reserved, prefetch)
+        except Exception as e:
+            return json({"error": str(e)}, status=500)
+        return json({"tasks": tasks, "reserved": reserved})
+
     if "worker" in request.args:
         response = await assign_task_to_worker(request.args.get("worker"))
         return json(response)
@@ -59,6 +87,36 @@ async def get_task_status(request, task_id):
     
     return json({"status": task["status"]})
 
+@bp.route("/<task_id>/start", methods=["POST"])
+async def start_task(request, task_id):
+    """Start a task the worker prefetched"""
+    data = request.json
+
+    if not data or "worker_uid" not in data:
+        return json({"error": "Missing required field: worker_uid"}, status=400)
+
+    started = await start_leased_task(task_id, data["worker_uid"])
+
+    if not started:
+        return json({"error": f"Task {task_id} is no longer leased to worker {data['worker_uid']}"}, status=409)
+
+    return json({"success": True, "message": f"Task {task_id} started"})
+
+@bp.route("/<task_id>/preempted", methods=["POST"])
+async def preempted_task(request, task_id):
+    """Requeue a task the worker stopped for higher priority work, with its checkpoint"""
+    data = request.json
+
+    if not data or "worker_uid" not in data:
+        return json({"error": "Missing required field: worker_uid"}, status=400)
+
+    requeued = await requeue_preempted_task(task_id, data["worker_uid"], data.get("checkpoint"))
+
+    if not requeued:
+        return json({"error": f"Task {task_id} is not running on worker {data['worker_uid']}"}, status=409)
+
+    return json({"success": True, "message": f"Task {task_id} requeued"})
+
 @bp.route("/<task_id>/result", methods=["POST"])
 async def update_task_result(request, task_id):
     """Update task result"""
@@ -71,8 +129,11 @@ async def update_task_result(request, task_id):
     error = data.get("error", '')
     worker_uid = data.get("worker_uid")
     
-    # Determine status based on result
-    status = "completed" if result == "completed" else "failed"
+    # Workers report the status next to the structured per-input result,
+    # older workers only send "completed" or "failed" as the result
+    status = data.get("status")
+    if status not in ["completed", "failed"]:
+        status = "completed" if result == "completed" else "failed"
 
     # Update task status and result
     updated = await update_task_status(
@@ -83,6 +144,9 @@ async def update_task_result(request, task_id):
         worker_uid=worker_uid
     )
     
+    if updated is None:
+        return json({"error": f"Task {task_id} is not running on or leased to worker {worker_uid}"}, status=409)
+    
     if not updated:
         return json({"error": f"Failed to update task {task_id}"}, status=500)
     
@@ -93,4 +157,56 @@ async def update_task_status_endpoint(request, task_id):
     """Update task status"""
     data = request.json
     updated = await update_task_status(task_id, data.get("status"))
-    return json({"success": True, "message": f"Task {task_id} updated successfully"})
\ No newline at end of file
+    return json({"success": True, "message": f"Task {task_id} updated successfully"})
+
+@bp.route("/<task_id>/logs", methods=["POST"])
+async def append_task_logs(request, task_id):
+    """Append a batch of log lines shipped by the worker the task is assigned to"""
+    try:
+        UUID(task_id)
+    except ValueError:
+        return json({"error": f"Invalid task UID {task_id}"}, status=400)
+
+    try:
+        body = request.body
+        if request.headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        data = json_loads(body)
+    except Exception as e:
+        return json({"error": f"Invalid log batch: {e}"}, status=400)
+
+    task = await get_task_by_uid(task_id)
+
+    if not task:
+        return json({"error": f"Task with UID {task_id} not found"}, status=404)
+
+    if not data.get("worker_uid") or task["worker_uid"] != data["worker_uid"]:
+        return json({"error": f"Task {task_id} is not assigned to worker {data.get('worker_uid')}"}, status=409)
+
+    lines = data.get("lines") or []
+    dropped = data.get("dropped", 0)
+
+    written = await asyncio.to_thread(get_log_store().append, task_id, lines, dropped)
+    return json({"success": True, "written": written})
+
+@bp.route("/<task_id>/logs", methods=["GET"])
+async def get_task_logs(request, task_id):
+    """Get a task's logs from a byte offset"""
+    try:
+        UUID(task_id)
+    except ValueError:
+        return json({"error": f"Invalid task UID {task_id}"}, status=400)
+
+    task = await get_task_by_uid(task_id)
+
+    if not task:
+        return json({"error": f"Task with UID {task_id} not found"}, status=404)
+
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", 65536))
+    except (ValueError, TypeError):
+        return json({"error": "offset and limit must be integers"}, status=400)
+
+    data, next_offset = await asyncio.to_thread(get_log_store().read, task_id, max(offset, 0), max(limit, 1))
+    return json({"data": data, "offset": next_offset, "status": task["status"]})
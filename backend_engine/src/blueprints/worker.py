@@ -1,8 +1,14 @@
 from sanic import Blueprint
 from sanic.response import json
-from lib.worker import get_all_workers, get_worker_by_uid, create_worker, create_workers_batch, set_worker_online, set_worker_offline, associate_worker_with_grid, delete_worker
+from lib.worker import get_all_workers, get_worker_by_uid, create_worker, create_workers_batch, set_worker_online, set_worker_offline, associate_worker_with_grid, delete_worker, update_worker_heartbeat
 from sqlalchemy.sql import text
-import os
+from db import get_session
+from lib.priority import preemptions
+import json as jsonlib
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint("worker", url_prefix="/api/workers")
 
@@ -20,6 +26,36 @@ async def get_workers(request):
     workers = await get_all_workers(filters)
     return json(workers)
 
+@bp.route("/deployments", methods=["GET"])
+async def get_deployments(request):
+    """Deployment queue jobs by status, recent failures, API server request counters and reconciler counters"""
+    from lib.k8ssdk import deployment_queue
+    from lib.reconciler import reconciler
+    try:
+        summary = await deployment_queue.summary()
+        summary["reconciler"] = dict(reconciler.stats, observed=len(reconciler.observed), dirty=len(reconciler.dirty))
+        return json(summary)
+    except Exception as e:
+        logger.error(f"Error reading the deployment queue: {e}")
+        return json({"error": f"Error reading the deployment queue: {str(e)}"}, status=500)
+
+@bp.route("/pools", methods=["GET"])
+async def get_warm_pools(request):
+    """Warm pools with their ready and booting workers"""
+    from lib.warmpool import get_pools
+    return json(await get_pools())
+
+@bp.route("/pools", methods=["PUT"])
+async def set_warm_pool(request):
+    """Create, resize or remove (size 0) the warm pool of an image and resource class"""
+    from lib.warmpool import set_pool
+    pools = await set_pool(request.json or {})
+    
+    if pools is None:
+        return json({"error": "Invalid warm pool settings"}, status=400)
+    
+    return json(pools)
+
 @bp.route("/<uid>", methods=["GET"])
 async def get_worker(request, uid):
     """Get a specific worker by UID"""
@@ -75,13 +111,26 @@ async def associate_worker_with_grid_endpoint(request, uid, grid_uid):
 @bp.route("/<uid>/online", methods=["POST"])
 async def set_worker_online_endpoint(request, uid):
     """Set a worker's status to online"""
-    result = await set_worker_online(uid)
+    result = await set_worker_online(uid, request.json or {})
     
     if result:
         return json({"message": f"Worker {uid} set to online"})
     else:
         return json({"error": f"Failed to set worker {uid} to online"}, status=500)
 
+@bp.route("/<uid>/heartbeat", methods=["POST"])
+async def worker_heartbeat_endpoint(request, uid):
+    """Record a worker heartbeat with its measured resource usage and slot occupancy
+
+    The response lists the running tasks the worker should stop for higher priority work.
+    """
+    result = await update_worker_heartbeat(uid, request.json or {})
+    
+    if result:
+        return json({"message": f"Heartbeat recorded for worker {uid}", "preempt": preemptions.for_worker(uid)})
+    else:
+        return json({"error": f"Worker {uid} not found, register again"}, status=404)
+
 @bp.route("/<uid>/offline", methods=["POST"])
 async def set_worker_offline_endpoint(request, uid):
     """Set a worker status to offline"""
@@ -126,21 +175,21 @@ async def deploy_worker_endpoint(request, uid):
                 "memory_total": worker.memory_total,
                 "gpu_id": worker.gpu_id,
                 "gpu_memory": worker.gpu_memory,
-                "spec": worker.spec
+                "spec": jsonlib.loads(worker.spec) if isinstance(worker.spec, str) else worker.spec
             }
             
-            # Deploy worker to Kubernetes
-            from lib.k8ssdk import K8sDeployer
-            namespace = os.environ.get("K8S_NAMESPACE", "default")
-            deployer = K8sDeployer(namespace=namespace)
-            
-            # Deploy worker
-            result = deployer.deploy_worker(worker_dict)
+            # Deploy worker through the deployment queue, answer once it's done or still retrying
+            from lib.k8ssdk import deployment_queue, K8S_REQUEST_TIMEOUT
+            futures = await deployment_queue.submit("deploy", [worker_dict])
+            try:
+                error = await asyncio.wait_for(asyncio.shield(futures[uid]), timeout=K8S_REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                return json({"message": f"Deployment of worker {uid} is queued"}, status=202)
             
-            if result:
+            if error is None:
                 return json({"message": f"Worker {uid} deployed successfully"})
             else:
-                return json({"error": f"Failed to deploy worker {uid}"}, status=500)
+                return json({"error": f"Failed to deploy worker {uid}: {error}"}, status=500)
     except Exception as e:
         logger.error(f"Error deploying worker {uid}: {e}")
         return json({"error": f"Error deploying worker: {str(e)}"}, status=500) 
\ No newline at end of file
@@ -67,7 +67,12 @@ def list_functions():
 @click.option("--gpu", "-G", is_flag=True, help="Requires GPU")
 @click.option("--docker-image", "-d", default="python:3.11-slim", help="Docker image to use")
 @click.option("--batch-size", "-b", default=1, help="Number of parallel tasks to create")
-def create_function_cmd(name, grid, script, artifactory, cpu, memory, gpu, docker_image, batch_size):
+@click.option("--gang-size", type=int, help="Start the tasks together in gangs of this many workers")
+@click.option("--priority", "-P", help="Priority class (low, normal, high, urgent) or number")
+@click.option("--max-concurrency", type=int, help="Most tasks running at once")
+@click.option("--rate-limit", type=float, help="Most tasks started per second")
+@click.option("--rate-burst", type=int, help="Tasks started at once under the rate limit")
+def create_function_cmd(name, grid, script, artifactory, cpu, memory, gpu, docker_image, batch_size, gang_size, priority, max_concurrency, rate_limit, rate_burst):
     """Create a new function"""
     try:
         # Expand user path (e.g., ~/script.py)
@@ -119,6 +124,21 @@ def create_function_cmd(name, grid, script, artifactory, cpu, memory, gpu, docke
         if artifactory:
             data["artifactory_url"] = artifactory
         
+        if gang_size:
+            data["gang_size"] = gang_size
+        
+        if priority:
+            data["priority"] = priority
+        
+        if max_concurrency:
+            data["max_concurrency"] = max_concurrency
+        
+        if rate_limit:
+            data["rate_limit"] = rate_limit
+        
+        if rate_burst:
+            data["rate_burst"] = rate_burst
+        
         # Create the function
         click.echo("Creating function...")
         function = client.post("/api/functions", data)
@@ -128,10 +148,24 @@ def create_function_cmd(name, grid, script, artifactory, cpu, memory, gpu, docke
         click.echo(f"Script path: {function['script_path']}")
         click.echo(f"Docker Image: {function['docker_image']}")
         click.echo(f"Batch Size: {function.get('batch_size', 1)}")  # Display batch size
+        if function.get('gang_size'):
+            click.echo(f"Gang Size: {function['gang_size']}")
+        click.echo(f"Priority: {function.get('priority_class', 'normal')}")
+        click.echo(f"Limits: {format_limits(function)}")
         click.echo(f"Status: {function['status']}")
     except Exception as e:
         click.echo(f"Error: {str(e)}")
 
+def format_limits(function):
+    """Concurrency and rate limits of a function as one line"""
+    limits = []
+    if function.get('max_concurrency'):
+        limits.append(f"{function['max_concurrency']} at once")
+    if function.get('rate_limit'):
+        burst = function.get('rate_burst') or max(1, int(function['rate_limit']))
+        limits.append(f"{function['rate_limit']}/s, bursts of {burst}")
+    return ", ".join(limits) or "none"
+
 @fn_cli.command(name="show")
 @click.argument("uid")
 def show_function(uid):
@@ -146,6 +180,10 @@ def show_function(uid):
         click.echo(f"Docker Image: {function.get('docker_image', 'default')}")
         click.echo(f"Status: {function['status']}")
         click.echo(f"Batch Size: {function.get('batch_size', 1)}")
+        if function.get('gang_size'):
+            click.echo(f"Gang Size: {function['gang_size']}")
+        click.echo(f"Priority: {function.get('priority_class', 'normal')}")
+        click.echo(f"Limits: {format_limits(function)}")
         
         # Get task count
         tasks = client.get("/api/tasks", {"function": uid})
@@ -172,7 +210,10 @@ def show_function(uid):
 @click.option('--params', '-p', help='JSON string with function parameters')
 @click.option('--params-file', '-f', help='Path to JSON file with function parameters')
 @click.option('--batch-size', '-b', type=int, help='Override batch size for this run')
-def start_function_cmd(uid, params, params_file, batch_size):
+@click.option('--provision', type=int, help="Workers to add if no worker of the grid runs the function's image")
+@click.option('--gang-size', type=int, help='Override gang size for this run')
+@click.option('--priority', '-P', help='Override priority class for this run')
+def start_function_cmd(uid, params, params_file, batch_size, provision, gang_size, priority):
     """Start a function with the given UID"""
     if params and params_file:
         click.echo("Error: Cannot specify both --params and --params-file")
@@ -203,6 +244,18 @@ def start_function_cmd(uid, params, params_file, batch_size):
         # Convert back to JSON string
         params = json.dumps(params_dict)
     
+    if provision is not None:
+        params_dict['provision_workers'] = provision
+        params = json.dumps(params_dict)
+    
+    if gang_size is not None:
+        params_dict['gang_size'] = gang_size
+        params = json.dumps(params_dict)
+    
+    if priority is not None:
+        params_dict['priority'] = priority
+        params = json.dumps(params_dict)
+    
     # Prepare request data
     data = {}
     if params:
@@ -238,6 +291,32 @@ def check_function_status_cmd(uid):
     except Exception as e:
         click.echo(f"Error: {str(e)}")
 
+@fn_cli.command(name="limits")
+@click.argument("uid")
+@click.option("--max-concurrency", type=int, help="Most tasks running at once, 0 for no limit")
+@click.option("--rate-limit", type=float, help="Most tasks started per second, 0 for no limit")
+@click.option("--rate-burst", type=int, help="Tasks started at once under the rate limit, 0 for the default")
+def limits_function_cmd(uid, max_concurrency, rate_limit, rate_burst):
+    """Show or change a function's concurrency and rate limits"""
+    try:
+        client = APIClient()
+        changes = {
+            "max_concurrency": max_concurrency,
+            "rate_limit": rate_limit,
+            "rate_burst": rate_burst
+        }
+        changes = {key: value for key, value in changes.items() if value is not None}
+        if changes:
+            client.put(f"/api/functions/{uid}/limits", changes)
+        
+        limits = client.get(f"/api/functions/{uid}/limits")
+        click.echo(f"Limits: {format_limits(limits)}")
+        click.echo(f"  Running: {limits['running']}")
+        if limits.get('tokens') is not None:
+            click.echo(f"  Tokens: {limits['tokens']}")
+    except Exception as e:
+        click.echo(f"Error: {str(e)}")
+
 @fn_cli.command(name="delete")
 @click.argument("uid")
 @click.option("--force", "-f", is_flag=True, help="Force deletion without confirmation")
@@ -1,6 +1,7 @@
 import click
 import json
 import os
+import time
 from datetime import datetime
 from tabulate import tabulate
 from cli.api_client import APIClient
@@ -40,11 +41,53 @@ def list_grids():
     except Exception as e:
         click.echo(f"Error: {str(e)}")
 
+def worker_options(command):
+    """Resources and image of the workers a grid is initialized with"""
+    command = click.option("--cpu", type=float, default=4.0, show_default=True, help="CPU cores per worker")(command)
+    command = click.option("--memory", type=int, default=8192, show_default=True, help="Memory per worker in MB")(command)
+    command = click.option("--image", default="python:3.11-slim", show_default=True, help="Worker Docker image")(command)
+    command = click.option("--deploy/--no-deploy", default=True, help="Deploy the workers to Kubernetes")(command)
+    command = click.option("--group/--no-group", default=False, help="Deploy the workers as the replicas of one StatefulSet")(command)
+    command = click.option("--wait/--no-wait", default=True, help="Follow the provisioning until it finishes")(command)
+    return command
+
+def initialize(client, uid, cpu, memory, image, deploy, group, wait):
+    """Initialize a grid's workers and optionally follow the progress"""
+    data = {
+        "cpu_total": cpu,
+        "memory_total": memory,
+        "docker_image": image,
+        "auto_deploy": deploy
+    }
+    if group:
+        data["mode"] = "group"
+    progress = client.post(f"/api/grids/{uid}/initialize", data)
+    click.echo(f"Created {progress['created']} workers")
+    
+    if not wait:
+        return
+    
+    while progress["state"] in ("creating", "deploying"):
+        time.sleep(2)
+        progress = client.get(f"/api/grids/{uid}/initialize")
+        eta = f", ETA {progress['eta_seconds']:.0f}s" if progress["eta_seconds"] else ""
+        click.echo(
+            f"\rDeployed {progress['deployed']}/{progress['created']}, failed {progress['failed']} "
+            f"({progress['workers_per_second']:.1f}/s{eta})    ",
+            nl=False
+        )
+    
+    click.echo(f"\nProvisioning {progress['state']} in {progress['elapsed_seconds']:.0f}s")
+    for error in progress["errors"]:
+        click.echo(f"  {error['name']}: {error['error']}")
+
 @grid_cli.command(name="create")
 @click.option("--name", "-n", required=True, help="Grid name")
 @click.option("--length", "-l", required=True, type=int, help="Grid length")
 @click.option("--width", "-w", required=True, type=int, help="Grid width")
-def create_grid(name, length, width):
+@click.option("--init/--no-init", default=True, help="Create a worker for each cell of the grid")
+@worker_options
+def create_grid(name, length, width, init, cpu, memory, image, deploy, group, wait):
     """Create a new grid"""
     try:
         client = APIClient()
@@ -57,7 +100,20 @@ def create_grid(name, length, width):
         response = client.post("/api/grids", data)
         
         click.echo(f"Grid created with UID: {response['uid']}")
-        click.echo("Initializing grid...")
+        if init:
+            click.echo("Initializing grid...")
+            initialize(client, response["uid"], cpu, memory, image, deploy, group, wait)
+    except Exception as e:
+        click.echo(f"Error: {str(e)}")
+
+@grid_cli.command(name="init")
+@click.argument("uid")
+@worker_options
+def init_grid(uid, cpu, memory, image, deploy, group, wait):
+    """Create and deploy a worker for each cell of a grid"""
+    try:
+        client = APIClient()
+        initialize(client, uid, cpu, memory, image, deploy, group, wait)
     except Exception as e:
         click.echo(f"Error: {str(e)}")
 
@@ -90,6 +146,21 @@ def show_grid(uid):
             click.echo(f"  Online: {online}")
             click.echo(f"  Busy: {busy}")
             click.echo(f"  Offline: {offline}")
+        
+        # Capacity measured from the workers' heartbeats
+        capacity = client.get(f"/api/grids/{uid}/capacity")
+        click.echo(f"\nLive Workers: {capacity['live_workers']}")
+        click.echo(f"  CPU Available: {capacity['cpu_available']:.2f} / {capacity['cpu_total']:.2f} cores")
+        click.echo(f"  Memory Available: {capacity['memory_available'] / 1024:.1f} / {capacity['memory_total'] / 1024:.1f} GB")
+        click.echo(f"  Slots Busy: {capacity['slots_busy']} / {capacity['slots_total']}")
+        
+        # Where tiled tasks ran relative to the slot they were placed on
+        locality = capacity.get("locality") or {}
+        if locality.get("local") or locality.get("adjacent") or locality.get("remote"):
+            click.echo(
+                f"  Tile Locality: {locality['local']} local, {locality['adjacent']} adjacent, "
+                f"{locality['remote']} remote ({locality['remote_ratio'] * 100:.1f}% remote)"
+            )
     except Exception as e:
         click.echo(f"Error: {str(e)}")
 
@@ -126,3 +197,55 @@ def terminate_grid_cmd(uid):
         click.echo(response["message"])
     except Exception as e:
         click.echo(f"Error: {str(e)}")
+
+@grid_cli.command(name="autoscale")
+@click.argument("uid")
+@click.option("--enable/--disable", default=None, help="Turn the autoscaler on or off")
+@click.option("--min", "min_workers", type=int, help="Minimum number of workers")
+@click.option("--max", "max_workers", type=int, help="Maximum number of workers")
+@click.option("--drain", "target_drain_seconds", type=int, help="Seconds the backlog should be worked off in")
+@click.option("--up-cooldown", "scale_up_cooldown", type=int, help="Seconds between scale ups")
+@click.option("--down-cooldown", "scale_down_cooldown", type=int, help="Seconds between scale downs")
+@click.option("--limit", default=10, show_default=True, help="Number of recent decisions to show")
+def autoscale_grid_cmd(uid, enable, min_workers, max_workers, target_drain_seconds, scale_up_cooldown, scale_down_cooldown, limit):
+    """Show or change a grid's autoscaler and its recent decisions"""
+    try:
+        client = APIClient()
+        changes = {
+            "min_workers": min_workers,
+            "max_workers": max_workers,
+            "target_drain_seconds": target_drain_seconds,
+            "scale_up_cooldown": scale_up_cooldown,
+            "scale_down_cooldown": scale_down_cooldown
+        }
+        changes = {key: value for key, value in changes.items() if value is not None}
+        if enable is not None:
+            changes["enabled"] = enable
+        if changes:
+            client.put(f"/api/grids/{uid}/autoscale", changes)
+        
+        autoscale = client.get(f"/api/grids/{uid}/autoscale", {"limit": limit})
+        settings = autoscale["settings"]
+        click.echo(f"Autoscaler: {'enabled' if settings['enabled'] else 'disabled'}")
+        click.echo(f"  Workers: {settings['min_workers']} - {settings['max_workers']}")
+        click.echo(f"  Drain Target: {settings['target_drain_seconds']}s")
+        click.echo(f"  Cooldowns: {settings['scale_up_cooldown']}s up, {settings['scale_down_cooldown']}s down")
+        
+        if autoscale["decisions"]:
+            headers = ["Time", "Action", "Workers", "Desired", "Changed", "Reason"]
+            table_data = [
+                [
+                    decision["created_at"].replace("T", " ")[:19],
+                    decision["action"],
+                    decision["current_workers"],
+                    decision["desired_workers"],
+                    decision["changed_workers"],
+                    decision["reason"]
+                ]
+                for decision in autoscale["decisions"]
+            ]
+            click.echo(tabulate(table_data, headers=headers, tablefmt="grid"))
+        else:
+            click.echo("No autoscaler decisions yet")
+    except Exception as e:
+        click.echo(f"Error: {str(e)}")
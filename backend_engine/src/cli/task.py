@@ -1,4 +1,6 @@
 import click
+import json
+import time
 from tabulate import tabulate
 from cli.api_client import APIClient
 
@@ -59,12 +61,17 @@ def show_task(uid):
         click.echo(f"Worker: {task.get('worker_uid', 'N/A')}")
         click.echo(f"Status: {task['status']}")
         
-        if task.get('result'):
+        if isinstance(task.get('result'), dict):
+            click.echo(f"Result: {json.dumps(task['result'], indent=2)}")
+        elif task.get('result'):
             click.echo(f"Result: {task['result']}")
             
         if task.get('error'):
             click.echo(f"Error: {task['error']}")
             
+        if task.get('preemptions'):
+            click.echo(f"Preempted: {task['preemptions']} times")
+            
         click.echo(f"Created: {task['created_at']}")
         click.echo(f"Updated: {task['updated_at']}")
         
@@ -75,3 +82,29 @@ def show_task(uid):
             click.echo(f"Ended: {task['ended_at']}")
     except Exception as e:
         click.echo(f"Error: {str(e)}")
+
+@task_cli.command(name="logs")
+@click.argument("uid")
+@click.option("--follow", "-f", is_flag=True, help="Keep streaming new output until the task finishes")
+def task_logs(uid, follow):
+    """Show the output of a task"""
+    try:
+        client = APIClient()
+        offset = 0
+
+        while True:
+            response = client.get(f"/api/tasks/{uid}/logs", {"offset": offset})
+
+            if response["data"]:
+                click.echo(response["data"], nl=False)
+            elif not follow or response["status"] in ["completed", "failed", "cancelled"]:
+                # Nothing new and the task is done, its workers have shipped everything
+                break
+
+            offset = response["offset"]
+            if not response["data"]:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        click.echo(f"Error: {str(e)}")
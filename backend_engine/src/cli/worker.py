@@ -10,7 +10,7 @@ def worker_cli():
 
 @worker_cli.command(name="list")
 @click.option("--grid", "-g", help="Filter by grid UID")
-@click.option("--status", "-s", help="Filter by status (online, offline, busy)")
+@click.option("--status", "-s", help="Filter by status (online, offline, busy, suspect)")
 def list_workers(grid, status):
     """List all workers"""
     try:
@@ -98,6 +98,8 @@ def create_worker(name, grid, cpu, memory, gpu_id, gpu_memory, docker_image, cou
             click.echo(f"CPU: {response['cpu_total']} cores")
             click.echo(f"Memory: {response['memory_total']} MB")
             click.echo(f"Docker Image: {response.get('docker_image', 'python:3.11-slim')}")
+            if response.get("warm"):
+                click.echo("Bound to a warm pod")
     except Exception as e:
         click.echo(f"Error: {str(e)}")
 
@@ -111,7 +113,17 @@ def show_worker(uid):
         
         click.echo(f"Worker: {worker['name']} ({worker['uid']})")
         click.echo(f"Grid: {worker['grid_uid']}")
+        if worker.get("grid_x") is not None:
+            click.echo(f"Slot: ({worker['grid_x']}, {worker['grid_y']})")
         click.echo(f"Status: {worker['status']}")
+        if worker.get("observed_state"):
+            click.echo(f"StatefulSet: {worker['observed_state']} (observed {worker['observed_at']})")
+        if worker.get("group_ordinal") is not None:
+            click.echo(f"Worker group replica: {worker['group_ordinal']}")
+        if worker.get("running_tasks") is not None:
+            click.echo(f"Running tasks: {worker['running_tasks']}")
+        if worker.get("cpu_reserved") is not None:
+            click.echo(f"Reserved: {worker['cpu_reserved']} cores, {worker['memory_reserved'] / 1024:.1f} GB")
         click.echo(f"CPU: {worker['cpu_total']} cores (Available: {worker['cpu_available']} cores)")
         
         memory_total_gb = worker['memory_total'] / 1024
@@ -131,6 +143,21 @@ def show_worker(uid):
         
         if worker.get('last_heartbeat'):
             click.echo(f"Last Heartbeat: {worker['last_heartbeat']}")
+        
+        telemetry = worker.get('telemetry')
+        if telemetry:
+            if telemetry.get('cpu_used') is not None:
+                click.echo(f"CPU Used: {telemetry['cpu_used']:.2f} / {telemetry.get('cpu_limit')} cores")
+            if telemetry.get('memory_used_mb') is not None:
+                click.echo(f"Memory Used: {telemetry['memory_used_mb']} MB")
+            click.echo(f"Slots Busy: {telemetry.get('slots_busy', 0)} / {telemetry.get('slots_total', 0)}")
+            
+            # Latency of the worker's requests to the engine
+            endpoints = telemetry.get('http', {}).get('endpoints', {})
+            if endpoints:
+                click.echo("Engine Latency:")
+                for endpoint, stats in sorted(endpoints.items()):
+                    click.echo(f"  {endpoint}: p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms ({stats['count']} requests, {stats['errors']} errors)")
             
         click.echo(f"Created: {worker['created_at']}")
         click.echo(f"Updated: {worker['updated_at']}")
@@ -230,3 +257,44 @@ def deploy_worker_cmd(uid):
         click.echo(response["message"])
     except Exception as e:
         click.echo(f"Error: {str(e)}")
+
+@worker_cli.command(name="pool")
+@click.option("--docker-image", "-d", default="python:3.11-slim", help="Docker image of the pool")
+@click.option("--cpu", "-c", default=2.0, help="CPU cores of the pool's workers")
+@click.option("--memory", "-m", default=4096, help="Memory in MB of the pool's workers")
+@click.option("--size", "-s", type=int, help="Idle workers to keep ready, 0 removes the pool")
+def warm_pool(docker_image, cpu, memory, size):
+    """Show the warm pools, or set the size of one"""
+    try:
+        client = APIClient()
+        if size is not None:
+            pools = client.put("/api/workers/pools", {
+                "docker_image": docker_image,
+                "cpu_total": cpu,
+                "memory_total": memory,
+                "size": size
+            })
+        else:
+            pools = client.get("/api/workers/pools")
+        
+        if not pools:
+            click.echo("No warm pools")
+            return
+        
+        headers = ["Image", "CPU", "Memory (MB)", "Size", "Ready", "Booting", "Bound", "Cold Starts"]
+        table_data = [
+            [
+                pool["docker_image"],
+                pool["cpu_total"],
+                pool["memory_total"],
+                pool["size"],
+                pool["ready"],
+                pool["booting"],
+                pool["bound"],
+                pool["cold_starts"]
+            ]
+            for pool in pools
+        ]
+        click.echo(tabulate(table_data, headers=headers, tablefmt="grid"))
+    except Exception as e:
+        click.echo(f"Error: {str(e)}")
@@ -1,6 +1,6 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, JSON, Enum
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, JSON, Enum, Index, text
 from sqlalchemy.sql import func
 import enum
 from datetime import datetime
@@ -100,6 +100,7 @@ class WorkerStatus(enum.Enum):
     OFFLINE = "offline"
     BUSY = "busy"
     ERROR = "error"
+    SUSPECT = "suspect"  # Missed heartbeats, set by the failure detector
 
 # Define models with explicit enum type names
 class Grid(Base):
@@ -116,6 +117,8 @@ class Grid(Base):
     free_slots = Column(Integer)  # Number of free slots available
     worker_count = Column(Integer, default=0)  # Number of workers in the grid
     busy_workers = Column(Integer, default=0)  # Number of busy workers in the grid
+    autoscale = Column(JSON)  # Autoscaler settings, see lib/autoscaler.py
+    worker_group = Column(JSON)  # Image, resources and replicas of the grid's worker group, NULL for one StatefulSet per worker
     
 class Function(Base):
     __tablename__ = "functions"
@@ -130,6 +133,11 @@ class Function(Base):
     status = Column(Enum(FunctionStatus, name="functionstatus"), default=FunctionStatus.PENDING)
     batch_size = Column(Integer, default=1)  # Default to 1 task per function
     function_params = Column(JSON, default={})  # Store default parameters
+    gang_size = Column(Integer)  # Tasks that must run at once on distinct workers, NULL schedules tasks independently
+    priority = Column(Integer, nullable=False, default=0)  # Class of its tasks, higher first, see lib/priority.py
+    max_concurrency = Column(Integer)  # Tasks running or prefetched at once, NULL for no limit, see lib/limits.py
+    rate_limit = Column(Float)  # Tasks started per second, NULL for no limit
+    rate_burst = Column(Integer)  # Tasks started at once under rate_limit, defaults to the rate
     created_at = Column(DateTime, default=func.utcnow())
     updated_at = Column(DateTime, default=func.utcnow(), onupdate=func.utcnow())
     started_at = Column(DateTime)
@@ -149,13 +157,43 @@ class Task(Base):
     ended_at = Column(DateTime)
     result = Column(JSON)    # Store task results
     error = Column(String)    # Store task error
+    lease_expires_at = Column(DateTime)    # Prefetch lease of a pending task claimed by worker_uid
+    slot_x = Column(Integer)    # Grid slot of the task's tile, NULL for untiled tasks
+    slot_y = Column(Integer)
+    docker_image = Column(String)    # Image of the task's function, only claimed by workers running it. NULL runs anywhere
+    gang_uid = Column(String, ForeignKey('gangs.uid'))    # Gang the task is a rank of, see lib/gang.py
+    priority = Column(Integer, nullable=False, default=0)    # Priority of the task's function when it started
+    preempt_requested_at = Column(DateTime)    # Worker asked to stop the running task for higher priority work
+    preemptions = Column(Integer, nullable=False, default=0)    # Times the task was stopped and requeued
+
+    __table_args__ = (
+        Index("ix_tasks_pending_slot", "slot_x", "slot_y", postgresql_where=text("status = 'pending'")),
+        Index("ix_tasks_pending_image", "docker_image", "created_at", postgresql_where=text("status = 'pending'")),
+        Index("ix_tasks_pending_priority", "priority", "created_at", postgresql_where=text("status = 'pending'")),
+        Index("ix_tasks_running_priority", "priority", "started_at", postgresql_where=text("status = 'running'")),
+        Index("ix_tasks_gang_uid", "gang_uid", postgresql_where=text("gang_uid IS NOT NULL")),
+        Index("ix_tasks_gang_worker", "worker_uid", postgresql_where=text("gang_uid IS NOT NULL AND lease_expires_at IS NOT NULL")),
+    )
+
+class Gang(Base):
+    __tablename__ = 'gangs'
+
+    uid = Column(String, primary_key=True)
+    function_uid = Column(String, ForeignKey('functions.uid'), nullable=False, index=True)
+    size = Column(Integer, nullable=False)  # Ranks that start together
+    attempts = Column(Integer, default=0)  # Reservations timed out since the last release
+    reserve_deadline = Column(DateTime)  # Partial reservation is given up after this
+    backoff_until = Column(DateTime)  # No reservations before this after a timeout
+    released_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Worker(Base):
     __tablename__ = 'workers'
 
     uid = Column(String, primary_key=True)
     name = Column(String, unique=True, nullable=False)  # Make name unique
-    grid_uid = Column(String, ForeignKey('grids.uid'), nullable=False)
+    grid_uid = Column(String, ForeignKey('grids.uid'))  # NULL for idle warm pool workers
     cpu_total = Column(Float, nullable=False)
     cpu_available = Column(Float, nullable=False)
     memory_total = Column(Integer, nullable=False)  # Memory in MB
@@ -167,7 +205,70 @@ class Worker(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     spec = Column(JSON, default={})  # Additional specifications (OS, arch, etc.)
+    telemetry = Column(JSON)  # Last measured usage and slot occupancy reported by the worker
+    grid_x = Column(Integer)  # (x, y) slot of the worker in its grid
+    grid_y = Column(Integer)
+    observed_state = Column(String)  # State of the worker's StatefulSet seen by the reconciler
+    observed_at = Column(DateTime)
+    pool_key = Column(String)  # Warm pool of an idle pre-provisioned worker, NULL once bound to a grid
+    group_ordinal = Column(Integer)  # Pod ordinal of a worker group replica, NULL for workers with their own StatefulSet
+    running_tasks = Column(Integer, nullable=False, default=0)  # Tasks running on the worker, busy while above 0
+    cpu_reserved = Column(Float, nullable=False, default=0)  # CPU requested by the running tasks' functions, cpu_available is measured
+    memory_reserved = Column(Integer, nullable=False, default=0)  # Memory in MB requested by the running tasks' functions
+
+    __table_args__ = (
+        Index("ix_workers_grid_slot", "grid_uid", "grid_x", "grid_y"),
+        Index("ix_workers_pool_key", "pool_key", postgresql_where=text("pool_key IS NOT NULL")),
+        Index(
+            "ix_workers_group_ordinal", "grid_uid", "group_ordinal",
+            unique=True, postgresql_where=text("group_ordinal IS NOT NULL")
+        ),
+    )
     
+class AutoscaleDecision(Base):
+    __tablename__ = 'autoscale_decisions'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    grid_uid = Column(String, ForeignKey('grids.uid', ondelete='CASCADE'), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    action = Column(String, nullable=False)  # scale_up, scale_down or hold
+    current_workers = Column(Integer, nullable=False)
+    desired_workers = Column(Integer, nullable=False)
+    changed_workers = Column(Integer, default=0)  # Workers actually added or removed
+    reason = Column(String)
+    metrics = Column(JSON)  # Backlog, throughput and durations the decision was based on
+
+class WarmPool(Base):
+    __tablename__ = 'warm_pools'
+
+    key = Column(String, primary_key=True)  # docker_image|cpu_total|memory_total, see lib/warmpool.py
+    docker_image = Column(String, nullable=False)
+    cpu_total = Column(Float, nullable=False)
+    memory_total = Column(Integer, nullable=False)  # Memory in MB
+    size = Column(Integer, nullable=False)  # Idle workers to keep ready
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DeploymentJob(Base):
+    __tablename__ = 'deployment_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    action = Column(String, nullable=False)  # deploy, delete, group, scale or label
+    worker_uid = Column(String, nullable=False, index=True)  # No foreign key, deletes outlive the worker row
+    grid_uid = Column(String)
+    namespace = Column(String, nullable=False)
+    payload = Column(JSON)  # Worker fields the deployer needs
+    status = Column(String, nullable=False, default="pending")  # pending, running, done, failed or cancelled
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    next_attempt_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_deployment_jobs_due", "next_attempt_at", postgresql_where=text("status = 'pending'")),
+    )
+
 # Database initialization function
 async def init_db():
     print("Starting database initialization...")
@@ -206,7 +307,7 @@ async def ensure_enum_types():
             "gridstatus": ["active", "inactive", "creating", "paused", "terminated", "error"],
             "functionstatus": ["ready", "pending", "running", "completed", "failed", "cancelled"],
             "taskstatus": ["pending", "running", "completed", "failed", "cancelled"],
-            "workerstatus": ["online", "offline", "busy", "error"]
+            "workerstatus": ["online", "offline", "busy", "error", "suspect"]
         }
         
         # Check and create each enum type
@@ -68,12 +68,226 @@ async def add_grid_columns():
         else:
             print("busy_workers column already exists.")
         
+        await add_column_if_missing(conn, "grids", "autoscale", "JSON")
+        await add_column_if_missing(conn, "grids", "worker_group", "JSON")
+        
         await conn.close()
         return True
     except Exception as e:
         print(f"Error adding columns to grids table: {e}")
         return False
 
+async def add_column_if_missing(conn, table, column, definition):
+    """Add a column to a table if it doesn't exist yet"""
+    exists = await conn.fetchval("""
+        SELECT EXISTS (
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_name = $1
+            AND column_name = $2
+        )
+    """, table, column)
+
+    if not exists:
+        print(f"Adding {column} column to {table} table...")
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        print(f"{column} column added successfully!")
+    else:
+        print(f"{column} column already exists.")
+
+async def add_function_columns():
+    """Add gang_size, priority and limit columns to functions table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await add_column_if_missing(conn, "functions", "gang_size", "INTEGER")
+        await add_column_if_missing(conn, "functions", "priority", "INTEGER NOT NULL DEFAULT 0")
+        await add_column_if_missing(conn, "functions", "max_concurrency", "INTEGER")
+        await add_column_if_missing(conn, "functions", "rate_limit", "DOUBLE PRECISION")
+        await add_column_if_missing(conn, "functions", "rate_burst", "INTEGER")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error adding columns to functions table: {e}")
+        return False
+
+async def add_gangs_table():
+    """Create the gangs table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS gangs (
+                uid VARCHAR PRIMARY KEY,
+                function_uid VARCHAR NOT NULL REFERENCES functions(uid),
+                size INTEGER NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                reserve_deadline TIMESTAMP,
+                backoff_until TIMESTAMP,
+                released_at TIMESTAMP,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS ix_gangs_function_uid ON gangs (function_uid)")
+        print("gangs table is up to date.")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error creating gangs table: {e}")
+        return False
+
+async def add_task_columns():
+    """Add lease_expires_at, slot, image, gang and priority columns to tasks table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await add_column_if_missing(conn, "tasks", "lease_expires_at", "TIMESTAMP")
+        await add_column_if_missing(conn, "tasks", "slot_x", "INTEGER")
+        await add_column_if_missing(conn, "tasks", "slot_y", "INTEGER")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_tasks_pending_slot ON tasks (slot_x, slot_y)
+            WHERE status = 'pending'
+        """)
+        await add_column_if_missing(conn, "tasks", "docker_image", "VARCHAR")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_tasks_pending_image ON tasks (docker_image, created_at)
+            WHERE status = 'pending'
+        """)
+        # Pending tasks of functions with an image only run on workers of that image from now on
+        await conn.execute("""
+            UPDATE tasks AS t SET docker_image = f.docker_image
+            FROM functions f
+            WHERE f.uid = t.function_uid
+            AND t.status = 'pending' AND t.docker_image IS NULL
+            AND f.docker_image IS NOT NULL AND f.docker_image NOT IN ('', 'default')
+        """)
+        await add_column_if_missing(conn, "tasks", "gang_uid", "VARCHAR REFERENCES gangs(uid)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS ix_tasks_gang_uid ON tasks (gang_uid) WHERE gang_uid IS NOT NULL")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_tasks_gang_worker ON tasks (worker_uid)
+            WHERE gang_uid IS NOT NULL AND lease_expires_at IS NOT NULL
+        """)
+        await add_column_if_missing(conn, "tasks", "priority", "INTEGER NOT NULL DEFAULT 0")
+        await add_column_if_missing(conn, "tasks", "preempt_requested_at", "TIMESTAMP")
+        await add_column_if_missing(conn, "tasks", "preemptions", "INTEGER NOT NULL DEFAULT 0")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_tasks_pending_priority ON tasks (priority, created_at)
+            WHERE status = 'pending'
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_tasks_running_priority ON tasks (priority, started_at)
+            WHERE status = 'running'
+        """)
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error adding columns to tasks table: {e}")
+        return False
+
+async def add_worker_columns():
+    """Add telemetry, grid slot, observed state, warm pool, worker group and occupancy columns to workers table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await add_column_if_missing(conn, "workers", "telemetry", "JSON")
+        await add_column_if_missing(conn, "workers", "grid_x", "INTEGER")
+        await add_column_if_missing(conn, "workers", "grid_y", "INTEGER")
+        await add_column_if_missing(conn, "workers", "observed_state", "VARCHAR")
+        await add_column_if_missing(conn, "workers", "observed_at", "TIMESTAMP")
+        await add_column_if_missing(conn, "workers", "pool_key", "VARCHAR")
+        await conn.execute("CREATE INDEX IF NOT EXISTS ix_workers_pool_key ON workers (pool_key) WHERE pool_key IS NOT NULL")
+        await add_column_if_missing(conn, "workers", "group_ordinal", "INTEGER")
+        await add_column_if_missing(conn, "workers", "running_tasks", "INTEGER NOT NULL DEFAULT 0")
+        await add_column_if_missing(conn, "workers", "cpu_reserved", "DOUBLE PRECISION NOT NULL DEFAULT 0")
+        await add_column_if_missing(conn, "workers", "memory_reserved", "INTEGER NOT NULL DEFAULT 0")
+        await conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_workers_group_ordinal ON workers (grid_uid, group_ordinal) "
+            "WHERE group_ordinal IS NOT NULL"
+        )
+        # Idle warm pool workers belong to no grid
+        await conn.execute("ALTER TABLE workers ALTER COLUMN grid_uid DROP NOT NULL")
+        await conn.execute("CREATE INDEX IF NOT EXISTS ix_workers_grid_slot ON workers (grid_uid, grid_x, grid_y)")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error adding columns to workers table: {e}")
+        return False
+
+async def add_autoscale_table():
+    """Create the autoscale_decisions table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS autoscale_decisions (
+                id SERIAL PRIMARY KEY,
+                grid_uid VARCHAR NOT NULL REFERENCES grids(uid) ON DELETE CASCADE,
+                created_at TIMESTAMP,
+                action VARCHAR NOT NULL,
+                current_workers INTEGER NOT NULL,
+                desired_workers INTEGER NOT NULL,
+                changed_workers INTEGER DEFAULT 0,
+                reason VARCHAR,
+                metrics JSON
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS ix_autoscale_decisions_grid_uid ON autoscale_decisions (grid_uid)")
+        print("autoscale_decisions table is up to date.")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error creating autoscale_decisions table: {e}")
+        return False
+
+async def add_warm_pools_table():
+    """Create the warm_pools table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS warm_pools (
+                key VARCHAR PRIMARY KEY,
+                docker_image VARCHAR NOT NULL,
+                cpu_total FLOAT NOT NULL,
+                memory_total INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP
+            )
+        """)
+        print("warm_pools table is up to date.")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error creating warm_pools table: {e}")
+        return False
+
+async def add_deployment_jobs_table():
+    """Create the deployment_jobs table"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS deployment_jobs (
+                id SERIAL PRIMARY KEY,
+                action VARCHAR NOT NULL,
+                worker_uid VARCHAR NOT NULL,
+                grid_uid VARCHAR,
+                namespace VARCHAR NOT NULL,
+                payload JSON,
+                status VARCHAR NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                last_error VARCHAR,
+                next_attempt_at TIMESTAMP,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS ix_deployment_jobs_worker_uid ON deployment_jobs (worker_uid)")
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_deployment_jobs_due ON deployment_jobs (next_attempt_at) WHERE status = 'pending'"
+        )
+        print("deployment_jobs table is up to date.")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error creating deployment_jobs table: {e}")
+        return False
+
 async def fix_enum_values():
     """Fix enum values in the database to use lowercase"""
     try:
@@ -131,7 +345,7 @@ async def ensure_enum_types():
             "gridstatus": ["active", "inactive", "creating", "paused", "terminated", "error"],
             "functionstatus": ["ready", "pending", "running", "completed", "failed", "cancelled"],
             "taskstatus": ["pending", "running", "completed", "failed", "cancelled"],
-            "workerstatus": ["online", "offline", "busy", "error"]
+            "workerstatus": ["online", "offline", "busy", "error", "suspect"]
         }
         
         # Check and create each enum type
@@ -162,11 +376,31 @@ async def ensure_enum_types():
         print(f"Error ensuring enum types: {e}")
         return False
 
+async def add_enum_values():
+    """Add enum values introduced after the enum types were created"""
+    try:
+        conn = await asyncpg.connect(db_url)
+        await conn.execute("ALTER TYPE workerstatus ADD VALUE IF NOT EXISTS 'suspect'")
+        print("workerstatus enum values are up to date.")
+        await conn.close()
+        return True
+    except Exception as e:
+        print(f"Error adding enum values: {e}")
+        return False
+
 async def main():
     """Run all migrations"""
     print("Starting database migrations...")
     await ensure_enum_types()  # Make sure enum types exist first
+    await add_enum_values()
     await add_grid_columns()
+    await add_function_columns()
+    await add_gangs_table()
+    await add_task_columns()
+    await add_worker_columns()
+    await add_autoscale_table()
+    await add_deployment_jobs_table()
+    await add_warm_pools_table()
     await fix_enum_values()
     print("Database migrations completed!")
 
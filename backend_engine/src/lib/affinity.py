@@ -0,0 +1,64 @@
+import os
+import json
+import logging
+from sqlalchemy import text
+from db import get_session
+
+logger = logging.getLogger(__name__)
+
+# Workers added to a function's grid when it starts and no worker there runs its image,
+# 0 leaves the tasks waiting for such a worker. Overridden by the provision_workers start param
+IMAGE_PROVISION_WORKERS = int(os.environ.get("IMAGE_PROVISION_WORKERS", "0"))
+
+# Function images that run on any worker
+ANY_IMAGE = ("", "default")
+
+def required_image(docker_image):
+    """Image a function's tasks must run on, None if any worker can run them"""
+    if not docker_image or docker_image in ANY_IMAGE:
+        return None
+    return docker_image
+
+async def provision_image_workers(function, tasks, count=None):
+    """Add workers running a function's image to its grid when none there runs it
+
+    At most one worker per task is added. Returns the number of workers added.
+    """
+    from lib.autoscaler import add_workers
+
+    image = required_image(function.docker_image)
+    count = min(IMAGE_PROVISION_WORKERS if count is None else count, tasks)
+    if not image or count <= 0:
+        return 0
+
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            SELECT g.*, EXISTS (
+                SELECT 1 FROM workers w
+                WHERE w.grid_uid = g.uid
+                AND w.spec->>'docker_image' = :image
+                AND w.status != 'error'
+            ) AS runs_image
+            FROM grids g
+            WHERE g.uid = :grid_uid
+            """),
+            {"grid_uid": function.grid_uid, "image": image}
+        )
+        grid = result.fetchone()
+
+    if not grid or grid.runs_image:
+        return 0
+
+    requirements = function.resource_requirements or {}
+    if isinstance(requirements, str):
+        requirements = json.loads(requirements)
+    settings = {"docker_image": image}
+    if requirements.get("cpu"):
+        settings["cpu_total"] = requirements["cpu"]
+    if requirements.get("memory"):
+        settings["memory_total"] = requirements["memory"]
+
+    added = await add_workers(grid, settings, count)
+    logger.info(f"Added {added} workers running {image} to grid {grid.uid} for function {function.uid}")
+    return added
@@ -0,0 +1,375 @@
+import os
+import math
+import json
+import asyncio
+import logging
+from uuid import uuid4
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from db import get_session
+from lib.utilization import utilization, status_value
+from lib.failure_detector import failure_detector
+from lib.provisioning import ProvisioningProgress, provisioning, new_worker, insert_workers, provision_workers
+from lib.warmpool import bind_warm_workers
+from lib.workergroup import load_group, add_group_workers, remove_group_workers
+
+logger = logging.getLogger(__name__)
+
+AUTOSCALE_INTERVAL = float(os.environ.get("AUTOSCALE_INTERVAL", "30"))
+
+# Throughput and task durations are measured over this window
+AUTOSCALE_WINDOW_SECONDS = int(os.environ.get("AUTOSCALE_WINDOW_SECONDS", "300"))
+
+# Settings of a grid's autoscaler, stored in grids.autoscale
+DEFAULT_AUTOSCALE = {
+    "enabled": False,
+    "min_workers": 0,
+    "max_workers": None,  # Defaults to length * width
+    "target_drain_seconds": 300,  # Time the backlog should be worked off in
+    "scale_up_cooldown": 60,
+    "scale_down_cooldown": 600,
+    "max_step": 50,  # Most workers added or removed at once
+    "cpu_total": 4.0,
+    "memory_total": 8192,
+    "docker_image": "python:3.11-slim"
+}
+
+def get_autoscale_settings(grid):
+    """Autoscaler settings of a grid row, with defaults filled in"""
+    settings = {**DEFAULT_AUTOSCALE, **(grid.autoscale or {})}
+    if settings["max_workers"] is None:
+        settings["max_workers"] = grid.length * grid.width
+    return settings
+
+def desired_workers(settings, metrics):
+    """Worker count needed to keep up with arrivals and drain the backlog in target_drain_seconds
+
+    Returns (desired, reason).
+    """
+    pending, running = metrics["pending"], metrics["running"]
+    slots = max(metrics["slots_per_worker"], 1)
+
+    if pending == 0 and running == 0:
+        desired, reason = settings["min_workers"], "no pending or running tasks"
+    else:
+        # Tasks each worker completes per second, from durations, else from throughput
+        service_rate = None
+        if metrics["avg_duration"]:
+            service_rate = slots / metrics["avg_duration"]
+        elif metrics["throughput"] and metrics["live_workers"]:
+            service_rate = metrics["throughput"] / metrics["live_workers"]
+
+        if service_rate:
+            required_rate = metrics["arrival_rate"] + pending / settings["target_drain_seconds"]
+            desired = math.ceil(required_rate / service_rate)
+            reason = (
+                f"{pending} pending, {metrics['arrival_rate']:.2f} tasks/s arriving, "
+                f"{service_rate:.3f} tasks/s per worker"
+            )
+        else:
+            desired = math.ceil((pending + running) / slots)
+            reason = f"{pending} pending and {running} running tasks, no duration history"
+
+        # Never go below what the running tasks occupy
+        desired = max(desired, math.ceil(running / slots))
+
+    bounded = min(max(desired, settings["min_workers"]), settings["max_workers"])
+    if bounded != desired:
+        reason += f", bounded to [{settings['min_workers']}, {settings['max_workers']}]"
+    return bounded, reason
+
+async def get_autoscale_metrics(grid_uid):
+    """Backlog, throughput and durations of a grid's tasks over AUTOSCALE_WINDOW_SECONDS"""
+    now = datetime.utcnow()
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            SELECT
+                COUNT(*) FILTER (WHERE t.status = 'pending') AS pending,
+                COUNT(*) FILTER (WHERE t.status = 'running') AS running,
+                COUNT(*) FILTER (WHERE t.status = 'completed' AND t.ended_at >= :since) AS completed,
+                COUNT(*) FILTER (WHERE t.created_at >= :since) AS arrived,
+                AVG(EXTRACT(EPOCH FROM (t.ended_at - t.started_at)))
+                    FILTER (WHERE t.status = 'completed' AND t.ended_at >= :since AND t.started_at IS NOT NULL) AS avg_duration
+            FROM tasks t
+            JOIN functions f ON f.uid = t.function_uid
+            WHERE f.grid_uid = :grid_uid
+            AND (t.status IN ('pending', 'running') OR t.ended_at >= :since OR t.created_at >= :since)
+            """),
+            {"grid_uid": grid_uid, "since": now - timedelta(seconds=AUTOSCALE_WINDOW_SECONDS)}
+        )
+        tasks = result.fetchone()
+
+        result = await session.execute(
+            text("""
+            SELECT
+                COUNT(*) AS workers,
+                COUNT(*) FILTER (WHERE status IN ('online', 'busy')) AS live_workers,
+                AVG((telemetry->>'slots_total')::int) FILTER (WHERE status IN ('online', 'busy')) AS slots_per_worker,
+                (SELECT MAX(created_at) FROM autoscale_decisions
+                 WHERE grid_uid = :grid_uid AND action = 'scale_up' AND changed_workers > 0) AS last_scale_up,
+                (SELECT MAX(created_at) FROM autoscale_decisions
+                 WHERE grid_uid = :grid_uid AND action = 'scale_down' AND changed_workers > 0) AS last_scale_down
+            FROM workers
+            WHERE grid_uid = :grid_uid
+            """),
+            {"grid_uid": grid_uid}
+        )
+        workers = result.fetchone()
+
+        return {
+            "pending": tasks.pending,
+            "running": tasks.running,
+            "throughput": round(tasks.completed / AUTOSCALE_WINDOW_SECONDS, 4),
+            "arrival_rate": round(tasks.arrived / AUTOSCALE_WINDOW_SECONDS, 4),
+            "avg_duration": round(float(tasks.avg_duration), 2) if tasks.avg_duration else None,
+            "workers": workers.workers,
+            "live_workers": workers.live_workers,
+            "slots_per_worker": round(float(workers.slots_per_worker or 1), 2),
+            "last_scale_up": workers.last_scale_up,
+            "last_scale_down": workers.last_scale_down
+        }
+
+async def add_workers(grid, settings, count):
+    """Add workers on free slots of a grid, returns the number added
+
+    Ready warm pods are bound first, the rest are created and deployed.
+    """
+    async for session in get_session():
+        result = await session.execute(
+            text("SELECT grid_x, grid_y FROM workers WHERE grid_uid = :grid_uid AND grid_x IS NOT NULL"),
+            {"grid_uid": grid.uid}
+        )
+        used = {(row.grid_x, row.grid_y) for row in result.fetchall()}
+        free = [
+            (i % grid.length, i // grid.length)
+            for i in range(grid.length * grid.width)
+            if (i % grid.length, i // grid.length) not in used
+        ]
+
+        workers = []
+        for i in range(count):
+            if i < len(free):
+                x, y = free[i]
+                workers.append(new_worker(f"{grid.name}-worker-{y * grid.length + x + 1}", grid.uid, settings, (x, y)))
+            else:
+                workers.append(new_worker(f"{grid.name}-worker-{uuid4().hex[:8]}", grid.uid, settings))
+
+    bound = await bind_warm_workers(workers)
+    bound_ids = {id(worker) for worker in bound}
+    workers = [worker for worker in workers if id(worker) not in bound_ids]
+    if not workers:
+        return len(bound)
+
+    async for session in get_session():
+        await insert_workers(workers, session)
+        await session.commit()
+
+    for worker in workers:
+        utilization.worker_added(grid.uid, worker["status"])
+
+    progress = ProvisioningProgress(grid.uid, len(workers))
+    progress.created = len(workers)
+    provisioning[grid.uid] = progress
+    asyncio.create_task(provision_workers(workers, progress))
+    return len(bound) + len(workers)
+
+async def remove_idle_workers(grid_uid, count):
+    """Delete up to count workers without tasks, never-started and unresponsive ones first
+
+    Returns the number removed.
+    """
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            DELETE FROM workers
+            WHERE uid IN (
+                SELECT w.uid FROM workers w
+                WHERE w.grid_uid = :grid_uid
+                AND w.status != 'busy'
+                AND NOT EXISTS (
+                    SELECT 1 FROM tasks t
+                    WHERE t.worker_uid = w.uid AND t.status IN ('pending', 'running')
+                )
+                ORDER BY
+                    CASE w.status WHEN 'offline' THEN 0 WHEN 'error' THEN 0 WHEN 'suspect' THEN 1 ELSE 2 END,
+                    w.last_heartbeat NULLS FIRST
+                LIMIT :count
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING uid, name, status, spec
+            """),
+            {"grid_uid": grid_uid, "count": count}
+        )
+        removed = result.fetchall()
+        await session.commit()
+
+    for worker in removed:
+        utilization.worker_removed(grid_uid, status_value(worker.status))
+        failure_detector.forget(worker.uid)
+
+    if removed:
+        from lib.k8ssdk import deployment_queue
+        try:
+            await deployment_queue.submit(
+                "delete", [{"uid": worker.uid, "name": worker.name, "grid_uid": grid_uid, "spec": worker.spec} for worker in removed]
+            )
+        except Exception as e:
+            logger.error(f"Error queueing the deletion of {len(removed)} workers of grid {grid_uid}: {e}")
+
+    return len(removed)
+
+async def record_decision(grid_uid, action, current, desired, changed, reason, metrics):
+    """Store an autoscaler decision"""
+    async for session in get_session():
+        await session.execute(
+            text("""
+            INSERT INTO autoscale_decisions
+                (grid_uid, created_at, action, current_workers, desired_workers, changed_workers, reason, metrics)
+            VALUES (:grid_uid, :now, :action, :current, :desired, :changed, :reason, CAST(:metrics AS json))
+            """),
+            {
+                "grid_uid": grid_uid,
+                "now": datetime.utcnow(),
+                "action": action,
+                "current": current,
+                "desired": desired,
+                "changed": changed,
+                "reason": reason,
+                "metrics": json.dumps(metrics, default=str)
+            }
+        )
+        await session.commit()
+
+async def autoscale_grid(grid):
+    """Evaluate a grid's autoscaler once and scale it, returns the decision"""
+    settings = get_autoscale_settings(grid)
+    metrics = await get_autoscale_metrics(grid.uid)
+    current = metrics["workers"]
+    desired, reason = desired_workers(settings, metrics)
+
+    now = datetime.utcnow()
+    action, changed = "hold", 0
+    if desired > current:
+        action = "scale_up"
+        last = metrics["last_scale_up"]
+        if last and now - last < timedelta(seconds=settings["scale_up_cooldown"]):
+            reason += f", in scale up cooldown until {(last + timedelta(seconds=settings['scale_up_cooldown'])).isoformat()}"
+        else:
+            count = min(desired - current, settings["max_step"])
+            if load_group(grid.worker_group):
+                changed = await add_group_workers(grid.uid, count)
+            else:
+                changed = await add_workers(grid, settings, count)
+    elif desired < current:
+        action = "scale_down"
+        # Scaling up also holds off scaling down, so new workers get a chance to take the backlog
+        last = max((t for t in (metrics["last_scale_down"], metrics["last_scale_up"]) if t), default=None)
+        if last and now - last < timedelta(seconds=settings["scale_down_cooldown"]):
+            reason += f", in scale down cooldown until {(last + timedelta(seconds=settings['scale_down_cooldown'])).isoformat()}"
+        else:
+            count = min(current - desired, settings["max_step"])
+            if load_group(grid.worker_group):
+                changed = await remove_group_workers(grid.uid, count)
+            else:
+                changed = await remove_idle_workers(grid.uid, count)
+            if changed < count:
+                reason += f", only {changed} idle workers"
+
+    if action != "hold":
+        logger.info(f"Autoscaler {action} grid {grid.uid} from {current} to {desired} workers ({changed} changed): {reason}")
+        await record_decision(grid.uid, action, current, desired, changed, reason, metrics)
+
+    return {"action": action, "current_workers": current, "desired_workers": desired, "changed_workers": changed, "reason": reason}
+
+async def run_autoscaler():
+    """Evaluate the autoscaler of every active grid that has it enabled, every AUTOSCALE_INTERVAL"""
+    while True:
+        await asyncio.sleep(AUTOSCALE_INTERVAL)
+
+        try:
+            async for session in get_session():
+                result = await session.execute(
+                    text("""
+                    SELECT * FROM grids
+                    WHERE status = 'active'
+                    AND autoscale IS NOT NULL
+                    AND (autoscale->>'enabled')::boolean
+                    """)
+                )
+                grids = result.fetchall()
+        except Exception as e:
+            logger.error(f"Error loading autoscaled grids: {e}")
+            continue
+
+        for grid in grids:
+            try:
+                await autoscale_grid(grid)
+            except Exception as e:
+                logger.error(f"Error autoscaling grid {grid.uid}: {e}")
+
+async def get_autoscale(grid_uid, limit=20):
+    """Autoscaler settings and latest decisions of a grid, None if the grid doesn't exist"""
+    async for session in get_session():
+        result = await session.execute(
+            text("SELECT * FROM grids WHERE uid = :uid"),
+            {"uid": grid_uid}
+        )
+        grid = result.fetchone()
+        if not grid:
+            return None
+
+        result = await session.execute(
+            text("""
+            SELECT * FROM autoscale_decisions
+            WHERE grid_uid = :grid_uid
+            ORDER BY created_at DESC
+            LIMIT :limit
+            """),
+            {"grid_uid": grid_uid, "limit": limit}
+        )
+        decisions = [
+            {
+                "created_at": decision.created_at.isoformat() if decision.created_at else None,
+                "action": decision.action,
+                "current_workers": decision.current_workers,
+                "desired_workers": decision.desired_workers,
+                "changed_workers": decision.changed_workers,
+                "reason": decision.reason,
+                "metrics": decision.metrics
+            }
+            for decision in result.fetchall()
+        ]
+
+        return {"grid_uid": grid_uid, "settings": get_autoscale_settings(grid), "decisions": decisions}
+
+async def update_autoscale(grid_uid, data):
+    """Update a grid's autoscaler settings, returns them or None if the grid doesn't exist"""
+    changes = {key: value for key, value in data.items() if key in DEFAULT_AUTOSCALE}
+    try:
+        async for session in get_session():
+            result = await session.execute(
+                text("SELECT autoscale FROM grids WHERE uid = :uid FOR UPDATE"),
+                {"uid": grid_uid}
+            )
+            grid = result.fetchone()
+            if not grid:
+                logger.error(f"Grid {grid_uid} not found")
+                return None
+
+            settings = {**(grid.autoscale or {}), **changes}
+            bounds = (settings.get("min_workers", 0), settings.get("max_workers"))
+            if bounds[0] < 0 or (bounds[1] is not None and bounds[1] < bounds[0]):
+                logger.error(f"Invalid autoscaler bounds for grid {grid_uid}: {bounds}")
+                return None
+            await session.execute(
+                text("UPDATE grids SET autoscale = CAST(:autoscale AS json), updated_at = :now WHERE uid = :uid"),
+                {"autoscale": json.dumps(settings), "now": datetime.utcnow(), "uid": grid_uid}
+            )
+            await session.commit()
+            logger.info(f"Grid {grid_uid} autoscaler settings updated: {changes}")
+
+        return (await get_autoscale(grid_uid, limit=0))["settings"]
+    except Exception as e:
+        logger.error(f"Error updating autoscaler of grid {grid_uid}: {e}")
+        return None
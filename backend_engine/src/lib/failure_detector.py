@@ -0,0 +1,239 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import collections
+from datetime import datetime, timezone
+from sqlalchemy import text
+from db import get_session
+from lib.utilization import utilization, status_value
+from lib.occupancy import report_occupancy
+from lib.gang import requeue_gangs
+from lib.limits import function_limits
+
+logger = logging.getLogger(__name__)
+
+# Phi above which a worker is suspected, and above which it is taken offline
+PHI_SUSPECT_THRESHOLD = float(os.environ.get("PHI_SUSPECT_THRESHOLD", "3"))
+PHI_OFFLINE_THRESHOLD = float(os.environ.get("PHI_OFFLINE_THRESHOLD", "8"))
+
+# Heartbeat interval assumed until a worker has a history of its own
+EXPECTED_HEARTBEAT_INTERVAL = float(os.environ.get("EXPECTED_HEARTBEAT_INTERVAL", "10"))
+
+# Extra delay tolerated on top of the mean interval, so GC or network pauses
+# don't cause false positives
+ACCEPTABLE_HEARTBEAT_PAUSE = float(os.environ.get("ACCEPTABLE_HEARTBEAT_PAUSE", "10"))
+MIN_HEARTBEAT_STD = float(os.environ.get("MIN_HEARTBEAT_STD", "2"))
+HEARTBEAT_HISTORY = int(os.environ.get("HEARTBEAT_HISTORY", "100"))
+FAILURE_DETECTOR_INTERVAL = float(os.environ.get("FAILURE_DETECTOR_INTERVAL", "1"))
+
+def phi(elapsed, mean, std):
+    """Suspicion level of a heartbeat being elapsed seconds late, -log10 of the
+    probability that it still arrives (logistic approximation of the normal CDF)
+    """
+    y = (elapsed - mean) / std
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if elapsed > mean:
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+class FailureDetector:
+    """Phi accrual failure detector over the heartbeat inter-arrival times of each worker"""
+
+    def __init__(self):
+        self.last_seen = {}
+        self.intervals = {}
+        self.suspected = set()
+        self.failed = set()
+
+    def heartbeat(self, uid, now=None):
+        """Record a heartbeat arrival, returns True if the worker was taken offline and is back"""
+        now = now or time.time()
+
+        last_seen = self.last_seen.get(uid)
+        if last_seen is not None and now > last_seen:
+            intervals = self.intervals.setdefault(uid, collections.deque(maxlen=HEARTBEAT_HISTORY))
+            intervals.append(now - last_seen)
+        self.last_seen[uid] = now
+        self.suspected.discard(uid)
+
+        if uid in self.failed:
+            self.failed.discard(uid)
+            return True
+        return False
+
+    def track(self, uid, last_seen):
+        """Start watching a worker last seen at a given time, without a history"""
+        self.last_seen.setdefault(uid, last_seen)
+
+    def forget(self, uid):
+        """Stop watching a worker"""
+        self.last_seen.pop(uid, None)
+        self.intervals.pop(uid, None)
+        self.suspected.discard(uid)
+        self.failed.discard(uid)
+
+    def phi(self, uid, now):
+        """Current suspicion level of a worker"""
+        intervals = self.intervals.get(uid)
+        if intervals and len(intervals) >= 3:
+            mean = sum(intervals) / len(intervals)
+            variance = sum((i - mean) ** 2 for i in intervals) / len(intervals)
+            std = max(math.sqrt(variance), MIN_HEARTBEAT_STD)
+        else:
+            # Too few samples, assume the configured interval with a wide spread
+            mean = EXPECTED_HEARTBEAT_INTERVAL
+            std = max(EXPECTED_HEARTBEAT_INTERVAL / 4, MIN_HEARTBEAT_STD)
+
+        return phi(now - self.last_seen[uid], mean + ACCEPTABLE_HEARTBEAT_PAUSE, std)
+
+    def evaluate(self, now=None):
+        """Workers that newly crossed the suspect and offline thresholds"""
+        now = now or time.time()
+        suspect, offline = [], []
+
+        for uid in list(self.last_seen):
+            level = self.phi(uid, now)
+            if level >= PHI_OFFLINE_THRESHOLD:
+                offline.append(uid)
+            elif level >= PHI_SUSPECT_THRESHOLD and uid not in self.suspected:
+                suspect.append(uid)
+
+        return suspect, offline
+
+failure_detector = FailureDetector()
+
+async def load_live_workers():
+    """Watch the workers the database has as live, e.g. after an engine restart"""
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            SELECT uid, last_heartbeat FROM workers
+            WHERE status IN ('online', 'busy', 'suspect')
+            """)
+        )
+        now = time.time()
+        for worker in result.fetchall():
+            last_seen = now
+            if worker.last_heartbeat:
+                last_seen = min(worker.last_heartbeat.replace(tzinfo=timezone.utc).timestamp(), now)
+            failure_detector.track(worker.uid, last_seen)
+
+async def suspect_workers(uids):
+    """Mark live workers as suspect in one statement"""
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            WITH prev AS (
+                SELECT uid, status FROM workers
+                WHERE uid = ANY(CAST(:uids AS text[]))
+                AND status IN ('online', 'busy')
+                FOR UPDATE
+            )
+            UPDATE workers AS w
+            SET status = 'suspect', updated_at = :now
+            FROM prev
+            WHERE w.uid = prev.uid
+            RETURNING w.uid, w.grid_uid, prev.status
+            """),
+            {"uids": uids, "now": datetime.utcnow()}
+        )
+        rows = result.fetchall()
+        await session.commit()
+
+        for row in rows:
+            utilization.status_changed(row.grid_uid, status_value(row.status), "suspect")
+        if rows:
+            logger.warning(f"Suspecting {len(rows)} workers: {', '.join(row.uid for row in rows)}")
+
+async def fail_workers(uids, reason="unresponsive", statuses=("online", "busy", "suspect")):
+    """Take workers offline and requeue their leased and running tasks, in one transaction
+
+    Only workers in one of statuses are taken offline. The requeued tasks no
+    longer occupy the workers, their running_tasks and reserved resources
+    are reset. Gangs with a rank on the workers are requeued as a whole.
+    Returns the UIDs of the workers taken offline.
+    """
+    async for session in get_session():
+        now = datetime.utcnow()
+        result = await session.execute(
+            text("""
+            WITH prev AS (
+                SELECT uid, status FROM workers
+                WHERE uid = ANY(CAST(:uids AS text[]))
+                AND status = ANY(CAST(:statuses AS workerstatus[]))
+                FOR UPDATE
+            )
+            UPDATE workers AS w
+            SET status = 'offline',
+                running_tasks = 0,
+                cpu_reserved = 0,
+                memory_reserved = 0,
+                updated_at = :now
+            FROM prev
+            WHERE w.uid = prev.uid
+            RETURNING w.uid, w.grid_uid, prev.status
+            """),
+            {"uids": uids, "statuses": list(statuses), "now": now}
+        )
+        rows = result.fetchall()
+        failed = [row.uid for row in rows]
+        occupancy = []
+
+        if failed:
+            # Release the prefetch leases and give running tasks to other workers
+            result = await session.execute(
+                text("""
+                UPDATE tasks
+                SET status = 'pending',
+                    worker_uid = NULL,
+                    lease_expires_at = NULL,
+                    started_at = NULL,
+                    updated_at = :now
+                WHERE worker_uid = ANY(CAST(:uids AS text[]))
+                AND status IN ('pending', 'running')
+                RETURNING function_uid, gang_uid
+                """),
+                {"uids": failed, "now": now}
+            )
+            requeued = result.fetchall()
+            released = collections.Counter(task.function_uid for task in requeued if task.gang_uid is None)
+            logger.warning(f"Took {len(failed)} {reason} workers offline, requeued {len(requeued)} tasks: {', '.join(failed)}")
+
+            _, occupancy = await requeue_gangs(session, [task.gang_uid for task in requeued], now)
+
+        await session.commit()
+
+        for row in rows:
+            utilization.status_changed(row.grid_uid, status_value(row.status), "offline")
+        report_occupancy(occupancy)
+        if failed:
+            # Their concurrency slots are free again, see lib/limits.py
+            for function_uid, count in released.items():
+                function_limits.finished(function_uid, count)
+        return failed
+
+async def run_failure_detector():
+    """Evaluate the workers every FAILURE_DETECTOR_INTERVAL and apply status transitions in bulk"""
+    try:
+        await load_live_workers()
+    except Exception as e:
+        logger.error(f"Error loading live workers for the failure detector: {e}")
+
+    while True:
+        await asyncio.sleep(FAILURE_DETECTOR_INTERVAL)
+
+        suspect, offline = failure_detector.evaluate()
+        try:
+            if suspect:
+                await suspect_workers(suspect)
+                failure_detector.suspected.update(suspect)
+            if offline:
+                failed = await fail_workers(offline)
+                for uid in offline:
+                    failure_detector.forget(uid)
+                # Only workers actually taken offline come back with their next heartbeat
+                failure_detector.failed.update(failed)
+        except Exception as e:
+            logger.error(f"Error applying failure detector transitions: {e}")
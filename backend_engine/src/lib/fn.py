@@ -4,6 +4,12 @@ import asyncio
 import logging
 from sqlalchemy import text
 from uuid import uuid4
+from lib.topology import get_input_tile, place_tiles
+from lib.affinity import required_image, provision_image_workers
+from lib.occupancy import occupancy_ctes, report_occupancy
+from lib.gang import check_gangs, plan_gangs
+from lib.priority import priority_value, priority_name
+from lib.limits import LIMIT_FIELDS, function_limits, limits_of
 import asyncpg
 import os
 import json
@@ -77,6 +83,12 @@ async def get_function_by_uid(uid):
             "resource_requirements": fn.resource_requirements,
             "docker_image": fn.docker_image,
             "status": fn.status if not hasattr(fn.status, 'value') else fn.status.value,
+            "gang_size": fn.gang_size,
+            "priority": fn.priority,
+            "priority_class": priority_name(fn.priority),
+            "max_concurrency": fn.max_concurrency,
+            "rate_limit": fn.rate_limit,
+            "rate_burst": fn.rate_burst,
             "created_at": fn.created_at.isoformat() if fn.created_at else None,
             "updated_at": fn.updated_at.isoformat() if fn.updated_at else None,
             "started_at": fn.started_at.isoformat() if fn.started_at else None,
@@ -100,6 +112,11 @@ async def create_new_function(data):
             status="ready",  # Use lowercase string directly
             batch_size=data.get("batch_size", 1),  # Default to 1 if not specified
             function_params=data.get("function_params", {}),  # Store default parameters
+            gang_size=data.get("gang_size"),  # Tasks start together in gangs of this size
+            priority=priority_value(data.get("priority")),  # Class name or number, higher is claimed first
+            max_concurrency=data.get("max_concurrency"),  # Limits enforced at claim time, see lib/limits.py
+            rate_limit=data.get("rate_limit"),
+            rate_burst=data.get("rate_burst"),
             created_at=datetime.utcnow(),
             updated_at=datetime.utcnow()
         )
@@ -120,6 +137,12 @@ async def create_new_function(data):
                 "status": "ready",  # Use lowercase string directly
                 "batch_size": function.batch_size,
                 "function_params": function.function_params,
+                "gang_size": function.gang_size,
+                "priority": function.priority,
+                "priority_class": priority_name(function.priority),
+                "max_concurrency": function.max_concurrency,
+                "rate_limit": function.rate_limit,
+                "rate_burst": function.rate_burst,
                 "created_at": function.created_at.isoformat()
             }
     except Exception as e:
@@ -161,6 +184,20 @@ async def update_function(uid, data):
                 update_clauses.append("status = :status")
                 params["status"] = data["status"]
             
+            if "gang_size" in data:
+                update_clauses.append("gang_size = :gang_size")
+                params["gang_size"] = data["gang_size"]
+            
+            if "priority" in data:
+                update_clauses.append("priority = :priority")
+                params["priority"] = priority_value(data["priority"])
+            
+            # 0 clears a limit
+            for field in LIMIT_FIELDS:
+                if field in data:
+                    update_clauses.append(f"{field} = :{field}")
+                    params[field] = data[field] or None
+            
             # Always update the updated_at timestamp
             update_clauses.append("updated_at = :updated_at")
             params["updated_at"] = datetime.utcnow()
@@ -181,15 +218,28 @@ async def update_function(uid, data):
                 await session.rollback()
                 raise
             
+            # Limits apply to the next claims, without waiting for the reconciliation
+            function = await get_function_by_uid(uid)
+            if function and any(field in data for field in LIMIT_FIELDS):
+                function_limits.configure(uid, **{field: function[field] for field in LIMIT_FIELDS})
+            
             # Return the updated function
-            return await get_function_by_uid(uid)
+            return function
     except Exception as e:
         logger.error(f"Error updating function {uid}: {e}")
         return None
 
 # Existing functions with improved error handling
+async def provision_for_function(function, tasks, params):
+    """Add workers of a started function's image if its grid has none, see lib/affinity.py"""
+    try:
+        count = params.get("provision_workers") if isinstance(params, dict) else None
+        await provision_image_workers(function, tasks, None if count is None else int(count))
+    except Exception as e:
+        logger.error(f"Error provisioning workers for function {function.uid}: {e}")
+
 async def start_function(function_uid, params=None):
-    """Start a function"""
+    """Start a function, raises ValueError if its tasks don't split into whole gangs"""
     try:
         async for session in get_session():
             # Get the function
@@ -212,25 +262,8 @@ async def start_function(function_uid, params=None):
                 logger.error(f"Function {function_uid} cannot be started in {function.status} state")
                 return False
             
-            # Update function status - use lowercase directly
-            try:
-                await session.execute(
-                    text("""
-                    UPDATE functions 
-                    SET status = 'running', 
-                        started_at = :now,
-                        updated_at = :now
-                    WHERE uid = :uid
-                    """),
-                    {
-                        "uid": function_uid,
-                        "now": datetime.utcnow()
-                    }
-                )
-                await session.commit()
-            except Exception as e:
-                logger.error(f"Error updating function status: {e}")
-                return False
+            # Tasks only run on workers of the function's image
+            image = required_image(function.docker_image)
             
             # Determine batch size
             batch_size = function.batch_size if hasattr(function, 'batch_size') else 1
@@ -242,6 +275,25 @@ async def start_function(function_uid, params=None):
                 except (ValueError, TypeError):
                     logger.warning(f"Invalid batch_size in params: {params['batch_size']}, using default: {batch_size}")
             
+            # Gang scheduled tasks start together on distinct workers, see lib/gang.py
+            gang_size = function.gang_size
+            if params and isinstance(params, dict) and 'gang_size' in params:
+                try:
+                    gang_size = int(params['gang_size'])
+                except (ValueError, TypeError):
+                    logger.warning(f"Invalid gang_size in params: {params['gang_size']}, using default: {gang_size}")
+            
+            # Higher priority tasks are claimed first and preempt lower ones, see lib/priority.py
+            priority = function.priority
+            if params and isinstance(params, dict) and 'priority' in params:
+                try:
+                    priority = priority_value(params['priority'])
+                except ValueError as e:
+                    logger.warning(f"Invalid priority in params: {e}, using default: {priority}")
+            
+            # Concurrency and rate limits are enforced when workers claim the tasks, see lib/limits.py
+            function_limits.configure(function_uid, **limits_of(function))
+            
             # Get inputs from params
             inputs = []
             print(params)
@@ -251,35 +303,68 @@ async def start_function(function_uid, params=None):
                     logger.warning(f"Inputs parameter is not a list, using empty list")
                     inputs = []
             
-            # If no inputs provided, create a single task
+            # Refuse starts whose tasks don't split into whole gangs before the function runs
+            if inputs:
+                check_gangs((len(inputs) + batch_size - 1) // batch_size, gang_size)
+            
+            # Update function status - use lowercase directly
+            try:
+                await session.execute(
+                    text("""
+                    UPDATE functions 
+                    SET status = 'running', 
+                        started_at = :now,
+                        updated_at = :now
+                    WHERE uid = :uid
+                    """),
+                    {
+                        "uid": function_uid,
+                        "now": datetime.utcnow()
+                    }
+                )
+                await session.commit()
+            except Exception as e:
+                logger.error(f"Error updating function status: {e}")
+                return False
+            
+            # If no inputs provided, create a single task, or one gang of tasks without inputs
             if not inputs:
                 logger.info(f"No inputs provided, creating a single task for function {function_uid}")
-                task_uid = str(uuid4())
-                
-                # Create task data with inputs
-                task_data = {
-                    "input": inputs,
-                    "function_uid": function_uid
-                }
-                
-                # Create the task
-                task = Task(
-                    uid=str(uuid4()),
-                    function_uid=function_uid,
-                    status="pending",  # Use lowercase string directly
-                    data=task_data,  # Include inputs in task data
-                    created_at=datetime.utcnow(),
-                    updated_at=datetime.utcnow()
-                )
+                count = gang_size if gang_size and gang_size > 1 else 1
+                gangs, ranks = plan_gangs(function_uid, count, gang_size)
                 
                 try:
-                    session.add(task)
+                    session.add_all(gangs)
+                    await session.flush()
+                    for rank in ranks:
+                        # Create task data with inputs
+                        task_data = {
+                            "input": inputs,
+                            "function_uid": function_uid
+                        }
+                        if rank:
+                            task_data.update(rank)
+                        
+                        # Create the task
+                        task = Task(
+                            uid=str(uuid4()),
+                            function_uid=function_uid,
+                            status="pending",  # Use lowercase string directly
+                            data=task_data,  # Include inputs in task data
+                            docker_image=image,
+                            gang_uid=rank["gang_uid"] if rank else None,
+                            priority=priority,
+                            created_at=datetime.utcnow(),
+                            updated_at=datetime.utcnow()
+                        )
+                        session.add(task)
                     await session.commit()
                 except Exception as e:
                     logger.error(f"Error creating task: {e}")
                     return False
                 
-                logger.info(f"Created single task {task_uid} for function {function_uid}")
+                logger.info(f"Created {count} tasks without inputs for function {function_uid}")
+                await provision_for_function(function, count, params)
                 return True
             
             # Calculate number of batches
@@ -288,6 +373,20 @@ async def start_function(function_uid, params=None):
             
             logger.info(f"Starting function {function_uid} with {total_inputs} inputs, batch size {batch_size}, creating {num_batches} tasks")
             
+            # Inputs tagged with "tile": [x, y] are placed on the grid slot of their
+            # tile, a batch takes the tile of its first input
+            tiles = [get_input_tile(inputs[i * batch_size]) for i in range(num_batches)]
+            slots = await place_tiles(function.grid_uid, tiles)
+            
+            # Consecutive batches form the ranks of each gang
+            try:
+                gangs, ranks = plan_gangs(function_uid, num_batches, gang_size)
+                session.add_all(gangs)
+                await session.flush()
+            except Exception as e:
+                logger.error(f"Error creating gangs of function {function_uid}: {e}")
+                return False
+            
             # Create tasks for this function
             task_uids = []
             for i in range(num_batches):
@@ -310,6 +409,10 @@ async def start_function(function_uid, params=None):
                     'input_end': end_idx,
                     'inputs': batch_inputs
                 }
+                if tiles[i]:
+                    task_data['tile'] = list(tiles[i])
+                if ranks[i]:
+                    task_data.update(ranks[i])
                 
                 # Create the task
                 task = Task(
@@ -317,6 +420,11 @@ async def start_function(function_uid, params=None):
                     function_uid=function_uid,
                     status="pending",  # Use lowercase string directly
                     data=task_data,  # Include inputs in task data
+                    docker_image=image,
+                    slot_x=slots[i][0] if slots[i] else None,
+                    slot_y=slots[i][1] if slots[i] else None,
+                    gang_uid=ranks[i]["gang_uid"] if ranks[i] else None,
+                    priority=priority,
                     created_at=datetime.utcnow(),
                     updated_at=datetime.utcnow()
                 )
@@ -338,8 +446,11 @@ async def start_function(function_uid, params=None):
             # Assign tasks to workers (this would be handled by a scheduler)
             # For now, just log that tasks were created
             logger.info(f"Function {function_uid} started successfully with {num_batches} tasks")
+            await provision_for_function(function, num_batches, params)
             
             return True
+    except ValueError:
+        raise
     except Exception as e:
         logger.error(f"Error starting function {function_uid}: {e}")
         # Print the line number where the error occurred
@@ -382,23 +493,39 @@ async def cancel_function(function_uid):
                 }
             )
             
-            # Cancel any running tasks - use lowercase values
-            await session.execute(
-                text("""
-                UPDATE tasks 
-                SET status = 'cancelled', 
-                    ended_at = :now,
-                    updated_at = :now
-                WHERE function_uid = :function_uid 
-                AND status IN ('pending', 'running')
+            # Cancel any running tasks - use lowercase values, their workers are freed
+            result = await session.execute(
+                text(f"""
+                WITH prev AS (
+                    SELECT uid, status FROM tasks
+                    WHERE function_uid = :function_uid 
+                    AND status IN ('pending', 'running')
+                    FOR UPDATE
+                ),
+                cancelled AS (
+                    UPDATE tasks AS t
+                    SET status = 'cancelled', 
+                        ended_at = :now,
+                        updated_at = :now
+                    FROM prev
+                    WHERE t.uid = prev.uid
+                    RETURNING t.worker_uid, t.function_uid, prev.status AS old_status
+                ),
+                stopped AS (
+                    SELECT worker_uid, function_uid, -1 AS delta FROM cancelled WHERE old_status = 'running'
+                ),{occupancy_ctes("stopped")}
+                SELECT grid_uid, old_status, new_status FROM occupancy
                 """),
                 {
                     "function_uid": function_uid,
                     "now": datetime.utcnow()
                 }
             )
+            occupancy = result.fetchall()
             
             await session.commit()
+            report_occupancy(occupancy)
+            function_limits.cancelled(function_uid)
             
             return True
     except Exception as e:
@@ -444,10 +571,24 @@ async def delete_function(uid):
                 logger.error(f"Cannot delete function {uid} because it is currently running")
                 return False
             
-            # Delete associated tasks first
+            # Delete associated tasks first, freeing the workers still running them
+            result = await session.execute(
+                text(f"""
+                WITH deleted AS (
+                    DELETE FROM tasks WHERE function_uid = :function_uid
+                    RETURNING worker_uid, function_uid, status
+                ),
+                stopped AS (
+                    SELECT worker_uid, function_uid, -1 AS delta FROM deleted WHERE status = 'running'
+                ),{occupancy_ctes("stopped")}
+                SELECT grid_uid, old_status, new_status FROM occupancy
+                """),
+                {"function_uid": uid, "now": datetime.utcnow()}
+            )
+            occupancy = result.fetchall()
             await session.execute(
-                text("DELETE FROM tasks WHERE function_uid = :function_uid"),
-                {"function_uid": uid}
+                text("DELETE FROM gangs WHERE function_uid = :uid"),
+                {"uid": uid}
             )
             
             # Delete the function
@@ -456,6 +597,7 @@ async def delete_function(uid):
                 {"uid": uid}
             )
             await session.commit()
+            report_occupancy(occupancy)
             
             logger.info(f"Function {uid} deleted successfully")
             return True
@@ -0,0 +1,350 @@
+import os
+import json
+import asyncio
+import logging
+from uuid import uuid4
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from db import Gang, get_session
+from lib.occupancy import occupancy_ctes, report_occupancy
+
+logger = logging.getLogger(__name__)
+
+# Seconds a gang has to reserve all its ranks once the first one is reserved,
+# after that the partial reservation is given up and the workers go back to other work
+GANG_RESERVATION_SECONDS = int(os.environ.get("GANG_RESERVATION_SECONDS", "60"))
+
+# A gang that timed out waits GANG_BACKOFF_SECONDS before reserving again,
+# doubling with every timeout up to GANG_BACKOFF_MAX_SECONDS
+GANG_BACKOFF_SECONDS = float(os.environ.get("GANG_BACKOFF_SECONDS", "30"))
+GANG_BACKOFF_MAX_SECONDS = float(os.environ.get("GANG_BACKOFF_MAX_SECONDS", "600"))
+
+# Seconds between the sweeps giving up reservations past their deadline
+GANG_EXPIRY_INTERVAL = float(os.environ.get("GANG_EXPIRY_INTERVAL", "5"))
+
+def check_gangs(tasks, gang_size):
+    """Raise ValueError if a start's tasks don't split into whole gangs of gang_size"""
+    if gang_size and gang_size > 1 and tasks % gang_size:
+        raise ValueError(f"{tasks} tasks don't split into gangs of {gang_size}")
+
+def plan_gangs(function_uid, tasks, gang_size):
+    """Group a start's tasks into gangs of gang_size consecutive ranks
+
+    Returns the gang rows and each task's gang fields, ([], None per task)
+    for functions that are not gang scheduled. Raises ValueError if the
+    tasks don't split into whole gangs.
+    """
+    check_gangs(tasks, gang_size)
+    if not gang_size or gang_size <= 1:
+        return [], [None] * tasks
+
+    now = datetime.utcnow()
+    gangs = [
+        Gang(uid=str(uuid4()), function_uid=function_uid, size=gang_size, attempts=0, created_at=now, updated_at=now)
+        for _ in range(tasks // gang_size)
+    ]
+    ranks = [
+        {"gang_uid": gangs[i // gang_size].uid, "gang_rank": i % gang_size, "gang_size": gang_size}
+        for i in range(tasks)
+    ]
+    return gangs, ranks
+
+async def expire_reservations(session, now):
+    """Give up the partial reservations past their deadline and back their gangs off"""
+    result = await session.execute(
+        text("""
+        WITH expired AS (
+            UPDATE gangs
+            SET reserve_deadline = NULL,
+                attempts = attempts + 1,
+                backoff_until = :now + make_interval(secs => LEAST(:backoff * power(2, attempts), :backoff_max)),
+                updated_at = :now
+            WHERE reserve_deadline <= :now
+            RETURNING uid, attempts, backoff_until
+        ),
+        unreserved AS (
+            UPDATE tasks
+            SET worker_uid = NULL, lease_expires_at = NULL, updated_at = :now
+            WHERE gang_uid IN (SELECT uid FROM expired)
+            AND status = 'pending'
+            RETURNING gang_uid
+        )
+        SELECT e.uid, e.attempts, e.backoff_until,
+            (SELECT COUNT(*) FROM unreserved u WHERE u.gang_uid = e.uid) AS unreserved
+        FROM expired e
+        """),
+        {"now": now, "backoff": GANG_BACKOFF_SECONDS, "backoff_max": GANG_BACKOFF_MAX_SECONDS}
+    )
+    for gang in result.fetchall():
+        logger.warning(
+            f"Gang {gang.uid} timed out with {gang.unreserved} ranks reserved, "
+            f"backing off until {gang.backoff_until} (attempt {gang.attempts})"
+        )
+
+async def requeue_gangs(session, gang_uids, now):
+    """Requeue every rank of gangs one of whose ranks was requeued, e.g. by a failed worker
+
+    A gang only runs with all its ranks at once, so its ranks still running
+    on other workers are stopped in the database too (their results are
+    rejected) and the whole gang reserves its ranks again. Returns the
+    number of ranks requeued and the occupancy rows to report.
+    """
+    gang_uids = [uid for uid in set(gang_uids) if uid]
+    if not gang_uids:
+        return 0, []
+
+    result = await session.execute(
+        text(f"""
+        WITH gang AS (
+            UPDATE gangs
+            SET released_at = NULL, reserve_deadline = NULL, updated_at = :now
+            WHERE uid = ANY(CAST(:gang_uids AS text[]))
+            RETURNING uid
+        ),
+        prev AS (
+            SELECT t.uid, t.status, t.worker_uid FROM tasks t
+            WHERE t.gang_uid IN (SELECT uid FROM gang)
+            AND (t.status = 'running' OR (t.status = 'pending' AND t.worker_uid IS NOT NULL))
+            FOR UPDATE OF t
+        ),
+        requeued AS (
+            UPDATE tasks
+            SET status = 'pending', worker_uid = NULL, lease_expires_at = NULL, started_at = NULL, updated_at = :now
+            FROM prev
+            WHERE tasks.uid = prev.uid
+            RETURNING prev.worker_uid, tasks.function_uid, prev.status
+        ),
+        stopped AS (
+            SELECT worker_uid, function_uid, -1 AS delta FROM requeued WHERE status = 'running'
+        ),{occupancy_ctes("stopped")}
+        SELECT (SELECT COUNT(*) FROM requeued) AS requeued, o.grid_uid, o.old_status, o.new_status
+        FROM (SELECT 1) AS one
+        LEFT JOIN occupancy o ON TRUE
+        """),
+        {"gang_uids": gang_uids, "now": now}
+    )
+    rows = result.fetchall()
+    requeued = rows[0].requeued if rows else 0
+    logger.warning(f"Requeued {len(gang_uids)} gangs with {requeued} more ranks: {', '.join(gang_uids)}")
+    return requeued, [row for row in rows if row.grid_uid is not None]
+
+async def held_gangs(session, worker_uid, now):
+    """Gangs a worker holds a live rank reservation of"""
+    result = await session.execute(
+        text("""
+        SELECT DISTINCT gang_uid FROM tasks
+        WHERE worker_uid = :worker_uid
+        AND gang_uid IS NOT NULL
+        AND status = 'pending'
+        AND lease_expires_at > :now
+        """),
+        {"worker_uid": worker_uid, "now": now}
+    )
+    return [row.gang_uid for row in result.fetchall()]
+
+async def reserve_rank(session, worker_uid, now):
+    """Reserve one rank of the oldest highest priority gang the worker can run and holds no rank of
+
+    The rank is leased to the worker until the gang's reservation deadline,
+    set by its first reserved rank. Gangs are locked before their tasks, and
+    gangs another worker is reserving are skipped. Returns the gang's uid.
+    """
+    result = await session.execute(
+        text("""
+        WITH me AS (
+            SELECT pool_key, spec->>'docker_image' AS docker_image FROM workers WHERE uid = :worker_uid
+        ),
+        gang AS (
+            SELECT g.uid FROM gangs g
+            JOIN functions f ON f.uid = g.function_uid
+            WHERE g.uid IN (
+                SELECT t.gang_uid FROM tasks t, me
+                WHERE t.status = 'pending'
+                AND t.gang_uid IS NOT NULL
+                AND me.pool_key IS NULL
+                AND (t.docker_image IS NULL OR t.docker_image = me.docker_image)
+                AND (t.lease_expires_at IS NULL OR t.lease_expires_at <= :now)
+            )
+            AND (g.backoff_until IS NULL OR g.backoff_until <= :now)
+            AND NOT EXISTS (
+                SELECT 1 FROM tasks r
+                WHERE r.gang_uid = g.uid AND r.worker_uid = :worker_uid
+                AND r.status IN ('pending', 'running')
+            )
+            ORDER BY f.priority DESC, g.created_at
+            LIMIT 1
+            FOR UPDATE OF g SKIP LOCKED
+        ),
+        rank AS (
+            SELECT t.uid FROM tasks t, gang
+            WHERE t.gang_uid = gang.uid
+            AND t.status = 'pending'
+            AND (t.lease_expires_at IS NULL OR t.lease_expires_at <= :now)
+            ORDER BY t.created_at
+            LIMIT 1
+            FOR UPDATE OF t SKIP LOCKED
+        ),
+        deadline AS (
+            UPDATE gangs
+            SET reserve_deadline = COALESCE(reserve_deadline, :deadline), updated_at = :now
+            WHERE uid = (SELECT uid FROM gang) AND EXISTS (SELECT 1 FROM rank)
+            RETURNING uid, reserve_deadline
+        )
+        UPDATE tasks
+        SET worker_uid = :worker_uid,
+            lease_expires_at = deadline.reserve_deadline,
+            updated_at = :now
+        FROM rank, deadline
+        WHERE tasks.uid = rank.uid
+        RETURNING tasks.gang_uid
+        """),
+        {
+            "worker_uid": worker_uid,
+            "now": now,
+            "deadline": now + timedelta(seconds=GANG_RESERVATION_SECONDS)
+        }
+    )
+    row = result.fetchone()
+    return row.gang_uid if row else None
+
+async def release_gang(session, gang_uid, now):
+    """Start all ranks of a gang at once if every rank is reserved
+
+    The released ranks keep their lease until their worker picks them up,
+    see deliver_ranks. Returns the number of ranks started and the
+    occupancy rows to report.
+    """
+    result = await session.execute(
+        text(f"""
+        WITH gang AS (
+            SELECT uid FROM gangs WHERE uid = :gang_uid FOR UPDATE
+        ),
+        ranks AS (
+            SELECT t.uid, t.status, t.worker_uid, t.lease_expires_at
+            FROM tasks t JOIN gang ON t.gang_uid = gang.uid
+            WHERE t.status IN ('pending', 'running')
+            FOR UPDATE OF t
+        ),
+        ready AS (
+            SELECT EXISTS (SELECT 1 FROM ranks WHERE status = 'pending')
+                AND NOT EXISTS (
+                    SELECT 1 FROM ranks
+                    WHERE status = 'pending'
+                    AND (worker_uid IS NULL OR lease_expires_at IS NULL OR lease_expires_at <= :now)
+                ) AS ok
+        ),
+        released AS (
+            UPDATE tasks
+            SET status = 'running', started_at = :now, updated_at = :now
+            FROM ranks, ready
+            WHERE ready.ok AND tasks.uid = ranks.uid AND ranks.status = 'pending'
+            RETURNING tasks.worker_uid, tasks.function_uid, 1 AS delta
+        ),
+        gang_released AS (
+            UPDATE gangs
+            SET released_at = :now, reserve_deadline = NULL, backoff_until = NULL, attempts = 0, updated_at = :now
+            WHERE uid = :gang_uid AND EXISTS (SELECT 1 FROM released)
+            RETURNING uid
+        ),{occupancy_ctes("released")}
+        SELECT (SELECT COUNT(*) FROM released) AS released, o.grid_uid, o.old_status, o.new_status
+        FROM (SELECT 1) AS one
+        LEFT JOIN occupancy o ON TRUE
+        """),
+        {"gang_uid": gang_uid, "now": now}
+    )
+    rows = result.fetchall()
+    released = rows[0].released if rows else 0
+    if released:
+        logger.info(f"Released {released} ranks of gang {gang_uid}")
+    return released, [row for row in rows if row.grid_uid is not None]
+
+async def deliver_ranks(session, worker_uid, now):
+    """Hand a worker the released ranks it hasn't picked up yet"""
+    result = await session.execute(
+        text("""
+        UPDATE tasks
+        SET lease_expires_at = NULL, updated_at = :now
+        WHERE worker_uid = :worker_uid
+        AND gang_uid IS NOT NULL
+        AND status = 'running'
+        AND lease_expires_at IS NOT NULL
+        RETURNING uid, function_uid, data
+        """),
+        {"worker_uid": worker_uid, "now": now}
+    )
+    return result.fetchall()
+
+async def gang_work(session, worker_uid):
+    """Whether any gang has pending ranks or a rank released to the worker waits for pickup"""
+    result = await session.execute(
+        text("""
+        SELECT EXISTS (
+            SELECT 1 FROM tasks
+            WHERE gang_uid IS NOT NULL
+            AND (status = 'pending'
+                 OR (status = 'running' AND worker_uid = :worker_uid AND lease_expires_at IS NOT NULL))
+        ) AS pending
+        """),
+        {"worker_uid": worker_uid}
+    )
+    return result.scalar()
+
+async def claim_gang_tasks(worker_uid, count):
+    """Gang ranks released to a worker, reserving a rank for it if it has idle slots
+
+    A worker reserves at most one rank at a time and waits with that slot
+    idle until the gang is released or its reservation times out, its other
+    slots keep running other tasks. Returns the worker's started ranks and
+    the number of its slots held by reservations. Without any gang work the
+    claim only costs one read.
+    """
+    from lib.task import get_task_inputs
+
+    now = datetime.utcnow()
+    occupancy = []
+    async for session in get_session():
+        if not await gang_work(session, worker_uid):
+            return [], 0
+
+        delivered = await deliver_ranks(session, worker_uid, now)
+        held = await held_gangs(session, worker_uid, now)
+        if not held and count > len(delivered):
+            gang_uid = await reserve_rank(session, worker_uid, now)
+            if gang_uid:
+                held = [gang_uid]
+
+        released_any = False
+        for gang_uid in list(held):
+            released, rows = await release_gang(session, gang_uid, now)
+            occupancy.extend(rows)
+            if released:
+                held.remove(gang_uid)
+                released_any = True
+        if released_any:
+            delivered += await deliver_ranks(session, worker_uid, now)
+
+        await session.commit()
+
+    report_occupancy(occupancy)
+
+    tasks = []
+    for row in delivered:
+        data = json.loads(row.data) if isinstance(row.data, str) else (row.data or {})
+        tasks.append({
+            "task_uid": row.uid,
+            "function_uid": row.function_uid,
+            "inputs": get_task_inputs(data),
+            "gang": {"uid": data.get("gang_uid"), "rank": data.get("gang_rank"), "size": data.get("gang_size")}
+        })
+    return tasks, len(held)
+
+async def run_gang_expiry():
+    """Give up the gang reservations past their deadline every GANG_EXPIRY_INTERVAL"""
+    while True:
+        await asyncio.sleep(GANG_EXPIRY_INTERVAL)
+        try:
+            async for session in get_session():
+                await expire_reservations(session, datetime.utcnow())
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Error expiring gang reservations: {e}")
@@ -1,12 +1,22 @@
-from db import Grid, GridStatus, Worker, WorkerStatus, get_session
-from datetime import datetime
+from db import Grid, GridStatus, WorkerStatus, get_session
+from datetime import datetime, timedelta
+import json
 import asyncio
 import logging
 import uuid
 from sqlalchemy import text
+import os
+from lib.utilization import utilization
+from lib.failure_detector import failure_detector
+from lib.topology import grid_slot, locality
+from lib.provisioning import ProvisioningProgress, provisioning, new_worker, insert_workers, provision_workers
+from lib.workergroup import GROUP_MODE, group_payload, load_group, new_group, provision_group
 
 logger = logging.getLogger(__name__)
 
+# Workers whose last heartbeat is older than this don't count towards live capacity
+TELEMETRY_STALE_SECONDS = int(os.environ.get("TELEMETRY_STALE_SECONDS", "60"))
+
 # Database access functions
 async def get_all_grids():
     """Get all grids from the database"""
@@ -97,72 +107,110 @@ async def create_new_grid(data):
         logger.error(f"Error creating grid: {e}")
         return None
 
-async def initialize_grid(grid_uid):
-    """Initialize a grid by creating worker nodes"""
+async def initialize_grid(grid_uid, data=None):
+    """Create a worker for each cell of a grid in one bulk insert and deploy them in the background
+
+    With mode "group" the workers are the replicas of one StatefulSet (see
+    lib/workergroup.py) rather than one StatefulSet each. Returns the
+    provisioning progress, or None if the grid can't be initialized.
+    """
+    data = data or {}
+    group = None
+    progress = None
     try:
         async for session in get_session():
-            # Get the grid
+            # Lock the grid so concurrent initializations don't both create workers
             result = await session.execute(
-                text("SELECT * FROM grids WHERE uid = :uid"),
+                text("""
+                SELECT g.*, (SELECT COUNT(*) FROM workers w WHERE w.grid_uid = g.uid) AS existing_workers
+                FROM grids g
+                WHERE g.uid = :uid
+                FOR UPDATE
+                """),
                 {"uid": grid_uid}
             )
             grid = result.fetchone()
             
             if not grid:
                 logger.error(f"Grid {grid_uid} not found")
-                return False
+                return None
             
             # Check if grid can be initialized
-            if grid.status != "creating":  # Use lowercase string
+            if grid.status in ("terminated", "creating"):
                 logger.error(f"Grid {grid_uid} cannot be initialized from {grid.status} state")
-                return False
+                return None
+            
+            if grid.existing_workers:
+                logger.error(f"Grid {grid_uid} already has {grid.existing_workers} workers")
+                return None
             
             # Calculate total number of workers
             total_workers = grid.length * grid.width
-            
-            # Create worker nodes
-            for i in range(total_workers):
-                worker = Worker(
-                    uid=str(uuid.uuid4()),
-                    name=f"{grid.name}-worker-{i+1}",
-                    grid_uid=grid_uid,
-                    cpu_total=4.0,  # Default values
-                    cpu_available=4.0,
-                    memory_total=8192,  # 8GB in MB
-                    memory_available=8192,
-                    status="offline",  # Use lowercase string
-                    created_at=datetime.utcnow(),
-                    updated_at=datetime.utcnow(),
-                    spec={"node_type": "standard"}
+            progress = ProvisioningProgress(grid_uid, total_workers)
+            provisioning[grid_uid] = progress
+            
+            # Each worker gets the (x, y) slot of its cell for topology aware placement,
+            # group replicas are identified by the pod ordinal of the same index
+            if data.get("mode") == GROUP_MODE:
+                group = new_group(data, total_workers)
+            workers = [
+                new_worker(
+                    f"{grid.name}-worker-{i+1}", grid_uid, data, grid_slot(i, grid.length),
+                    group_ordinal=i if group else None
                 )
-                session.add(worker)
-            
-            # Update grid status
-            grid.status = "active"  # Use lowercase string
-            grid.updated_at = datetime.utcnow()
+                for i in range(total_workers)
+            ]
+            await insert_workers(workers, session)
             
+            await session.execute(
+                text("""
+                UPDATE grids
+                SET status = 'creating', free_slots = :total, worker_group = CAST(:group AS json), updated_at = :now
+                WHERE uid = :uid
+                """),
+                {"total": total_workers, "group": json.dumps(group) if group else None, "now": datetime.utcnow(), "uid": grid_uid}
+            )
             await session.commit()
-            logger.info(f"Grid {grid_uid} initialized successfully with {total_workers} workers")
-            return True
             
-    except Exception as e:
-        logger.error(f"Error initializing grid {grid_uid}: {e}")
+            progress.created = total_workers
+            utilization.mark_dirty(grid_uid)
+            logger.info(f"Grid {grid_uid} initialized with {total_workers} workers")
         
-        # Update grid status to ERROR
-        try:
-            async for session in get_session():
-                result = await session.execute(
-                    text("SELECT * FROM grids WHERE uid = :uid"),
-                    {"uid": grid_uid}
-                )
-                grid = result.fetchone()
-                if grid:
-                    grid.status = "error"  # Use lowercase string
-                    grid.updated_at = datetime.utcnow()
-                    await session.commit()
-        except Exception as inner_e:
-            logger.error(f"Error updating grid status: {inner_e}")
+        asyncio.create_task(provision_grid(grid_uid, workers, progress, data.get("auto_deploy", True), group))
+        return progress.to_dict()
             
+    except Exception as e:
+        logger.error(f"Error initializing grid {grid_uid}: {e}")
+        if progress:
+            progress.finish("failed")
+        await set_grid_status(grid_uid, "error")
+        return None
+
+async def provision_grid(grid_uid, workers, progress, deploy=True, group=None):
+    """Deploy the workers or the worker group of a grid, then activate it"""
+    try:
+        if group:
+            await provision_group(grid_uid, group, progress, deploy)
+        else:
+            await provision_workers(workers, progress, deploy)
+    except Exception as e:
+        logger.error(f"Error provisioning grid {grid_uid}: {e}")
+        progress.finish("failed")
+    
+    await set_grid_status(grid_uid, "error" if progress.state == "failed" else "active")
+
+async def set_grid_status(grid_uid, status):
+    """Set the status of a grid"""
+    try:
+        async for session in get_session():
+            await session.execute(
+                text("UPDATE grids SET status = :status, updated_at = :now WHERE uid = :uid"),
+                {"status": status, "now": datetime.utcnow(), "uid": grid_uid}
+            )
+            await session.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Error updating grid {grid_uid} status: {e}")
         return False
 
 async def activate_grid(grid_uid):
@@ -253,6 +301,7 @@ async def pause_grid(grid_uid):
             )
             
             await session.commit()
+            utilization.mark_dirty(grid_uid)
             logger.info(f"Grid {grid_uid} paused successfully")
             return True
             
@@ -285,12 +334,30 @@ async def terminate_grid(grid_uid):
             grid.updated_at = datetime.utcnow()
             
             # Terminate workers (delete them)
-            await session.execute(
-                text("DELETE FROM workers WHERE grid_uid = :grid_uid"),
+            result = await session.execute(
+                text("DELETE FROM workers WHERE grid_uid = :grid_uid RETURNING uid, name, spec, group_ordinal"),
                 {"grid_uid": grid_uid}
             )
+            removed = result.fetchall()
             
             await session.commit()
+            utilization.mark_dirty(grid_uid)
+            for worker in removed:
+                failure_detector.forget(worker.uid)
+            
+            # Remove their StatefulSets too, rather than leaving them to the reconciler,
+            # the replicas of a worker group go with its StatefulSet
+            deletes = [
+                {"uid": worker.uid, "name": worker.name, "grid_uid": grid_uid, "spec": worker.spec}
+                for worker in removed if worker.group_ordinal is None
+            ]
+            group = load_group(grid.worker_group)
+            if group:
+                deletes.append(group_payload(grid_uid, group))
+            if deletes:
+                from lib.k8ssdk import deployment_queue
+                await deployment_queue.submit("delete", deletes)
+            
             logger.info(f"Grid {grid_uid} terminated successfully")
             return True
             
@@ -299,64 +366,60 @@ async def terminate_grid(grid_uid):
         return False
 
 async def update_grid_utilization(grid_uid):
-    """Update grid utilization statistics"""
-    try:
-        async for session in get_session():
-            # Get worker counts
-            result = await session.execute(
-                text("""
-                SELECT 
-                    COUNT(*) as total_workers,
-                    SUM(CASE WHEN status = :busy_status THEN 1 ELSE 0 END) as busy_workers
+    """Schedule a recount of a grid's workers, written by the utilization aggregator"""
+    utilization.mark_dirty(grid_uid)
+    return True
+
+async def get_grid_capacity(grid_uid):
+    """Roll up the measured capacity of a grid's workers
+
+    Only online or busy workers with a recent heartbeat count as live, their
+    free CPU and memory are the ones measured from their last heartbeat.
+    """
+    async for session in get_session():
+        result = await session.execute(
+            text("SELECT uid FROM grids WHERE uid = :uid"),
+            {"uid": grid_uid}
+        )
+        if not result.fetchone():
+            return None
+
+        result = await session.execute(
+            text("""
+            WITH live AS (
+                SELECT *,
+                    status IN ('online', 'busy') AND last_heartbeat >= :stale_before AS is_live
                 FROM workers
                 WHERE grid_uid = :grid_uid
-                """),
-                {"busy_status": WorkerStatus.BUSY.value, "grid_uid": grid_uid}  # Use .value to get string
-            )
-            worker_stats = result.fetchone()
-            
-            # Get grid
-            result = await session.execute(
-                text("SELECT * FROM grids WHERE uid = :uid"),
-                {"uid": grid_uid}
             )
-            grid = result.fetchone()
-            
-            if not grid:
-                logger.error(f"Grid {grid_uid} not found")
-                return False
-            
-            # Update grid utilization
-            total_workers = worker_stats.total_workers or 0
-            busy_workers = worker_stats.busy_workers or 0
-            
-            # Calculate utilization percentage
-            utilization = 0
-            if total_workers > 0:
-                utilization = (busy_workers / total_workers) * 100
-            
-            # Update grid
-            await session.execute(
-                text("""
-                UPDATE grids 
-                SET worker_count = :worker_count, 
-                    busy_workers = :busy_workers,
-                    utilization = :utilization,
-                    updated_at = :updated_at
-                WHERE uid = :uid
-                """),
-                {
-                    "worker_count": total_workers,
-                    "busy_workers": busy_workers,
-                    "utilization": utilization,
-                    "updated_at": datetime.utcnow(),
-                    "uid": grid_uid
-                }
-            )
-            await session.commit()
-            
-            logger.info(f"Grid {grid_uid} utilization updated: {utilization:.1f}% ({busy_workers}/{total_workers} workers busy)")
-            return True
-    except Exception as e:
-        logger.error(f"Error updating grid utilization {grid_uid}: {e}")
-        return False
+            SELECT
+                COUNT(*) AS worker_count,
+                COUNT(*) FILTER (WHERE is_live) AS live_workers,
+                COALESCE(SUM(cpu_total), 0) AS cpu_total,
+                COALESCE(SUM(cpu_available) FILTER (WHERE is_live), 0) AS cpu_available,
+                COALESCE(SUM(memory_total), 0) AS memory_total,
+                COALESCE(SUM(memory_available) FILTER (WHERE is_live), 0) AS memory_available,
+                COALESCE(SUM((telemetry->>'slots_total')::int) FILTER (WHERE is_live), 0) AS slots_total,
+                COALESCE(SUM((telemetry->>'slots_busy')::int) FILTER (WHERE is_live), 0) AS slots_busy
+            FROM live
+            """),
+            {
+                "grid_uid": grid_uid,
+                "stale_before": datetime.utcnow() - timedelta(seconds=TELEMETRY_STALE_SECONDS)
+            }
+        )
+        capacity = result.fetchone()
+
+        return {
+            "grid_uid": grid_uid,
+            "worker_count": capacity.worker_count,
+            "live_workers": capacity.live_workers,
+            "cpu_total": float(capacity.cpu_total),
+            "cpu_available": float(capacity.cpu_available),
+            "memory_total": int(capacity.memory_total),
+            "memory_available": int(capacity.memory_available),
+            "slots_total": int(capacity.slots_total),
+            "slots_busy": int(capacity.slots_busy),
+            "slots_free": int(capacity.slots_total - capacity.slots_busy),
+            "locality": locality.snapshot(grid_uid)
+        }
@@ -0,0 +1,189 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from sqlalchemy import text
+from db import get_session
+from lib.failure_detector import failure_detector
+from lib.occupancy import report_occupancy
+
+logger = logging.getLogger(__name__)
+
+# Heartbeats and registrations are buffered in memory and written in one
+# statement per flush instead of one UPDATE per request
+HEARTBEAT_FLUSH_SECONDS = float(os.environ.get("HEARTBEAT_FLUSH_SECONDS", "1"))
+HEARTBEAT_FLUSH_BATCH = int(os.environ.get("HEARTBEAT_FLUSH_BATCH", "5000"))
+
+# Per worker values of a buffered heartbeat, in the order of the unnest() columns
+HEARTBEAT_FIELDS = ["seen_at", "cpu_limit", "cpu_used", "memory_limit", "memory_used", "telemetry", "online", "boot"]
+
+class HeartbeatBuffer:
+    """Latest heartbeat of each worker since the last flush
+
+    UIDs a flush found no worker for are remembered as unknown, their
+    heartbeats are refused until they register again.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.unknown = set()
+
+    def record(self, uid, heartbeat=None, online=False, boot=None):
+        """Record a heartbeat, replacing an unflushed one of the same worker
+
+        A registration (online) or boot timing is kept even if a plain
+        heartbeat of the same worker arrives before the flush.
+        """
+        telemetry = (heartbeat or {}).get("telemetry") or {}
+        slots = (heartbeat or {}).get("slots")
+        now = datetime.utcnow()
+
+        previous = self.pending.get(uid)
+        record = {
+            "seen_at": now,
+            "cpu_limit": float(telemetry["cpu_limit"]) if telemetry.get("cpu_limit") else None,
+            "cpu_used": float(telemetry["cpu_used"]) if telemetry.get("cpu_used") is not None else None,
+            "memory_limit": int(telemetry["memory_limit_mb"]) if telemetry.get("memory_limit_mb") else None,
+            "memory_used": int(telemetry["memory_used_mb"]) if telemetry.get("memory_used_mb") is not None else None,
+            "telemetry": None,
+            "online": online or bool(previous and previous["online"]),
+            "boot": json.dumps(boot) if boot else (previous["boot"] if previous else None)
+        }
+        if telemetry or slots is not None:
+            record["telemetry"] = json.dumps({
+                **telemetry,
+                "slots": slots or [],
+                "reported_at": now.isoformat()
+            })
+        elif previous:
+            record["telemetry"] = previous["telemetry"]
+
+        self.pending[uid] = record
+
+    def take(self):
+        """Take the buffered heartbeats for a flush"""
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def restore(self, pending):
+        """Put back heartbeats of a failed flush, merged into newer ones"""
+        for uid, record in pending.items():
+            newer = self.pending.get(uid)
+            if newer is None:
+                self.pending[uid] = record
+            else:
+                newer["online"] = newer["online"] or record["online"]
+                newer["boot"] = newer["boot"] or record["boot"]
+
+heartbeats = HeartbeatBuffer()
+
+def record_heartbeat(uid, heartbeat=None):
+    """Buffer a worker heartbeat with its telemetry, returns False for unknown workers"""
+    if uid in heartbeats.unknown:
+        return False
+    # A worker the failure detector took offline comes back online
+    recovered = failure_detector.heartbeat(uid)
+    heartbeats.record(uid, heartbeat, online=recovered)
+    return True
+
+def record_registration(uid, registration=None):
+    """Buffer a worker registration, it sets the worker online at the next flush"""
+    boot = (registration or {}).get("boot")
+    if boot:
+        logger.info(f"Worker {uid} booted in {boot.get('container_boot_ms', boot.get('agent_boot_ms'))} ms")
+    heartbeats.unknown.discard(uid)
+    failure_detector.heartbeat(uid)
+    heartbeats.record(uid, registration, online=True, boot=boot)
+
+async def flush_heartbeats():
+    """Write all buffered heartbeats, one UPDATE per HEARTBEAT_FLUSH_BATCH workers
+
+    Free CPU and memory are each worker's allocation minus its measured usage.
+    A worker coming back online is busy while it still has running tasks,
+    these status changes are counted in the grid utilization. UIDs without
+    a worker are dropped and no longer watched by the failure detector.
+    Returns the number of workers updated.
+    """
+    pending = heartbeats.take()
+    if not pending:
+        return 0
+
+    uids = list(pending)
+    updated = 0
+    changed = []
+    unknown = set(uids)
+    try:
+        async for session in get_session():
+            for start in range(0, len(uids), HEARTBEAT_FLUSH_BATCH):
+                batch = uids[start:start + HEARTBEAT_FLUSH_BATCH]
+                params = {name: [pending[uid][name] for uid in batch] for name in HEARTBEAT_FIELDS}
+                params["uids"] = batch
+
+                result = await session.execute(
+                    text("""
+                    WITH prev AS (
+                        SELECT uid, status FROM workers
+                        WHERE uid = ANY(CAST(:uids AS text[]))
+                        ORDER BY uid
+                        FOR UPDATE
+                    )
+                    UPDATE workers AS w
+                    SET last_heartbeat = hb.seen_at,
+                        updated_at = hb.seen_at,
+                        status = CASE WHEN hb.online OR w.status = 'suspect'
+                            THEN (CASE WHEN w.running_tasks > 0 THEN 'busy' ELSE 'online' END)
+                            ELSE w.status
+                        END,
+                        cpu_available = CASE WHEN hb.cpu_used IS NULL THEN w.cpu_available
+                            ELSE GREATEST(LEAST(w.cpu_total, COALESCE(hb.cpu_limit, w.cpu_total)) - hb.cpu_used, 0)
+                        END,
+                        memory_available = CASE WHEN hb.memory_used IS NULL THEN w.memory_available
+                            ELSE GREATEST(LEAST(w.memory_total, COALESCE(hb.memory_limit, w.memory_total)) - hb.memory_used, 0)
+                        END,
+                        telemetry = COALESCE(CAST(hb.telemetry AS json), w.telemetry),
+                        spec = CASE WHEN hb.boot IS NULL THEN w.spec
+                            ELSE (COALESCE(CAST(w.spec AS jsonb), '{}'::jsonb) || jsonb_build_object('boot', CAST(hb.boot AS jsonb)))::json
+                        END
+                    FROM unnest(
+                        CAST(:uids AS text[]),
+                        CAST(:seen_at AS timestamp[]),
+                        CAST(:cpu_limit AS float8[]),
+                        CAST(:cpu_used AS float8[]),
+                        CAST(:memory_limit AS integer[]),
+                        CAST(:memory_used AS integer[]),
+                        CAST(:telemetry AS text[]),
+                        CAST(:online AS boolean[]),
+                        CAST(:boot AS text[])
+                    ) AS hb(uid, seen_at, cpu_limit, cpu_used, memory_limit, memory_used, telemetry, online, boot), prev
+                    WHERE w.uid = hb.uid AND prev.uid = hb.uid
+                    RETURNING w.uid, w.grid_uid, prev.status AS old_status, w.status AS new_status
+                    """),
+                    params
+                )
+                rows = result.fetchall()
+                updated += len(rows)
+                changed += [row for row in rows if row.old_status != row.new_status]
+                unknown.difference_update(row.uid for row in rows)
+
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error flushing {len(pending)} worker heartbeats: {e}")
+        heartbeats.restore(pending)
+        return 0
+
+    # Suspect or offline workers that are back may be busy again
+    report_occupancy(changed)
+
+    if unknown:
+        logger.warning(f"Dropped heartbeats of {len(unknown)} unknown workers: {', '.join(sorted(unknown))}")
+        heartbeats.unknown.update(unknown)
+        for uid in unknown:
+            failure_detector.forget(uid)
+    return updated
+
+async def run_heartbeat_flusher():
+    """Flush the buffered heartbeats every HEARTBEAT_FLUSH_SECONDS"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_FLUSH_SECONDS)
+        await flush_heartbeats()
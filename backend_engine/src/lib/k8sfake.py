@@ -0,0 +1,248 @@
+"""In-memory fake of the Kubernetes API server, for running the engine without a cluster
+
+    python -m lib.k8sfake --port 8001
+    K8S_API_URL=http://127.0.0.1:8001 python app.py
+
+Supports the calls of lib/k8ssdk.py on namespaced objects: get, list with
+an equality label selector, watch, server-side apply, merge patch, create,
+replace and delete. StatefulSets are reported ready as soon as they are stored.
+"""
+import re
+import json
+import time
+import argparse
+import threading
+import collections
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Watch events kept for watches resuming from an older resource version
+EVENT_HISTORY = 10000
+
+PATH_PATTERN = re.compile(
+    r"^/(?:api/(?P<core>v1)|apis/(?P<group>[^/]+/[^/]+))/namespaces/(?P<namespace>[^/]+)/(?P<plural>[^/]+)(?:/(?P<name>[^/]+))?$"
+)
+
+def matches_selector(obj, selector):
+    """Whether an object's labels match an equality based label selector (a=b,c=d)"""
+    labels = obj.get("metadata", {}).get("labels") or {}
+    for requirement in filter(None, (selector or "").split(",")):
+        key, _, value = requirement.partition("=")
+        if labels.get(key.strip()) != value.lstrip("=").strip():
+            return False
+    return True
+
+def merge_patch(obj, patch):
+    """Apply a JSON merge patch (RFC 7386), null values remove fields"""
+    if not isinstance(patch, dict):
+        return patch
+    merged = dict(obj) if isinstance(obj, dict) else {}
+    for field, value in patch.items():
+        if value is None:
+            merged.pop(field, None)
+        else:
+            merged[field] = merge_patch(merged.get(field), value)
+    return merged
+
+class FakeKubeAPI(ThreadingHTTPServer):
+    """Objects by (api version, namespace, plural, name), with a count of the requests served"""
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, FakeKubeHandler)
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.events = collections.deque(maxlen=EVENT_HISTORY)
+        self.requests = 0
+        self.resource_version = 0
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def record(self, key, event_type, obj):
+        """Add a watch event and wake the watches up, called with the lock held"""
+        self.events.append((self.resource_version, key[:3], event_type, obj))
+        self.changed.notify_all()
+
+    def store(self, key, obj):
+        self.resource_version += 1
+        obj.setdefault("metadata", {})["resourceVersion"] = str(self.resource_version)
+        if obj.get("kind") == "StatefulSet":
+            replicas = obj.get("spec", {}).get("replicas", 1)
+            obj["status"] = {"replicas": replicas, "readyReplicas": replicas}
+        event_type = "MODIFIED" if key in self.objects else "ADDED"
+        self.objects[key] = obj
+        self.record(key, event_type, obj)
+        return obj
+
+    def remove(self, key):
+        self.resource_version += 1
+        obj = self.objects.pop(key)
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.record(key, "DELETED", obj)
+        return obj
+
+class FakeKubeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write, keep-alive clients would otherwise wait on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def status(self, code, reason, message):
+        self.send(code, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason, "message": message, "code": code})
+
+    def parse(self):
+        """Collection key, object name and query of the request path"""
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        match = PATH_PATTERN.match(url.path)
+        if not match:
+            return None, None, params
+        api_version = match["core"] or match["group"]
+        return (api_version, match["namespace"], match["plural"]), match["name"], params
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def watch(self, collection, params):
+        """Stream the events of a collection after the requested resource version, one JSON line each"""
+        server = self.server
+        deadline = time.monotonic() + float(params.get("timeoutSeconds", 60))
+        with server.lock:
+            since = int(params.get("resourceVersion") or server.resource_version)
+            expired = bool(server.events) and since < server.events[0][0] - 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        if expired:
+            status = {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": "Expired",
+                      "message": f"too old resource version: {since}", "code": 410}
+            self.write_chunk(json.dumps({"type": "ERROR", "object": status}).encode() + b"\n")
+        else:
+            while True:
+                with server.lock:
+                    events = [event for event in server.events if event[0] > since]
+                    if not events:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        server.changed.wait(remaining)
+                        continue
+                since = events[-1][0]
+                lines = [
+                    json.dumps({"type": event_type, "object": obj}).encode() + b"\n"
+                    for _, key, event_type, obj in events
+                    if key == collection and matches_selector(obj, params.get("labelSelector"))
+                ]
+                if lines:
+                    self.write_chunk(b"".join(lines))
+        self.write_chunk(b"")
+
+    def handle_request(self, method):
+        with self.server.lock:
+            self.server.requests += 1
+        collection, name, params = self.parse()
+        body = self.body()
+        if collection is None:
+            return self.status(404, "NotFound", f"Unknown path {self.path}")
+        if method == "GET" and name is None and params.get("watch") in ("1", "true"):
+            return self.watch(collection, params)
+
+        with self.server.lock:
+            objects = self.server.objects
+            key = collection + (name,)
+
+            if method == "GET" and name is None:
+                items = [
+                    obj for k, obj in objects.items()
+                    if k[:3] == collection and matches_selector(obj, params.get("labelSelector"))
+                ]
+                return self.send(200, {
+                    "kind": "List",
+                    "apiVersion": "v1",
+                    "metadata": {"resourceVersion": str(self.server.resource_version)},
+                    "items": items
+                })
+
+            if method == "GET":
+                if key not in objects:
+                    return self.status(404, "NotFound", f"{collection[2]} \"{name}\" not found")
+                return self.send(200, objects[key])
+
+            if method == "POST":
+                key = collection + (body["metadata"]["name"],)
+                if key in objects:
+                    return self.status(409, "AlreadyExists", f"{collection[2]} \"{key[3]}\" already exists")
+                return self.send(201, self.server.store(key, body))
+
+            if method == "PATCH" and self.headers.get("Content-Type") == "application/merge-patch+json":
+                if key not in objects:
+                    return self.status(404, "NotFound", f"{collection[2]} \"{name}\" not found")
+                return self.send(200, self.server.store(key, merge_patch(objects[key], body)))
+
+            if method in ("PATCH", "PUT"):
+                if method == "PUT" and key not in objects:
+                    return self.status(404, "NotFound", f"{collection[2]} \"{name}\" not found")
+                created = key not in objects
+                return self.send(201 if created else 200, self.server.store(key, body))
+
+            if method == "DELETE":
+                if key not in objects:
+                    return self.status(404, "NotFound", f"{collection[2]} \"{name}\" not found")
+                self.server.remove(key)
+                return self.send(200, {"kind": "Status", "apiVersion": "v1", "status": "Success"})
+
+        self.status(405, "MethodNotAllowed", f"{method} is not supported")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+def serve(host="127.0.0.1", port=0):
+    """Start a fake API server in a background thread, returns it (see FakeKubeAPI.url)"""
+    server = FakeKubeAPI((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Kubernetes API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    server = FakeKubeAPI((args.host, args.port))
+    print(f"Fake Kubernetes API server listening on {server.url}")
+    server.serve_forever()
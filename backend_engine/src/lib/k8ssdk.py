@@ -1,125 +1,876 @@
 import os
+import copy
+import json
+import time
 import yaml
+import base64
+import random
+import asyncio
 import logging
+import hashlib
 import tempfile
-import subprocess
+import threading
+import requests
+import collections
+import concurrent.futures
 from string import Template
 from pathlib import Path
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from db import get_session
 
 logger = logging.getLogger(__name__)
 
+# The worker agent package, shipped to worker pods in a ConfigMap
+AGENT_DIR = Path(__file__).parent.parent / "agent"
+AGENT_CONFIGMAP = "vinci4d-agent"
+
+# Connections kept open to the API server, shared by all deployments
+K8S_POOL_SIZE = int(os.environ.get("K8S_POOL_SIZE", "32"))
+K8S_REQUEST_TIMEOUT = float(os.environ.get("K8S_REQUEST_TIMEOUT", "30"))
+
+# Requests per second sent to the API server, with bursts of up to K8S_BURST
+K8S_QPS = float(os.environ.get("K8S_QPS", "50"))
+K8S_BURST = int(os.environ.get("K8S_BURST", "100"))
+
+# Deployment queue: batches running at the same time, workers per batch and retries
+K8S_DEPLOY_CONCURRENCY = int(os.environ.get("K8S_DEPLOY_CONCURRENCY", "16"))
+K8S_DEPLOY_BATCH = int(os.environ.get("K8S_DEPLOY_BATCH", "20"))
+K8S_DEPLOY_ATTEMPTS = int(os.environ.get("K8S_DEPLOY_ATTEMPTS", "6"))
+K8S_RETRY_DELAY = float(os.environ.get("K8S_RETRY_DELAY", "1"))
+K8S_RETRY_MAX_DELAY = float(os.environ.get("K8S_RETRY_MAX_DELAY", "60"))
+
+# Seconds between checks for due jobs when nothing wakes the queue up
+K8S_QUEUE_POLL_SECONDS = float(os.environ.get("K8S_QUEUE_POLL_SECONDS", "5"))
+
+# Finished deployment jobs are deleted after this many seconds
+K8S_JOB_RETENTION_SECONDS = int(os.environ.get("K8S_JOB_RETENTION_SECONDS", "86400"))
+
+# Field manager of the objects the engine applies (server-side apply)
+FIELD_MANAGER = "vinci4d-engine"
+
+SERVICE_ACCOUNT_DIR = Path("/var/run/secrets/kubernetes.io/serviceaccount")
+
+def load_agent_files():
+    """Source files of the worker agent package and their combined hash"""
+    files = {path.name: path.read_text() for path in sorted(AGENT_DIR.glob("*.py"))}
+    digest = hashlib.sha256()
+    for name, content in files.items():
+        digest.update(name.encode())
+        digest.update(content.encode())
+    return files, digest.hexdigest()[:16]
+
+class KubeAPIError(Exception):
+    """Error response of the Kubernetes API server"""
+
+    def __init__(self, status_code, message):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+
+def is_retryable(error):
+    """Whether a failed API call may succeed when tried again (throttling, conflicts, server and network errors)"""
+    if isinstance(error, KubeAPIError):
+        return error.status_code in (409, 429) or error.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+class TokenBucket:
+    """Thread safe token bucket, refilled at rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until it is available, returns the seconds waited
+
+        Tokens are reserved under the lock and waited for outside it, so callers
+        are served in order without holding each other up.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+def _data_file(data):
+    """Write base64 kubeconfig data to a file, requests only takes certificate paths"""
+    with tempfile.NamedTemporaryFile(suffix=".pem", delete=False) as f:
+        f.write(base64.b64decode(data))
+        return f.name
+
+def kube_configured():
+    """Whether load_kube_config has an API server to connect to"""
+    if os.environ.get("K8S_API_URL"):
+        return True
+    if os.environ.get("KUBERNETES_SERVICE_HOST") and (SERVICE_ACCOUNT_DIR / "token").exists():
+        return True
+    return Path(os.environ.get("KUBECONFIG", "~/.kube/config").split(os.pathsep)[0]).expanduser().exists()
+
+# Deployment queue, reconciler and warm pools run only with Kubernetes, by default when an API server is configured
+K8S_ENABLED = os.environ.get("K8S_ENABLED", str(kube_configured())).lower() == "true"
+
+def load_kube_config():
+    """API server URL and credentials
+
+    From K8S_API_URL (with K8S_TOKEN, K8S_CA_CERT or K8S_INSECURE), else the
+    pod's service account when running in the cluster, else the current
+    context of the kubeconfig file.
+    """
+    if os.environ.get("K8S_API_URL"):
+        token = os.environ.get("K8S_TOKEN")
+        verify = os.environ.get("K8S_CA_CERT") or os.environ.get("K8S_INSECURE", "false").lower() != "true"
+        return {
+            "server": os.environ["K8S_API_URL"],
+            "headers": {"Authorization": f"Bearer {token}"} if token else {},
+            "verify": verify,
+            "cert": None
+        }
+
+    if os.environ.get("KUBERNETES_SERVICE_HOST") and (SERVICE_ACCOUNT_DIR / "token").exists():
+        return {
+            "server": f"https://{os.environ['KUBERNETES_SERVICE_HOST']}:{os.environ.get('KUBERNETES_SERVICE_PORT', '443')}",
+            "headers": {"Authorization": f"Bearer {(SERVICE_ACCOUNT_DIR / 'token').read_text().strip()}"},
+            "verify": str(SERVICE_ACCOUNT_DIR / "ca.crt"),
+            "cert": None
+        }
+
+    path = Path(os.environ.get("KUBECONFIG", "~/.kube/config").split(os.pathsep)[0]).expanduser()
+    with open(path) as f:
+        kubeconfig = yaml.safe_load(f)
+
+    context = next(c["context"] for c in kubeconfig["contexts"] if c["name"] == kubeconfig["current-context"])
+    cluster = next(c["cluster"] for c in kubeconfig["clusters"] if c["name"] == context["cluster"])
+    user = next((u["user"] for u in kubeconfig.get("users", []) if u["name"] == context.get("user")), {})
+
+    verify = True
+    if cluster.get("insecure-skip-tls-verify"):
+        verify = False
+    elif cluster.get("certificate-authority-data"):
+        verify = _data_file(cluster["certificate-authority-data"])
+    elif cluster.get("certificate-authority"):
+        verify = cluster["certificate-authority"]
+
+    cert = None
+    if user.get("client-certificate-data"):
+        cert = (_data_file(user["client-certificate-data"]), _data_file(user["client-key-data"]))
+    elif user.get("client-certificate"):
+        cert = (user["client-certificate"], user["client-key"])
+
+    return {
+        "server": cluster["server"],
+        "headers": {"Authorization": f"Bearer {user['token']}"} if user.get("token") else {},
+        "verify": verify,
+        "cert": cert
+    }
+
+def resource_path(api_version, kind, namespace, name=None):
+    """API path of a namespaced object, or of its collection without a name"""
+    base = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+    path = f"{base}/namespaces/{namespace}/{kind.lower()}s"
+    return f"{path}/{name}" if name else path
+
+class KubeAPI:
+    """Kubernetes API client over one pooled keep-alive session
+
+    Thread safe, deployments running in parallel share its connections
+    instead of each starting a kubectl process.
+    """
+
+    def __init__(self, config=None):
+        config = config or load_kube_config()
+        self.server = config["server"].rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=K8S_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(config["headers"])
+        self.session.verify = config["verify"]
+        self.session.cert = config["cert"]
+        self.limiter = TokenBucket(K8S_QPS, K8S_BURST)
+        self.round_trips = 0
+        self.throttled_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def request(self, method, path, **kwargs):
+        """Send a request to the API server within the K8S_QPS rate limit, raises KubeAPIError on error responses"""
+        waited = self.limiter.acquire()
+        with self.lock:
+            self.round_trips += 1
+            self.throttled_seconds += waited
+        response = self.session.request(method, self.server + path, timeout=K8S_REQUEST_TIMEOUT, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise KubeAPIError(response.status_code, message)
+        return response.json() if response.content else None
+
+    def apply(self, obj, namespace):
+        """Create or update an object with server-side apply"""
+        metadata = obj["metadata"]
+        path = resource_path(obj["apiVersion"], obj["kind"], metadata.get("namespace", namespace), metadata["name"])
+        return self.request(
+            "PATCH", path,
+            params={"fieldManager": FIELD_MANAGER, "force": "true"},
+            data=json.dumps(obj),
+            headers={"Content-Type": "application/apply-patch+yaml"}
+        )
+
+    def patch(self, api_version, kind, namespace, name, changes):
+        """Change some fields of an object with a JSON merge patch"""
+        return self.request(
+            "PATCH", resource_path(api_version, kind, namespace, name),
+            params={"fieldManager": FIELD_MANAGER},
+            data=json.dumps(changes),
+            headers={"Content-Type": "application/merge-patch+json"}
+        )
+
+    def delete(self, api_version, kind, namespace, name):
+        """Delete an object and its dependents, returns False if it didn't exist"""
+        try:
+            self.request(
+                "DELETE", resource_path(api_version, kind, namespace, name),
+                json={"kind": "DeleteOptions", "apiVersion": "v1", "propagationPolicy": "Background"}
+            )
+            return True
+        except KubeAPIError as e:
+            if e.status_code == 404:
+                return False
+            raise
+
+    def get(self, api_version, kind, namespace, name=None, label_selector=None):
+        """Get an object, or list a collection filtered by a label selector"""
+        params = {"labelSelector": label_selector} if label_selector else None
+        return self.request("GET", resource_path(api_version, kind, namespace, name), params=params)
+
+    def watch(self, api_version, kind, namespace, resource_version, label_selector=None, timeout_seconds=300):
+        """Events of a collection after resource_version, until the server ends the watch
+
+        Yields the decoded watch events (type and object). An expired
+        resource_version comes as an ERROR event with a 410 status.
+        """
+        params = {
+            "watch": "1",
+            "resourceVersion": resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": str(int(timeout_seconds))
+        }
+        if label_selector:
+            params["labelSelector"] = label_selector
+
+        waited = self.limiter.acquire()
+        with self.lock:
+            self.round_trips += 1
+            self.throttled_seconds += waited
+        with self.session.get(
+            self.server + resource_path(api_version, kind, namespace),
+            params=params,
+            stream=True,
+            timeout=(K8S_REQUEST_TIMEOUT, timeout_seconds + K8S_REQUEST_TIMEOUT)
+        ) as response:
+            if response.status_code >= 400:
+                raise KubeAPIError(response.status_code, response.text)
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+_kube_api = None
+_kube_api_lock = threading.Lock()
+
+def get_kube_api():
+    """Shared API client, created on first use"""
+    global _kube_api
+    with _kube_api_lock:
+        if _kube_api is None:
+            _kube_api = KubeAPI()
+            logger.info(f"Kubernetes API client connected to {_kube_api.server}")
+        return _kube_api
+
+_templates = {}
+
+def load_template(path):
+    """Parsed documents of a manifest template, cached until the file changes"""
+    mtime = os.path.getmtime(path)
+    cached = _templates.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            documents = [doc for doc in yaml.safe_load_all(f) if doc]
+        cached = _templates[path] = (mtime, documents)
+    return cached[1]
+
+def substitute(value, variables):
+    """Copy of a parsed template with ${VAR} placeholders in keys and strings filled in
+
+    Other $ signs are left alone, a spec value like a password may contain them.
+    """
+    if isinstance(value, dict):
+        return {substitute(key, variables): substitute(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, variables) for item in value]
+    if isinstance(value, str) and "$" in value:
+        return Template(value).safe_substitute(variables)
+    return copy.copy(value)
+
+def statefulset_name(worker):
+    """StatefulSet of a worker dict, a worker bound to a warm pod keeps the one of the pod"""
+    spec = worker.get("spec") or {}
+    if isinstance(spec, str):
+        spec = json.loads(spec)
+    return spec.get("statefulset") or f"vinci4dworker-{worker.get('name') or 'worker-' + worker['uid']}"
+
 class K8sDeployer:
     """Class for deploying resources to Kubernetes"""
     
-    def __init__(self, namespace="default"):
+    # Agent ConfigMap hash last applied, shared by all deployers
+    agent_hash = None
+    
+    def __init__(self, namespace="default", api=None):
         """Initialize the deployer with a namespace"""
         self.namespace = namespace
         self.template_dir = Path(__file__).parent.parent
+        self._api = api
     
-    def deploy_worker(self, worker):
-        """Deploy a worker to Kubernetes"""
+    @property
+    def api(self):
+        return self._api or get_kube_api()
+    
+    def apply_agent_configmap(self):
+        """Create or update the ConfigMap holding the worker agent, returns its hash"""
+        files, agent_hash = load_agent_files()
+        if agent_hash == K8sDeployer.agent_hash:
+            return agent_hash
+        
+        manifest = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {
+                "name": AGENT_CONFIGMAP,
+                "namespace": self.namespace,
+                "labels": {"app": "vinci4d-worker"},
+                "annotations": {"vinci4d.ai/agent-hash": agent_hash}
+            },
+            "data": files
+        }
+        
         try:
-            # Load the worker template
-            template_path = self.template_dir / "worker_template.yaml"
-            with open(template_path, 'r') as f:
-                template_content = f.read()
-            
-            # Prepare template variables
-            cpu_request = worker["cpu_total"] * 0.8  # Request 80% of total CPU
-            memory_request = int(worker["memory_total"] * 0.8)  # Request 80% of total memory
-            
-            # Add GPU limit if GPU is available
-            gpu_limit = ""
-            if worker.get("gpu_id"):
-                gpu_limit = f'nvidia.com/gpu: "1"'
-            
-            # Get docker image from spec
-            docker_image = worker.get("spec", {}).get("docker_image", "python:3.11-slim")
-            
-            # Prepare template variables with vinci4dworker prefix
-            worker_name = f"vinci4dworker-{worker['name']}"
-            
-            template_vars = {
-                "WORKER_NAME": worker_name,
-                "WORKER_UID": worker["uid"],
-                "GRID_UID": worker["grid_uid"],
-                "NAMESPACE": self.namespace,
-                "DOCKER_IMAGE": docker_image,
-                "CPU_REQUEST": str(cpu_request),
-                "CPU_LIMIT": str(worker["cpu_total"]),
-                "MEMORY_REQUEST": str(memory_request),
-                "MEMORY_LIMIT": str(worker["memory_total"]),
-                "GPU_LIMIT": gpu_limit,
-                "BACKEND_ENGINE_URL": "http://host.docker.internal:8000",
-                "LOGSTORE_URL": os.environ.get("LOGSTORE_URL", "http://logstore:8000"),
-                "ARTIFACTORY_URL": os.environ.get("ARTIFACTORY_URL", "http://artifactory:8000")
-            }
-            
-            # Apply template
-            template = Template(template_content)
-            manifest = template.substitute(template_vars)
-            
-            # Write manifest to temporary file
-            with tempfile.NamedTemporaryFile(suffix=".yaml", delete=False) as tmp:
-                tmp.write(manifest.encode())
-                tmp_path = tmp.name
-            
-            # Apply manifest using kubectl
-            result = subprocess.run(
-                ["kubectl", "apply", "-f", tmp_path],
-                capture_output=True,
-                text=True
-            )
-            
-            # Clean up temporary file
-            os.unlink(tmp_path)
-            
-            if result.returncode != 0:
-                logger.error(f"Failed to deploy worker: {result.stderr}")
-                return False
-            
-            logger.info(f"Worker {worker['uid']} deployed successfully as {worker_name}")
-            return True
+            self.api.apply(manifest, self.namespace)
+        except KubeAPIError as e:
+            raise KubeAPIError(e.status_code, f"Failed to apply worker agent ConfigMap: {e}")
+        
+        logger.info(f"Worker agent {agent_hash} applied to ConfigMap {AGENT_CONFIGMAP}")
+        K8sDeployer.agent_hash = agent_hash
+        return agent_hash
+    
+    def template_vars(self, worker, agent_hash):
+        """Template variables of a worker's resources and image"""
+        cpu_request = worker["cpu_total"] * 0.8  # Request 80% of total CPU
+        memory_request = int(worker["memory_total"] * 0.8)  # Request 80% of total memory
+        
+        # Get docker image from spec
+        docker_image = (worker.get("spec") or {}).get("docker_image", "python:3.11-slim")
+        
+        return {
+            "GRID_UID": worker["grid_uid"] or "",
+            "NAMESPACE": self.namespace,
+            "DOCKER_IMAGE": docker_image,
+            "CPU_REQUEST": str(cpu_request),
+            "CPU_LIMIT": str(worker["cpu_total"]),
+            "MEMORY_REQUEST": str(memory_request),
+            "MEMORY_LIMIT": str(worker["memory_total"]),
+            "AGENT_CONFIGMAP": AGENT_CONFIGMAP,
+            "AGENT_HASH": agent_hash,
+            "BACKEND_ENGINE_URL": os.environ.get("WORKER_BACKEND_ENGINE_URL", "http://host.docker.internal:8000"),
+            "LOGSTORE_URL": os.environ.get("LOGSTORE_URL", "http://logstore:8000"),
+            "ARTIFACTORY_URL": os.environ.get("ARTIFACTORY_URL", "http://artifactory:8000")
+        }
+    
+    def add_gpu_limit(self, objects):
+        for obj in objects:
+            if obj["kind"] == "StatefulSet":
+                for container in obj["spec"]["template"]["spec"]["containers"]:
+                    container["resources"]["limits"]["nvidia.com/gpu"] = "1"
+    
+    def render_worker(self, worker, agent_hash):
+        """Kubernetes objects of a worker, from the cached worker template"""
+        template_vars = self.template_vars(worker, agent_hash)
+        template_vars["WORKER_NAME"] = statefulset_name(worker)
+        template_vars["WORKER_UID"] = worker["uid"]
+        
+        objects = substitute(load_template(self.template_dir / "worker_template.yaml"), template_vars)
+        
+        # Add GPU limit if GPU is available
+        if worker.get("gpu_id"):
+            self.add_gpu_limit(objects)
+        
+        return objects
+    
+    def render_worker_group(self, group, agent_hash):
+        """StatefulSet and Service of a grid's worker group (see lib/workergroup.py), its replicas are the grid's workers"""
+        template_vars = self.template_vars(group, agent_hash)
+        template_vars["GROUP_NAME"] = statefulset_name(group)
+        
+        objects = substitute(load_template(self.template_dir / "worker_group_template.yaml"), template_vars)
+        for obj in objects:
+            if obj["kind"] == "StatefulSet":
+                obj["spec"]["replicas"] = group["replicas"]
+        
+        if group.get("gpu_id"):
+            self.add_gpu_limit(objects)
         
+        return objects
+    
+    def apply_worker_groups(self, groups):
+        """Create or update worker groups, returns the exceptions of the ones that failed by group name"""
+        errors = {}
+        try:
+            agent_hash = self.apply_agent_configmap()
         except Exception as e:
-            logger.error(f"Error deploying worker: {e}")
-            return False
+            logger.error(f"Error deploying {len(groups)} worker groups: {e}")
+            return {group["uid"]: e for group in groups}
+        
+        for group in groups:
+            try:
+                for obj in self.render_worker_group(group, agent_hash):
+                    self.api.apply(obj, self.namespace)
+                logger.info(f"Worker group {group['uid']} deployed with {group['replicas']} replicas")
+            except Exception as e:
+                logger.error(f"Failed to deploy worker group {group['uid']}: {e}")
+                errors[group["uid"]] = e
+        
+        return errors
+    
+    def scale_worker_groups(self, groups):
+        """Set the replicas of worker groups with one patch each, returns the exceptions of the ones that failed"""
+        errors = {}
+        for group in groups:
+            try:
+                self.api.patch("apps/v1", "StatefulSet", self.namespace, group["uid"], {"spec": {"replicas": group["replicas"]}})
+                logger.info(f"Worker group {group['uid']} scaled to {group['replicas']} replicas")
+            except Exception as e:
+                logger.error(f"Failed to scale worker group {group['uid']}: {e}")
+                errors[group["uid"]] = e
+        
+        return errors
+    
+    def deploy_workers(self, workers):
+        """Deploy workers to Kubernetes, returns the exceptions of the ones that failed by UID
+
+        Objects shared by all workers of the template are applied once.
+        """
+        errors = {}
+        try:
+            # Make sure the pods can mount the current agent, a new hash rolls them
+            agent_hash = self.apply_agent_configmap()
+        except Exception as e:
+            logger.error(f"Error deploying {len(workers)} workers: {e}")
+            return {worker["uid"]: e for worker in workers}
+        
+        applied = set()
+        for worker in workers:
+            try:
+                for obj in self.render_worker(worker, agent_hash):
+                    key = (obj["kind"], obj["metadata"].get("namespace", self.namespace), obj["metadata"]["name"])
+                    if key in applied:
+                        continue
+                    self.api.apply(obj, self.namespace)
+                    applied.add(key)
+                logger.info(f"Worker {worker['uid']} deployed successfully as {statefulset_name(worker)}")
+            except Exception as e:
+                logger.error(f"Failed to deploy worker {worker['uid']}: {e}")
+                errors[worker["uid"]] = e
+        
+        return errors
+    
+    def deploy_worker(self, worker):
+        """Deploy a worker to Kubernetes"""
+        return not self.deploy_workers([worker])
     
-    def delete_worker(self, worker_uid, worker_name=None):
+    def label_workers(self, workers):
+        """Label the StatefulSets, Services and pods of workers bound to a warm pod with their grid, returns the exceptions of the ones that failed by UID
+
+        Only the labels change, a new pod template would restart the warm pod.
+        GRID_UID stays empty in its env until the next rollout, the agent of a
+        single worker doesn't use it and per-grid queries go through the
+        workers table.
+        """
+        errors = {}
+        for worker in workers:
+            name = statefulset_name(worker)
+            labels = {"metadata": {"labels": {"grid": worker["grid_uid"] or ""}}}
+            try:
+                self.api.patch("apps/v1", "StatefulSet", self.namespace, name, labels)
+                self.api.patch("v1", "Service", self.namespace, name, labels)
+                try:
+                    self.api.patch("v1", "Pod", self.namespace, f"{name}-0", labels)
+                except KubeAPIError as e:
+                    # A pod being recreated gets the label from the StatefulSet's next rollout
+                    if e.status_code != 404:
+                        raise
+                logger.info(f"Worker {worker['uid']} labeled with grid {worker['grid_uid']}")
+            except Exception as e:
+                logger.error(f"Error labeling worker {worker['uid']}: {e}")
+                errors[worker["uid"]] = e
+        
+        return errors
+    
+    def delete_workers(self, workers):
+        """Delete the StatefulSets of worker dicts (uid, name and spec), returns the exceptions of the ones that failed by UID"""
+        errors = {}
+        for worker in workers:
+            name = statefulset_name(worker)
+            try:
+                self.api.delete("apps/v1", "StatefulSet", self.namespace, name)
+                self.api.delete("v1", "Service", self.namespace, name)
+                logger.info(f"Worker {worker['uid']} deleted successfully")
+            except Exception as e:
+                logger.error(f"Error deleting worker {worker['uid']}: {e}")
+                errors[worker["uid"]] = e
+        
+        return errors
+    
+    def delete_worker(self, worker_uid, worker_name=None, spec=None):
         """Delete a worker from Kubernetes"""
+        return not self.delete_workers([{"uid": worker_uid, "name": worker_name, "spec": spec}])
+
+def load_payload(payload):
+    """Worker dict stored with a job, asyncpg returns json columns of raw queries as text"""
+    return json.loads(payload) if isinstance(payload, str) else payload
+
+def retry_delay(attempts):
+    """Exponential backoff before the next attempt, with jitter so throttled batches don't retry together"""
+    delay = min(K8S_RETRY_MAX_DELAY, K8S_RETRY_DELAY * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.5, 1.0)
+
+class DeploymentQueue:
+    """Worker deployments and deletions, persisted in deployment_jobs and run in batches
+
+    At most K8S_DEPLOY_CONCURRENCY batches of K8S_DEPLOY_BATCH workers run at
+    a time, on the queue's own threads. Jobs failing with a retryable error are
+    tried again with exponential backoff, up to K8S_DEPLOY_ATTEMPTS attempts.
+    Jobs of the same worker run in the order they were submitted, and jobs
+    interrupted by an engine restart run again when the queue starts.
+    """
+
+    def __init__(self, concurrency=K8S_DEPLOY_CONCURRENCY, batch_size=K8S_DEPLOY_BATCH):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.executor = None
+        self.running = set()
+        self.waiters = {}
+        self.wakeup = None
+        self.stats = collections.Counter()
+        # Called with the worker UIDs of jobs given up on, see lib/reconciler.py
+        self.failure_listeners = []
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix="deploy"
+            )
+        return self.executor
+
+    def notify(self):
+        """Wake the queue up to claim new or freed up work"""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def resolve(self, job_id, error):
+        future = self.waiters.pop(job_id, None)
+        if future is not None and not future.done():
+            future.set_result(error)
+
+    async def submit(self, action, workers, namespace=None):
+        """Persist a deploy or delete job per worker dict, returns a future per worker UID
+
+        Worker groups (see lib/workergroup.py) are deployed with "group" and
+        scaled with "scale" jobs, keyed by their StatefulSet name. Workers bound
+        to a warm pod (see lib/warmpool.py) are moved to their grid with
+        "label" jobs.
+
+        A future resolves to None once its worker is deployed or deleted, else
+        to the error of the last attempt. Deleting a worker or group cancels its
+        pending deploys and scales.
+        """
+        namespace = namespace or os.environ.get("K8S_NAMESPACE", "default")
+        loop = asyncio.get_running_loop()
+        now = datetime.utcnow()
+        futures = {}
+        cancelled = []
+        job_ids = []
         try:
-            # If worker_name is provided, use it to construct the StatefulSet name
-            # Otherwise, use the worker_uid
-            if worker_name:
-                statefulset_name = f"vinci4dworker-{worker_name}"
+            async for session in get_session():
+                if action == "delete":
+                    result = await session.execute(
+                        text("""
+                        UPDATE deployment_jobs
+                        SET status = 'cancelled', last_error = 'Worker deleted', updated_at = :now
+                        WHERE worker_uid = ANY(CAST(:uids AS text[]))
+                        AND action != 'delete' AND status = 'pending'
+                        RETURNING id
+                        """),
+                        {"uids": [worker["uid"] for worker in workers], "now": now}
+                    )
+                    cancelled = [row.id for row in result.fetchall()]
+
+                result = await session.execute(
+                    text("""
+                    INSERT INTO deployment_jobs
+                        (action, worker_uid, grid_uid, namespace, payload, status, attempts, next_attempt_at, created_at, updated_at)
+                    SELECT :action, j.worker_uid, j.grid_uid, :namespace, CAST(j.payload AS json), 'pending', 0, :now, :now, :now
+                    FROM unnest(
+                        CAST(:uids AS text[]),
+                        CAST(:grid_uids AS text[]),
+                        CAST(:payloads AS text[])
+                    ) AS j(worker_uid, grid_uid, payload)
+                    RETURNING id, worker_uid
+                    """),
+                    {
+                        "action": action,
+                        "namespace": namespace,
+                        "uids": [worker["uid"] for worker in workers],
+                        "grid_uids": [worker.get("grid_uid") for worker in workers],
+                        "payloads": [json.dumps(worker) for worker in workers],
+                        "now": now
+                    }
+                )
+                # Register the futures before committing, the queue may pick the jobs up right after
+                for job in result.fetchall():
+                    future = loop.create_future()
+                    self.waiters[job.id] = future
+                    futures[job.worker_uid] = future
+                    job_ids.append(job.id)
+                await session.commit()
+        except Exception:
+            for job_id in job_ids:
+                self.waiters.pop(job_id, None)
+            raise
+
+        for job_id in cancelled:
+            self.resolve(job_id, "Worker deleted")
+        self.notify()
+        return futures
+
+    async def recover(self):
+        """Put back the jobs that were running when the engine stopped"""
+        async for session in get_session():
+            result = await session.execute(
+                text("""
+                UPDATE deployment_jobs
+                SET status = 'pending', next_attempt_at = :now, updated_at = :now
+                WHERE status = 'running'
+                """),
+                {"now": datetime.utcnow()}
+            )
+            await session.commit()
+            if result.rowcount:
+                logger.info(f"Resuming {result.rowcount} interrupted deployment jobs")
+
+    async def claim(self, limit):
+        """Mark up to limit due jobs as running, skipping workers with an earlier job still to run"""
+        now = datetime.utcnow()
+        async for session in get_session():
+            result = await session.execute(
+                text("""
+                UPDATE deployment_jobs AS j
+                SET status = 'running', attempts = j.attempts + 1, updated_at = :now
+                WHERE j.id IN (
+                    SELECT p.id FROM deployment_jobs p
+                    WHERE p.status = 'pending' AND p.next_attempt_at <= :now
+                    AND NOT EXISTS (
+                        SELECT 1 FROM deployment_jobs e
+                        WHERE e.worker_uid = p.worker_uid AND e.id < p.id
+                        AND e.status IN ('pending', 'running')
+                    )
+                    ORDER BY p.id
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING j.id, j.action, j.worker_uid, j.namespace, j.payload, j.attempts
+                """),
+                {"now": now, "limit": limit}
+            )
+            jobs = sorted(result.fetchall(), key=lambda job: job.id)
+            await session.commit()
+            return jobs
+        return []
+
+    def batches(self, jobs):
+        """Jobs grouped by action and namespace, in batches of at most batch_size"""
+        groups = collections.defaultdict(list)
+        for job in jobs:
+            groups[(job.action, job.namespace)].append(job)
+        for group in groups.values():
+            for start in range(0, len(group), self.batch_size):
+                yield group[start:start + self.batch_size]
+
+    async def run_batch(self, jobs):
+        """Deploy or delete the workers of a batch of jobs on the queue's threads"""
+        action, namespace = jobs[0].action, jobs[0].namespace
+        deployer = K8sDeployer(namespace=namespace)
+        loop = asyncio.get_running_loop()
+        try:
+            run = {
+                "deploy": deployer.deploy_workers,
+                "delete": deployer.delete_workers,
+                "label": deployer.label_workers,
+                "group": deployer.apply_worker_groups,
+                "scale": deployer.scale_worker_groups
+            }[action]
+            errors = await loop.run_in_executor(self.get_executor(), run, [load_payload(job.payload) for job in jobs])
+        except Exception as e:
+            errors = {job.worker_uid: e for job in jobs}
+
+        try:
+            await self.finish(jobs, errors)
+        except Exception as e:
+            logger.error(f"Error recording the outcome of {len(jobs)} {action} jobs: {e}")
+        finally:
+            self.notify()
+
+    async def finish(self, jobs, errors):
+        """Record the outcome of a batch, scheduling a retry for retryable errors"""
+        now = datetime.utcnow()
+        outcomes = []
+        for job in jobs:
+            error = errors.get(job.worker_uid)
+            if error is None:
+                outcomes.append((job, "done", None, now))
+            elif is_retryable(error) and job.attempts < K8S_DEPLOY_ATTEMPTS:
+                outcomes.append((job, "pending", str(error), now + timedelta(seconds=retry_delay(job.attempts))))
             else:
-                statefulset_name = f"vinci4dworker-worker-{worker_uid}"
-            
-            # Delete the StatefulSet
-            result = subprocess.run(
-                ["kubectl", "delete", "statefulset", statefulset_name, "-n", self.namespace],
-                capture_output=True,
-                text=True
+                outcomes.append((job, "failed", str(error), now))
+
+        # Settle the waiters first, a failure to write the outcome below only
+        # leaves the jobs to be run again after a restart
+        for job, status, error, _ in outcomes:
+            self.stats[status if status != "pending" else "retried"] += 1
+            if status == "failed":
+                logger.error(f"Giving up on {job.action} of worker {job.worker_uid} after {job.attempts} attempts: {error}")
+            if status != "pending":
+                self.resolve(job.id, error)
+
+        failed = [job.worker_uid for job, status, _, _ in outcomes if status == "failed"]
+        if failed:
+            for listener in self.failure_listeners:
+                listener(failed)
+
+        async for session in get_session():
+            await session.execute(
+                text("""
+                UPDATE deployment_jobs AS j
+                SET status = o.status, last_error = o.error, next_attempt_at = o.next_attempt_at, updated_at = :now
+                FROM unnest(
+                    CAST(:ids AS integer[]),
+                    CAST(:statuses AS text[]),
+                    CAST(:errors AS text[]),
+                    CAST(:next_attempts AS timestamp[])
+                ) AS o(id, status, error, next_attempt_at)
+                WHERE j.id = o.id
+                """),
+                {
+                    "ids": [job.id for job, _, _, _ in outcomes],
+                    "statuses": [status for _, status, _, _ in outcomes],
+                    "errors": [error for _, _, error, _ in outcomes],
+                    "next_attempts": [next_attempt for _, _, _, next_attempt in outcomes],
+                    "now": now
+                }
             )
-            
-            if result.returncode != 0 and "not found" not in result.stderr:
-                logger.error(f"Failed to delete worker StatefulSet: {result.stderr}")
-                return False
-            
-            # Delete the Service
-            result = subprocess.run(
-                ["kubectl", "delete", "service", statefulset_name, "-n", self.namespace],
-                capture_output=True,
-                text=True
+            await session.commit()
+
+    async def prune(self):
+        """Delete finished jobs older than K8S_JOB_RETENTION_SECONDS"""
+        async for session in get_session():
+            result = await session.execute(
+                text("""
+                DELETE FROM deployment_jobs
+                WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < :before
+                """),
+                {"before": datetime.utcnow() - timedelta(seconds=K8S_JOB_RETENTION_SECONDS)}
             )
-            
-            if result.returncode != 0 and "not found" not in result.stderr:
-                logger.error(f"Failed to delete worker Service: {result.stderr}")
-                return False
-            
-            logger.info(f"Worker {worker_uid} deleted successfully")
-            return True
-        
+            await session.commit()
+            return result.rowcount
+
+    async def run(self):
+        """Run due jobs as batches free up, until cancelled"""
+        self.wakeup = asyncio.Event()
+        try:
+            await self.recover()
         except Exception as e:
-            logger.error(f"Error deleting worker: {e}")
-            return False
+            logger.error(f"Error resuming deployment jobs: {e}")
+
+        pruned_at = 0
+        while True:
+            try:
+                free = self.concurrency - len(self.running)
+                if free > 0:
+                    for batch in self.batches(await self.claim(free * self.batch_size)):
+                        task = asyncio.create_task(self.run_batch(batch))
+                        self.running.add(task)
+                        task.add_done_callback(self.running.discard)
+                if time.monotonic() - pruned_at > 3600:
+                    await self.prune()
+                    pruned_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error running deployment jobs: {e}")
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=K8S_QUEUE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def summary(self):
+        """Job counts by action and status, recent failures and API client counters"""
+        async for session in get_session():
+            result = await session.execute(
+                text("SELECT action, status, COUNT(*) AS count FROM deployment_jobs GROUP BY action, status")
+            )
+            counts = collections.defaultdict(dict)
+            for row in result.fetchall():
+                counts[row.action][row.status] = row.count
+
+            result = await session.execute(
+                text("""
+                SELECT action, worker_uid, attempts, last_error, updated_at FROM deployment_jobs
+                WHERE status = 'failed'
+                ORDER BY updated_at DESC
+                LIMIT 20
+                """)
+            )
+            failures = [
+                {
+                    "action": row.action,
+                    "worker_uid": row.worker_uid,
+                    "attempts": row.attempts,
+                    "error": row.last_error,
+                    "failed_at": row.updated_at.isoformat() if row.updated_at else None
+                }
+                for row in result.fetchall()
+            ]
+
+        api = _kube_api
+        return {
+            "jobs": counts,
+            "running_batches": len(self.running),
+            "outcomes": dict(self.stats),
+            "recent_failures": failures,
+            "api_requests": api.round_trips if api else 0,
+            "api_throttled_seconds": round(api.throttled_seconds, 1) if api else 0.0
+        }
+
+deployment_queue = DeploymentQueue()
+
+async def run_deployment_queue():
+    """Run the deployment queue, started with the engine"""
+    await deployment_queue.run()
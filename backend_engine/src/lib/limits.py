@@ -0,0 +1,197 @@
+import os
+import time
+import asyncio
+import logging
+import collections
+from datetime import datetime
+from sqlalchemy import text
+from db import get_session
+
+logger = logging.getLogger(__name__)
+
+# Seconds between reconciliations of the in-memory counters with the tasks table
+LIMITS_RECONCILE_SECONDS = float(os.environ.get("LIMITS_RECONCILE_SECONDS", "5"))
+
+# Pending tasks a claim looks at per task wanted while some function can only take part of it
+LIMITS_SCAN_FACTOR = int(os.environ.get("LIMITS_SCAN_FACTOR", "4"))
+
+LIMIT_FIELDS = ["max_concurrency", "rate_limit", "rate_burst"]
+
+class FunctionLimits:
+    """Concurrency and token bucket rate limits of functions, enforced at claim time
+
+    running counts each limited function's running and prefetched tasks. A
+    claim reserves its allowance in inflight with acquire before touching the
+    database and moves what it claimed to running with release, both without
+    awaiting, so concurrent claims never hand out the same allowance.
+    Finished, requeued and cancelled tasks are counted down as they happen,
+    lease expiries are caught up by the periodic reconciliation. Every change
+    of running is also summed up in changes, so the reconciliation can add
+    what changed while it counted.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.running = collections.defaultdict(int)
+        self.changes = collections.defaultdict(int)
+        self.inflight = collections.defaultdict(int)
+        self.tokens = {}
+        self.refilled_at = {}
+
+    def configure(self, function_uid, max_concurrency=None, rate_limit=None, rate_burst=None):
+        """Set or clear a function's limits, keeping its counters"""
+        if not max_concurrency and not rate_limit:
+            self.limits.pop(function_uid, None)
+            self.tokens.pop(function_uid, None)
+            return
+        burst = rate_burst or max(1, int(rate_limit or 0))
+        self.limits[function_uid] = (max_concurrency or None, rate_limit or None, burst)
+        if rate_limit:
+            self.tokens[function_uid] = min(self.tokens.get(function_uid, burst), burst)
+            self.refilled_at.setdefault(function_uid, time.monotonic())
+
+    def refill(self, function_uid, now):
+        _, rate, burst = self.limits[function_uid]
+        if rate:
+            elapsed = now - self.refilled_at.get(function_uid, now)
+            self.tokens[function_uid] = min(burst, self.tokens.get(function_uid, burst) + elapsed * rate)
+        self.refilled_at[function_uid] = now
+
+    def acquire(self, count):
+        """Reserve up to count tasks for every limited function, returns {function_uid: allowance}"""
+        now = time.monotonic()
+        grants = {}
+        for function_uid, (max_concurrency, rate, _) in self.limits.items():
+            self.refill(function_uid, now)
+            allowance = count
+            if max_concurrency:
+                allowance = min(allowance, max_concurrency - self.running[function_uid] - self.inflight[function_uid])
+            if rate:
+                allowance = min(allowance, int(self.tokens[function_uid]))
+            allowance = max(allowance, 0)
+            self.inflight[function_uid] += allowance
+            if rate:
+                self.tokens[function_uid] -= allowance
+            grants[function_uid] = allowance
+        return grants
+
+    def release(self, grants, claimed):
+        """Count a claim's tasks as running and give back the allowance it didn't use"""
+        for function_uid, allowance in grants.items():
+            used = claimed.get(function_uid, 0)
+            self.inflight[function_uid] = max(self.inflight[function_uid] - allowance, 0)
+            self.adjust(function_uid, used)
+            if function_uid in self.tokens:
+                self.tokens[function_uid] += allowance - used
+
+    def adjust(self, function_uid, delta):
+        """Change a function's running count, recording the change for the reconciliation"""
+        self.running[function_uid] = max(self.running[function_uid] + delta, 0)
+        self.changes[function_uid] += delta
+
+    def finished(self, function_uid, count=1):
+        """Count down a limited function's tasks that stopped running or were requeued"""
+        if function_uid in self.limits:
+            self.adjust(function_uid, -count)
+
+    def cancelled(self, function_uid):
+        """A cancelled function runs no tasks anymore"""
+        if self.running.get(function_uid):
+            self.adjust(function_uid, -self.running[function_uid])
+
+    def reconcile(self, function_uid, counted, changes_before):
+        """Set a function's running count to a recount, plus what changed since it started"""
+        since = self.changes.get(function_uid, 0) - changes_before.get(function_uid, 0)
+        running = max(counted + since, 0)
+        if self.running[function_uid] != running:
+            logger.debug(f"Function {function_uid} runs {running} tasks, counted {self.running[function_uid]}")
+        self.running[function_uid] = running
+
+    def snapshot(self, function_uid):
+        """Current counters of a function"""
+        _, rate, _ = self.limits.get(function_uid, (None, None, None))
+        if rate:
+            self.refill(function_uid, time.monotonic())
+        return {
+            "running": self.running.get(function_uid, 0) + self.inflight.get(function_uid, 0),
+            "tokens": round(self.tokens[function_uid], 2) if rate else None
+        }
+
+function_limits = FunctionLimits()
+
+def limits_of(function):
+    """Limit settings of a function row"""
+    return {field: getattr(function, field, None) for field in LIMIT_FIELDS}
+
+def limit_settings(data):
+    """Limit settings given in a request, 0 clears a limit. Raises ValueError for invalid ones"""
+    settings = {}
+    for field in LIMIT_FIELDS:
+        if data.get(field) is None:
+            continue
+        try:
+            value = float(data[field]) if field == "rate_limit" else int(data[field])
+        except (ValueError, TypeError):
+            raise ValueError(f"{field} must be a {'number' if field == 'rate_limit' else 'whole number'}")
+        if value < 0:
+            raise ValueError(f"{field} must not be negative")
+        settings[field] = value or None
+    return settings
+
+async def get_limits(function_uid):
+    """A function's limit settings and current counters, None if it doesn't exist"""
+    async for session in get_session():
+        result = await session.execute(
+            text("SELECT uid, max_concurrency, rate_limit, rate_burst FROM functions WHERE uid = :uid"),
+            {"uid": function_uid}
+        )
+        function = result.fetchone()
+
+    if not function:
+        return None
+    return {"function_uid": function.uid, **limits_of(function), **function_limits.snapshot(function.uid)}
+
+async def reconcile_limits():
+    """Reload the limited functions and recount their running and prefetched tasks
+
+    Claims and completions while the recount runs are added on top of it,
+    counting them twice if the recount already saw them errs on the safe side
+    until the next reconciliation.
+    """
+    changes_before = dict(function_limits.changes)
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            SELECT f.uid, f.max_concurrency, f.rate_limit, f.rate_burst,
+                (SELECT COUNT(*) FROM tasks t
+                 WHERE t.function_uid = f.uid
+                 AND (t.status = 'running'
+                      OR (t.status = 'pending' AND t.worker_uid IS NOT NULL AND t.lease_expires_at > :now))
+                ) AS running
+            FROM functions f
+            WHERE f.max_concurrency IS NOT NULL OR f.rate_limit IS NOT NULL
+            """),
+            {"now": datetime.utcnow()}
+        )
+        functions = result.fetchall()
+
+    limited = set()
+    for function in functions:
+        function_limits.configure(function.uid, **limits_of(function))
+        if function.uid in function_limits.limits:
+            limited.add(function.uid)
+            function_limits.reconcile(function.uid, function.running, changes_before)
+    for function_uid in set(function_limits.limits) - limited:
+        function_limits.configure(function_uid)
+    for function_uid in set(function_limits.running) - limited:
+        del function_limits.running[function_uid]
+        function_limits.changes.pop(function_uid, None)
+
+async def run_limits_reconciler():
+    """Reconcile the function limit counters every LIMITS_RECONCILE_SECONDS"""
+    while True:
+        try:
+            await reconcile_limits()
+        except Exception as e:
+            logger.error(f"Error reconciling function limits: {e}")
+        await asyncio.sleep(LIMITS_RECONCILE_SECONDS)
@@ -0,0 +1,102 @@
+import os
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Engine-side cap on the stored output of a single task
+LOG_TASK_MAX_BYTES = int(os.environ.get("LOG_TASK_MAX_KB", "4096")) * 1024
+
+class LocalLogStore:
+    """Task logs stored as one append-only file per task on local disk"""
+
+    def __init__(self, base_dir):
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def _path(self, task_uid):
+        """Path of a task's log file, sharded by the first characters of the UID
+
+        Raises ValueError for UIDs that would leave the log directory.
+        """
+        path = (self.base_dir / task_uid[:2] / f"{task_uid}.log").resolve()
+        if not path.is_relative_to(self.base_dir.resolve()):
+            raise ValueError(f"Invalid task UID {task_uid!r}")
+        return path
+
+    def append(self, task_uid, lines, dropped=0):
+        """Append lines to a task's log, returns the number of bytes written"""
+        path = self._path(task_uid)
+        path.parent.mkdir(exist_ok=True)
+
+        data = "".join(f"{line}\n" for line in lines)
+        if dropped:
+            data += f"[... {dropped} lines dropped by the worker ...]\n"
+        encoded = data.encode("utf-8", errors="replace")
+
+        with self.lock:
+            size = path.stat().st_size if path.exists() else 0
+            if size >= LOG_TASK_MAX_BYTES:
+                return 0
+            if size + len(encoded) > LOG_TASK_MAX_BYTES:
+                marker = b"[... log truncated, size limit reached ...]\n"
+                encoded = encoded[:max(LOG_TASK_MAX_BYTES - size - len(marker), 0)] + marker
+
+            with open(path, "ab") as f:
+                f.write(encoded)
+
+        return len(encoded)
+
+    def read(self, task_uid, offset=0, limit=65536):
+        """Read a task's log from a byte offset, returns (text, next_offset)"""
+        path = self._path(task_uid)
+        if not path.exists():
+            return "", offset
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(limit)
+
+        # Don't split a line between two reads unless it doesn't fit at all
+        if len(data) == limit and b"\n" in data:
+            data = data[:data.rindex(b"\n") + 1]
+
+        return data.decode("utf-8", errors="replace"), offset + len(data)
+
+    def delete(self, task_uid):
+        """Delete a task's log"""
+        path = self._path(task_uid)
+        if path.exists():
+            path.unlink()
+
+def get_log_store():
+    """Get the log store configured by LOGSTORE_URL
+
+    Only local disk is supported: file:///abs/path, file://relative/path or a
+    plain path. Relative paths are resolved against the backend_engine directory.
+    """
+    global _log_store
+    if _log_store is not None:
+        return _log_store
+
+    default_dir = Path(__file__).parent.parent.parent / "logs"
+    url = os.environ.get("LOGSTORE_URL", "")
+
+    if url.startswith("file://"):
+        base_dir = Path(url[len("file://"):])
+    elif url and "://" not in url:
+        base_dir = Path(url)
+    else:
+        if url:
+            logger.warning(f"Unsupported LOGSTORE_URL {url}, storing task logs in {default_dir}")
+        base_dir = default_dir
+
+    if not base_dir.is_absolute():
+        base_dir = Path(__file__).parent.parent.parent / base_dir
+
+    _log_store = LocalLogStore(base_dir)
+    return _log_store
+
+_log_store = None
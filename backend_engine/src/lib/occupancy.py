@@ -0,0 +1,101 @@
+import logging
+from sqlalchemy import text
+from db import get_session
+from lib.utilization import utilization, status_value
+
+logger = logging.getLogger(__name__)
+
+def occupancy_ctes(source):
+    """CTEs applying the task transitions of a source CTE to the workers running them
+
+    source has one row per transition with worker_uid, function_uid and a
+    delta of +1 for a task that started running on the worker and -1 for
+    one that stopped. Each worker's running_tasks and status (online or
+    busy) follow, and the CPU and memory its tasks' functions request are
+    added to or taken from cpu_reserved and memory_reserved. cpu_available
+    and memory_available are left to the heartbeats' measurements. The
+    occupancy CTE returns the old and new status of each changed worker,
+    see report_occupancy. Needs a :now parameter.
+    """
+    return f"""
+    occupancy_prev AS (
+        SELECT uid, status FROM workers
+        WHERE uid IN (SELECT worker_uid FROM {source})
+        FOR UPDATE
+    ),
+    occupancy AS (
+        UPDATE workers AS w
+        SET running_tasks = GREATEST(w.running_tasks + o.tasks, 0),
+            cpu_reserved = GREATEST(w.cpu_reserved + o.cpu, 0),
+            memory_reserved = GREATEST(w.memory_reserved + o.memory, 0),
+            status = CASE
+                WHEN w.status NOT IN ('online', 'busy') THEN w.status
+                WHEN w.running_tasks + o.tasks > 0 THEN 'busy'
+                ELSE 'online'
+            END,
+            updated_at = :now
+        FROM (
+            SELECT s.worker_uid,
+                SUM(s.delta) AS tasks,
+                SUM(s.delta * COALESCE(CAST(f.resource_requirements->>'cpu' AS float8), 0)) AS cpu,
+                SUM(s.delta * COALESCE(CAST(f.resource_requirements->>'memory' AS integer), 0)) AS memory
+            FROM {source} s
+            LEFT JOIN functions f ON f.uid = s.function_uid
+            WHERE s.worker_uid IS NOT NULL
+            GROUP BY s.worker_uid
+            HAVING SUM(s.delta) != 0
+        ) AS o, occupancy_prev
+        WHERE w.uid = o.worker_uid AND occupancy_prev.uid = o.worker_uid
+        RETURNING w.uid, w.grid_uid, occupancy_prev.status AS old_status, w.status AS new_status
+    )"""
+
+def report_occupancy(rows):
+    """Count the busy transitions of committed occupancy rows in the grid utilization"""
+    for row in rows:
+        utilization.status_changed(row.grid_uid, status_value(row.old_status), status_value(row.new_status))
+
+async def repair_occupancy():
+    """Recount every worker's running tasks, reservations and status from the tasks table, e.g. on engine startup
+
+    Returns the number of workers repaired.
+    """
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            WITH actual AS (
+                SELECT w.uid,
+                    COUNT(t.uid) AS tasks,
+                    COALESCE(SUM(CAST(f.resource_requirements->>'cpu' AS float8)), 0) AS cpu,
+                    COALESCE(SUM(CAST(f.resource_requirements->>'memory' AS integer)), 0) AS memory
+                FROM workers w
+                LEFT JOIN tasks t ON t.worker_uid = w.uid AND t.status = 'running'
+                LEFT JOIN functions f ON f.uid = t.function_uid
+                GROUP BY w.uid
+            )
+            UPDATE workers AS w
+            SET running_tasks = a.tasks,
+                cpu_reserved = a.cpu,
+                memory_reserved = a.memory,
+                status = CASE
+                    WHEN w.status NOT IN ('online', 'busy') THEN w.status
+                    WHEN a.tasks > 0 THEN 'busy'
+                    ELSE 'online'
+                END
+            FROM actual a
+            WHERE w.uid = a.uid
+            AND (
+                w.running_tasks IS DISTINCT FROM a.tasks
+                OR ABS(w.cpu_reserved - a.cpu) > 0.001
+                OR w.memory_reserved IS DISTINCT FROM a.memory
+                OR (w.status = 'busy' AND a.tasks = 0)
+                OR (w.status = 'online' AND a.tasks > 0)
+            )
+            RETURNING w.uid
+            """)
+        )
+        repaired = len(result.fetchall())
+        await session.commit()
+
+    if repaired:
+        logger.warning(f"Repaired the running tasks, reservations and status of {repaired} workers")
+    return repaired
@@ -0,0 +1,240 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from db import get_session
+from lib.occupancy import occupancy_ctes, report_occupancy
+from lib.gang import requeue_gangs
+from lib.limits import function_limits
+
+logger = logging.getLogger(__name__)
+
+# Priority classes of functions, higher classes are claimed first
+PRIORITY_CLASSES = {"low": -1, "normal": 0, "high": 1, "urgent": 2}
+
+# A pending task waiting this long preempts a running task of a lower class
+PREEMPT_AFTER_SECONDS = float(os.environ.get("PREEMPT_AFTER_SECONDS", "30"))
+
+# Seconds a worker has to stop a preempted task, after that it is left to finish
+PREEMPT_ACK_SECONDS = float(os.environ.get("PREEMPT_ACK_SECONDS", "60"))
+
+# Waiting tasks served by preemption per round, and seconds between rounds
+PREEMPT_MAX_PER_ROUND = int(os.environ.get("PREEMPT_MAX_PER_ROUND", "10"))
+PREEMPT_INTERVAL = float(os.environ.get("PREEMPT_INTERVAL", "5"))
+
+def priority_value(priority):
+    """Numeric priority of a class name or number, raises ValueError for anything else"""
+    if priority is None:
+        return PRIORITY_CLASSES["normal"]
+    if isinstance(priority, str) and priority.lower() in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[priority.lower()]
+    try:
+        return int(priority)
+    except (ValueError, TypeError):
+        raise ValueError(f"priority must be one of {', '.join(PRIORITY_CLASSES)} or an integer")
+
+def priority_name(priority):
+    """Class name of a numeric priority, the number itself between classes"""
+    for name, value in PRIORITY_CLASSES.items():
+        if value == priority:
+            return name
+    return priority
+
+class PreemptionRequests:
+    """Running tasks each worker is asked to stop, sent with its heartbeat responses
+
+    Rebuilt from the tasks table every round, so requests survive engine restarts.
+    """
+
+    def __init__(self):
+        self.by_worker = {}
+
+    def load(self, rows):
+        by_worker = {}
+        for row in rows:
+            by_worker.setdefault(row.worker_uid, []).append(row.uid)
+        self.by_worker = by_worker
+
+    def discard(self, worker_uid, task_uid):
+        tasks = self.by_worker.get(worker_uid)
+        if tasks and task_uid in tasks:
+            tasks.remove(task_uid)
+
+    def for_worker(self, worker_uid):
+        return list(self.by_worker.get(worker_uid, []))
+
+preemptions = PreemptionRequests()
+
+async def expire_preemptions(session, now):
+    """Let the preempted tasks their worker didn't stop in time finish, returns the pending requests"""
+    result = await session.execute(
+        text("""
+        UPDATE tasks
+        SET preempt_requested_at = NULL, updated_at = :now
+        WHERE status = 'running'
+        AND preempt_requested_at <= :ack_before
+        RETURNING uid, worker_uid
+        """),
+        {"now": now, "ack_before": now - timedelta(seconds=PREEMPT_ACK_SECONDS)}
+    )
+    for row in result.fetchall():
+        logger.warning(f"Worker {row.worker_uid} didn't stop preempted task {row.uid}, leaving it to finish")
+
+    result = await session.execute(
+        text("SELECT uid, worker_uid FROM tasks WHERE status = 'running' AND preempt_requested_at IS NOT NULL")
+    )
+    return result.fetchall()
+
+async def preempt_tasks():
+    """Ask workers to stop lower class tasks for the tasks waiting past PREEMPT_AFTER_SECONDS
+
+    Each waiting task not covered by an outstanding request picks one running
+    task of a lower class on a worker of its image, the lowest class and most
+    recently started first so the least work is lost. Gang ranks are never
+    preempted. Returns the number of tasks asked to stop.
+    """
+    now = datetime.utcnow()
+    async for session in get_session():
+        pending = await expire_preemptions(session, now)
+
+        # Outstanding requests already free a slot for the first waiting tasks,
+        # and only tasks above the lowest running class can preempt anything
+        result = await session.execute(
+            text("""
+            SELECT uid, priority, docker_image FROM tasks
+            WHERE status = 'pending'
+            AND gang_uid IS NULL
+            AND created_at <= :waited_before
+            AND (lease_expires_at IS NULL OR lease_expires_at <= :now)
+            AND priority > (SELECT COALESCE(MIN(priority), priority) FROM tasks WHERE status = 'running')
+            ORDER BY priority DESC, created_at
+            OFFSET :outstanding
+            LIMIT :limit
+            """),
+            {
+                "now": now,
+                "waited_before": now - timedelta(seconds=PREEMPT_AFTER_SECONDS),
+                "outstanding": len(pending),
+                "limit": PREEMPT_MAX_PER_ROUND
+            }
+        )
+        waiting = result.fetchall()
+        if not waiting:
+            await session.commit()
+            preemptions.load(pending)
+            return 0
+
+        result = await session.execute(
+            text("""
+            SELECT t.uid, t.worker_uid, t.priority, w.spec->>'docker_image' AS docker_image
+            FROM tasks t
+            JOIN workers w ON w.uid = t.worker_uid
+            WHERE t.status = 'running'
+            AND t.gang_uid IS NULL
+            AND t.preempt_requested_at IS NULL
+            AND t.priority < :priority
+            ORDER BY t.priority, t.started_at DESC
+            LIMIT :limit
+            """),
+            {"priority": waiting[0].priority, "limit": PREEMPT_MAX_PER_ROUND * 10}
+        )
+        candidates = result.fetchall()
+
+        victims = []
+        for task in waiting:
+            for victim in candidates:
+                if victim.priority < task.priority and (task.docker_image is None or task.docker_image == victim.docker_image):
+                    victims.append(victim.uid)
+                    candidates.remove(victim)
+                    break
+
+        requested = []
+        if victims:
+            result = await session.execute(
+                text("""
+                UPDATE tasks
+                SET preempt_requested_at = :now, updated_at = :now
+                WHERE uid = ANY(CAST(:uids AS text[]))
+                AND status = 'running'
+                AND preempt_requested_at IS NULL
+                RETURNING uid, worker_uid
+                """),
+                {"now": now, "uids": victims}
+            )
+            requested = result.fetchall()
+        await session.commit()
+
+    preemptions.load(list(pending) + list(requested))
+    for row in requested:
+        logger.info(f"Preempting task {row.uid} on worker {row.worker_uid} for higher priority work")
+    return len(requested)
+
+async def requeue_preempted_task(task_uid, worker_uid, checkpoint=None):
+    """Put a task its worker stopped back in the queue, keeping its checkpoint
+
+    The task is pending again without a failure or error, so it doesn't count
+    as a failed attempt, and it keeps its place in its class's queue. A gang
+    rank requeues its whole gang. Returns False if the task isn't running
+    on the worker.
+    """
+    async for session in get_session():
+        result = await session.execute(
+            text(f"""
+            WITH prev AS (
+                SELECT uid, worker_uid FROM tasks
+                WHERE uid = :task_uid AND worker_uid = :worker_uid AND status = 'running'
+                FOR UPDATE
+            ),
+            requeued AS (
+                UPDATE tasks
+                SET status = 'pending',
+                    worker_uid = NULL,
+                    started_at = NULL,
+                    lease_expires_at = NULL,
+                    preempt_requested_at = NULL,
+                    preemptions = tasks.preemptions + 1,
+                    data = CASE WHEN CAST(:checkpoint AS text) IS NULL THEN tasks.data
+                        ELSE (COALESCE(CAST(tasks.data AS jsonb), '{{}}'::jsonb)
+                            || jsonb_build_object('checkpoint', CAST(:checkpoint AS jsonb)))::json
+                    END,
+                    updated_at = :now
+                FROM prev
+                WHERE tasks.uid = prev.uid
+                RETURNING prev.worker_uid, tasks.function_uid, tasks.gang_uid, -1 AS delta
+            ),{occupancy_ctes("requeued")}
+            SELECT (SELECT COUNT(*) FROM requeued) AS requeued, (SELECT gang_uid FROM requeued) AS gang_uid,
+                (SELECT function_uid FROM requeued) AS function_uid, o.grid_uid, o.old_status, o.new_status
+            FROM (SELECT 1) AS one
+            LEFT JOIN occupancy o ON TRUE
+            """),
+            {
+                "task_uid": task_uid,
+                "worker_uid": worker_uid,
+                "checkpoint": None if checkpoint is None else json.dumps(checkpoint),
+                "now": datetime.utcnow()
+            }
+        )
+        row = result.fetchone()
+        _, occupancy = await requeue_gangs(session, [row.gang_uid], datetime.utcnow())
+        await session.commit()
+
+    preemptions.discard(worker_uid, task_uid)
+    if not row.requeued:
+        logger.error(f"Task {task_uid} is not running on worker {worker_uid}, not requeued")
+        return False
+    report_occupancy([row] + occupancy)
+    if row.gang_uid is None:
+        function_limits.finished(row.function_uid)
+    logger.info(f"Requeued task {task_uid} preempted on worker {worker_uid}{' with a checkpoint' if checkpoint is not None else ''}")
+    return True
+
+async def run_preemptor():
+    """Preempt lower class tasks for the waiting higher class ones every PREEMPT_INTERVAL"""
+    while True:
+        await asyncio.sleep(PREEMPT_INTERVAL)
+        try:
+            await preempt_tasks()
+        except Exception as e:
+            logger.error(f"Error preempting tasks: {e}")
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from uuid import uuid4
+from datetime import datetime
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+WORKER_INSERT_BATCH = int(os.environ.get("WORKER_INSERT_BATCH", "5000"))
+
+# Deployment failures kept per provisioning run for display
+MAX_PROVISIONING_ERRORS = 20
+
+class ProvisioningProgress:
+    """Progress of creating and deploying a set of workers"""
+
+    def __init__(self, grid_uid, total):
+        self.grid_uid = grid_uid
+        self.total = total
+        self.created = 0
+        self.deployed = 0
+        self.failed = 0
+        self.errors = []
+        self.state = "creating"
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def fail(self, worker, error):
+        self.failed += 1
+        if len(self.errors) < MAX_PROVISIONING_ERRORS:
+            self.errors.append({"worker_uid": worker["uid"], "name": worker["name"], "error": error})
+
+    def finish(self, state):
+        self.state = state
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        done = self.deployed + self.failed
+        rate = done / elapsed if elapsed > 0 else 0
+        remaining = self.created - done
+        return {
+            "grid_uid": self.grid_uid,
+            "state": self.state,
+            "total": self.total,
+            "created": self.created,
+            "deployed": self.deployed,
+            "failed": self.failed,
+            "errors": self.errors,
+            "elapsed_seconds": round(elapsed, 1),
+            "workers_per_second": round(rate, 2),
+            "eta_seconds": round(remaining / rate, 1) if rate and self.finished_at is None else None
+        }
+
+# Latest provisioning run of each grid
+provisioning = {}
+
+def new_worker(name, grid_uid, data, slot=None, pool_key=None, group_ordinal=None):
+    """Worker row with the resources and image requested in data, at an optional (x, y) grid slot
+
+    Warm pool workers have a pool_key instead of a grid, worker group
+    replicas (see lib/workergroup.py) the ordinal of their pod.
+    """
+    cpu_total = float(data.get("cpu_total", 4.0))
+    memory_total = int(data.get("memory_total", 8192))
+    return {
+        "uid": str(uuid4()),
+        "name": name,
+        "grid_uid": grid_uid,
+        "cpu_total": cpu_total,
+        "memory_total": memory_total,
+        "gpu_id": data.get("gpu_id"),
+        "gpu_memory": data.get("gpu_memory"),
+        "grid_x": slot[0] if slot else None,
+        "grid_y": slot[1] if slot else None,
+        "pool_key": pool_key,
+        "group_ordinal": group_ordinal,
+        "status": "offline",
+        "spec": {
+            "docker_image": data.get("docker_image", "python:3.11-slim"),
+            "os": data.get("os", "linux"),
+            "arch": data.get("arch", "x86_64"),
+            "node_type": data.get("node_type", "standard")
+        }
+    }
+
+async def insert_workers(workers, session):
+    """Insert worker rows, one INSERT per WORKER_INSERT_BATCH workers"""
+    now = datetime.utcnow()
+    for start in range(0, len(workers), WORKER_INSERT_BATCH):
+        batch = workers[start:start + WORKER_INSERT_BATCH]
+        await session.execute(
+            text("""
+            INSERT INTO workers (
+                uid, name, grid_uid, cpu_total, cpu_available, memory_total, memory_available,
+                gpu_id, gpu_memory, grid_x, grid_y, pool_key, group_ordinal, status, spec, created_at, updated_at
+            )
+            SELECT w.uid, w.name, w.grid_uid, w.cpu_total, w.cpu_total, w.memory_total, w.memory_total,
+                w.gpu_id, w.gpu_memory, w.grid_x, w.grid_y, w.pool_key, w.group_ordinal, CAST('offline' AS workerstatus), CAST(w.spec AS json), :now, :now
+            FROM unnest(
+                CAST(:uids AS text[]),
+                CAST(:names AS text[]),
+                CAST(:grid_uids AS text[]),
+                CAST(:cpu_totals AS float8[]),
+                CAST(:memory_totals AS integer[]),
+                CAST(:gpu_ids AS text[]),
+                CAST(:gpu_memories AS integer[]),
+                CAST(:grid_xs AS integer[]),
+                CAST(:grid_ys AS integer[]),
+                CAST(:pool_keys AS text[]),
+                CAST(:group_ordinals AS integer[]),
+                CAST(:specs AS text[])
+            ) AS w(uid, name, grid_uid, cpu_total, memory_total, gpu_id, gpu_memory, grid_x, grid_y, pool_key, group_ordinal, spec)
+            """),
+            {
+                "uids": [w["uid"] for w in batch],
+                "names": [w["name"] for w in batch],
+                "grid_uids": [w["grid_uid"] for w in batch],
+                "cpu_totals": [w["cpu_total"] for w in batch],
+                "memory_totals": [w["memory_total"] for w in batch],
+                "gpu_ids": [w["gpu_id"] for w in batch],
+                "gpu_memories": [w["gpu_memory"] for w in batch],
+                "grid_xs": [w["grid_x"] for w in batch],
+                "grid_ys": [w["grid_y"] for w in batch],
+                "pool_keys": [w.get("pool_key") for w in batch],
+                "group_ordinals": [w.get("group_ordinal") for w in batch],
+                "specs": [json.dumps(w["spec"]) for w in batch],
+                "now": now
+            }
+        )
+
+async def deploy_workers(workers, progress):
+    """Queue the deployment of workers and record each outcome in progress as it comes"""
+    from lib.k8ssdk import deployment_queue
+
+    try:
+        futures = await deployment_queue.submit("deploy", workers)
+    except Exception as e:
+        logger.error(f"Error queueing the deployment of {len(workers)} workers: {e}")
+        for worker in workers:
+            progress.fail(worker, str(e))
+        return
+
+    def record(worker, future):
+        error = future.result()
+        if error is None:
+            progress.deployed += 1
+        else:
+            progress.fail(worker, error)
+
+    for worker in workers:
+        futures[worker["uid"]].add_done_callback(lambda future, worker=worker: record(worker, future))
+    await asyncio.gather(*futures.values())
+
+async def provision_workers(workers, progress, deploy=True):
+    """Deploy already inserted workers and record the outcome in progress"""
+    progress.state = "deploying" if deploy else "created"
+    if deploy and workers:
+        await deploy_workers(workers, progress)
+
+    state = "failed" if workers and progress.failed == len(workers) else "done"
+    progress.finish(state)
+    logger.info(
+        f"Provisioned {progress.created} workers for grid {progress.grid_uid}: "
+        f"{progress.deployed} deployed, {progress.failed} failed in {progress.to_dict()['elapsed_seconds']}s"
+    )
+    return progress
+
+def get_provisioning_progress(grid_uid):
+    """Progress of the latest provisioning run of a grid"""
+    progress = provisioning.get(grid_uid)
+    return progress.to_dict() if progress else None
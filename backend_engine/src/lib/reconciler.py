@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import collections
+from datetime import datetime
+from sqlalchemy import text
+from db import get_session
+from lib.k8ssdk import K8S_ENABLED, KubeAPIError, get_kube_api, deployment_queue
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_ENABLED = os.environ.get("RECONCILE_ENABLED", str(K8S_ENABLED)).lower() == "true"
+
+# Changes seen within this many seconds are reconciled together
+RECONCILE_INTERVAL = float(os.environ.get("RECONCILE_INTERVAL", "2"))
+RECONCILE_BATCH = int(os.environ.get("RECONCILE_BATCH", "1000"))
+
+# A worker is repaired (redeployed, or its orphaned StatefulSet deleted) at most once in this many seconds
+RECONCILE_REPAIR_SECONDS = float(os.environ.get("RECONCILE_REPAIR_SECONDS", "300"))
+
+# The API server ends each watch after this many seconds, it is resumed from the last resource version
+WATCH_TIMEOUT_SECONDS = int(os.environ.get("WATCH_TIMEOUT_SECONDS", "300"))
+WATCH_RETRY_SECONDS = float(os.environ.get("WATCH_RETRY_SECONDS", "10"))
+
+WORKER_SELECTOR = "app=vinci4d-worker"
+WORKER_PREFIX = "vinci4dworker-"
+
+def worker_of(statefulset):
+    """Worker UID, name and grid UID of a worker StatefulSet"""
+    metadata = statefulset.get("metadata", {})
+    labels = metadata.get("labels") or {}
+    # StatefulSets deployed before the worker label was added only carry it in their selector
+    match_labels = statefulset.get("spec", {}).get("selector", {}).get("matchLabels") or {}
+    worker_uid = labels.get("worker") or match_labels.get("worker")
+    name = metadata.get("name", "")
+    if name.startswith(WORKER_PREFIX):
+        name = name[len(WORKER_PREFIX):]
+    return worker_uid, name, labels.get("grid")
+
+def observed_state(statefulset):
+    """State of a worker StatefulSet: terminating, stopped, ready or progressing"""
+    if statefulset.get("metadata", {}).get("deletionTimestamp"):
+        return "terminating"
+    replicas = statefulset.get("spec", {}).get("replicas", 1)
+    if replicas == 0:
+        return "stopped"
+    if (statefulset.get("status") or {}).get("readyReplicas", 0) >= replicas:
+        return "ready"
+    return "progressing"
+
+Observed = collections.namedtuple("Observed", ["state", "name", "grid_uid"])
+
+class Reconciler:
+    """Keeps the workers table and the worker StatefulSets of the cluster in line
+
+    A watch thread follows the StatefulSets and records the state of each
+    worker's one. The workers whose StatefulSet changed, or whose deployment
+    was given up on, are reconciled in batches: their observed_state is
+    written, workers whose StatefulSet disappeared are redeployed, and
+    StatefulSets left without a worker row are deleted. Only a (re)list,
+    at startup or when the watch expired, looks at the whole fleet.
+    """
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace or os.environ.get("K8S_NAMESPACE", "default")
+        self.observed = {}
+        self.dirty = set()
+        self.retries = []
+        self.resync = False
+        self.resource_version = None
+        self.stats = collections.Counter()
+
+    def observe(self, event_type, statefulset):
+        """Record a watch event, marking the worker dirty if its state changed"""
+        worker_uid, name, grid_uid = worker_of(statefulset)
+        if not worker_uid:
+            return
+        if event_type == "DELETED":
+            changed = self.observed.pop(worker_uid, None) is not None
+        else:
+            observed = Observed(observed_state(statefulset), name, grid_uid)
+            changed = self.observed.get(worker_uid) != observed
+            self.observed[worker_uid] = observed
+        if changed:
+            self.dirty.add(worker_uid)
+            self.stats["events"] += 1
+
+    def relisted(self, statefulsets):
+        """Replace the observed StatefulSets with a full listing and check every worker at the next pass"""
+        previous = self.observed
+        self.observed = {}
+        for statefulset in statefulsets:
+            worker_uid, name, grid_uid = worker_of(statefulset)
+            if worker_uid:
+                self.observed[worker_uid] = Observed(observed_state(statefulset), name, grid_uid)
+        self.dirty |= set(previous) | set(self.observed)
+        self.resync = True
+        self.stats["relists"] += 1
+
+    def mark(self, worker_uids):
+        """Reconcile workers at the next pass, for changes made outside the watched StatefulSets"""
+        self.dirty.update(worker_uids)
+
+    def watch_forever(self, loop):
+        """Follow the worker StatefulSets, (re)listing them when there is no valid resource version
+
+        Runs in its own thread, events are handed to the event loop.
+        """
+        while True:
+            try:
+                api = get_kube_api()
+                if self.resource_version is None:
+                    listing = api.get("apps/v1", "StatefulSet", self.namespace, label_selector=WORKER_SELECTOR)
+                    loop.call_soon_threadsafe(self.relisted, listing.get("items", []))
+                    self.resource_version = listing["metadata"]["resourceVersion"]
+
+                for event in api.watch(
+                    "apps/v1", "StatefulSet", self.namespace, self.resource_version,
+                    label_selector=WORKER_SELECTOR, timeout_seconds=WATCH_TIMEOUT_SECONDS
+                ):
+                    obj = event.get("object") or {}
+                    if event["type"] == "ERROR":
+                        if obj.get("code") == 410:
+                            logger.info("StatefulSet watch expired, listing them again")
+                            self.resource_version = None
+                            break
+                        raise KubeAPIError(obj.get("code", 500), obj.get("message", "watch error"))
+
+                    self.resource_version = obj["metadata"]["resourceVersion"]
+                    if event["type"] != "BOOKMARK":
+                        loop.call_soon_threadsafe(self.observe, event["type"], obj)
+            except Exception as e:
+                logger.error(f"Error watching worker StatefulSets: {e}")
+                time.sleep(WATCH_RETRY_SECONDS)
+
+    async def mark_unobserved_workers(self):
+        """Mark the workers without an observed StatefulSet, after a relist
+
+        Worker group replicas have no StatefulSet of their own and are left out.
+        """
+        async for session in get_session():
+            result = await session.execute(
+                text("SELECT uid FROM workers WHERE group_ordinal IS NULL AND NOT (uid = ANY(CAST(:uids AS text[])))"),
+                {"uids": list(self.observed)}
+            )
+            self.mark(row.uid for row in result.fetchall())
+
+    def take(self):
+        """Dirty workers and the ones whose repair cooldown ended"""
+        now = time.monotonic()
+        while self.retries and self.retries[0][0] <= now:
+            self.dirty.add(heapq.heappop(self.retries)[1])
+        dirty, self.dirty = self.dirty, set()
+        return list(dirty)
+
+    async def reconcile(self):
+        """Reconcile the dirty workers, returns the number of repairs queued"""
+        if self.resync:
+            try:
+                await self.mark_unobserved_workers()
+                self.resync = False
+            except Exception as e:
+                logger.error(f"Error listing the workers to resync: {e}")
+
+        worker_uids = self.take()
+        repairs = 0
+        for start in range(0, len(worker_uids), RECONCILE_BATCH):
+            batch = worker_uids[start:start + RECONCILE_BATCH]
+            try:
+                repairs += await self.reconcile_batch(batch)
+            except Exception as e:
+                logger.error(f"Error reconciling {len(batch)} workers: {e}")
+                self.mark(batch)
+        return repairs
+
+    async def reconcile_batch(self, worker_uids):
+        now = datetime.utcnow()
+        async for session in get_session():
+            result = await session.execute(
+                text("""
+                SELECT d.uid AS dirty_uid, w.uid, w.name, w.grid_uid, w.cpu_total, w.memory_total,
+                    w.gpu_id, w.gpu_memory, w.spec, w.observed_state,
+                    EXISTS (
+                        SELECT 1 FROM deployment_jobs j
+                        WHERE j.worker_uid = d.uid AND j.status IN ('pending', 'running')
+                    ) AS active_job,
+                    (SELECT MAX(j.created_at) FROM deployment_jobs j WHERE j.worker_uid = d.uid) AS last_job_at,
+                    EXISTS (
+                        SELECT 1 FROM deployment_jobs j
+                        WHERE j.worker_uid = d.uid AND j.action = 'deploy'
+                    ) AS deployed
+                FROM unnest(CAST(:uids AS text[])) AS d(uid)
+                LEFT JOIN workers w ON w.uid = d.uid
+                """),
+                {"uids": worker_uids}
+            )
+            rows = result.fetchall()
+
+            updates, redeploy, orphans = [], [], []
+            for row in rows:
+                observed = self.observed.get(row.dirty_uid)
+                state = observed.state if observed else "missing"
+
+                if row.uid is not None and row.observed_state != state:
+                    updates.append((row.uid, state))
+                # Queued deploys and deletes are already converging, leave them be
+                if row.active_job:
+                    continue
+
+                cooldown = 0
+                if row.last_job_at is not None:
+                    cooldown = RECONCILE_REPAIR_SECONDS - (now - row.last_job_at).total_seconds()
+
+                if row.uid is None and observed and observed.state != "terminating":
+                    if cooldown > 0:
+                        heapq.heappush(self.retries, (time.monotonic() + cooldown, row.dirty_uid))
+                    else:
+                        orphans.append({"uid": row.dirty_uid, "name": observed.name, "grid_uid": observed.grid_uid})
+                elif row.uid is not None and state == "missing" and (row.deployed or row.observed_state not in (None, "missing")):
+                    # Only workers that were deployed once, auto_deploy=False workers have no StatefulSet on purpose
+                    if cooldown > 0:
+                        heapq.heappush(self.retries, (time.monotonic() + cooldown, row.dirty_uid))
+                    else:
+                        redeploy.append({
+                            "uid": row.uid,
+                            "name": row.name,
+                            "grid_uid": row.grid_uid,
+                            "cpu_total": row.cpu_total,
+                            "memory_total": row.memory_total,
+                            "gpu_id": row.gpu_id,
+                            "gpu_memory": row.gpu_memory,
+                            "spec": json.loads(row.spec) if isinstance(row.spec, str) else row.spec
+                        })
+
+            if updates:
+                await session.execute(
+                    text("""
+                    UPDATE workers AS w
+                    SET observed_state = o.state, observed_at = :now
+                    FROM unnest(CAST(:uids AS text[]), CAST(:states AS text[])) AS o(uid, state)
+                    WHERE w.uid = o.uid
+                    """),
+                    {"uids": [uid for uid, _ in updates], "states": [state for _, state in updates], "now": now}
+                )
+                await session.commit()
+
+        if redeploy:
+            logger.info(f"Redeploying {len(redeploy)} workers whose StatefulSet is missing")
+            await deployment_queue.submit("deploy", redeploy, self.namespace)
+        if orphans:
+            logger.info(f"Deleting {len(orphans)} StatefulSets of workers that no longer exist")
+            await deployment_queue.submit("delete", orphans, self.namespace)
+
+        self.stats["reconciled"] += len(worker_uids)
+        self.stats["observed_updates"] += len(updates)
+        self.stats["redeployed"] += len(redeploy)
+        self.stats["orphans_deleted"] += len(orphans)
+        return len(redeploy) + len(orphans)
+
+    async def run(self):
+        """Start the watch thread and reconcile changes every RECONCILE_INTERVAL"""
+        loop = asyncio.get_running_loop()
+        deployment_queue.failure_listeners.append(self.mark)
+        threading.Thread(target=self.watch_forever, args=(loop,), name="statefulset-watch", daemon=True).start()
+
+        while True:
+            await asyncio.sleep(RECONCILE_INTERVAL)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Error reconciling workers: {e}")
+
+reconciler = Reconciler()
+
+async def run_reconciler():
+    """Reconcile workers with the cluster, unless RECONCILE_ENABLED is false"""
+    if RECONCILE_ENABLED:
+        await reconciler.run()
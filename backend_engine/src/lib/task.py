@@ -1,11 +1,19 @@
 import logging
 from sqlalchemy import text
-from datetime import datetime
+from datetime import datetime, timedelta
 from db import Task, TaskStatus, get_session
+from lib.topology import TOPOLOGY_RADIUS, TOPOLOGY_STEAL_SECONDS, locality
+from lib.occupancy import occupancy_ctes, report_occupancy
+from lib.limits import LIMITS_SCAN_FACTOR, function_limits
 import json
+import os
 
 logger = logging.getLogger(__name__)
 
+# Prefetched tasks are leased to a worker until it starts them
+PREFETCH_MAX_PER_WORKER = int(os.environ.get("PREFETCH_MAX_PER_WORKER", "2"))
+PREFETCH_LEASE_SECONDS = int(os.environ.get("PREFETCH_LEASE_SECONDS", "60"))
+
 async def get_all_tasks(filters=None):
     """Get all tasks from the database with optional filters"""
     tasks_list = []
@@ -66,6 +74,9 @@ async def get_task_by_uid(uid):
             "status": task.status if not hasattr(task.status, 'value') else task.status.value,
             "result": task.result,
             "error": task.error,
+            "gang_uid": task.gang_uid,
+            "priority": task.priority,
+            "preemptions": task.preemptions,
             "created_at": task.created_at.isoformat() if task.created_at else None,
             "updated_at": task.updated_at.isoformat() if task.updated_at else None,
             "started_at": task.started_at.isoformat() if task.started_at else None,
@@ -100,55 +111,234 @@ async def create_new_task(data):
             "created_at": task.created_at.isoformat()
         }
 
-async def assign_task_to_worker(worker_uid):
-    """Assign a task to a worker"""
-    try:
-        async for session in get_session():
-            # First, find a pending task
+def get_task_inputs(task_data):
+    """Extract the inputs from task data (batched tasks use 'inputs', single tasks 'input')"""
+    if isinstance(task_data, str):
+        task_data = json.loads(task_data)
+    if not task_data or not isinstance(task_data, dict):
+        return []
+    if 'inputs' in task_data:
+        return task_data.get('inputs') or []
+    return task_data.get('input') or []
+
+def get_task_checkpoint(task_data):
+    """Checkpoint a preempted task left to resume from, None if it has none"""
+    if isinstance(task_data, str):
+        task_data = json.loads(task_data)
+    if not task_data or not isinstance(task_data, dict):
+        return None
+    return task_data.get('checkpoint')
+
+async def assign_tasks_to_worker(worker_uid, count=1, prefetch=False):
+    """Assign up to count pending tasks to a worker in one statement
+
+    Tasks are claimed as running, or with prefetch only leased to the worker
+    until it starts them (see start_leased_task). Running tasks make the
+    worker busy in the same statement, see lib/occupancy.py. Functions at
+    their concurrency or rate limit are skipped, see lib/limits.py.
+    """
+    async for session in get_session():
+        now = datetime.utcnow()
+
+        if prefetch:
+            # Cap the leased but not yet started tasks per worker, and never lease
+            # more than a fair share of the backlog so other workers don't starve
+            # Both counted among the tasks and workers of the worker's image
             result = await session.execute(
-                text("SELECT * FROM tasks WHERE status = 'pending' LIMIT 1")
-            )
-            task_row = result.fetchone()
-            
-            if not task_row:
-                # No pending tasks found
-                return {"error": "No pending tasks available"}
-            
-            # Get task data before updating
-            task_uid = task_row.uid
-            function_uid = task_row.function_uid
-            task_data = task_row.data if hasattr(task_row, 'data') else {}
-            
-            # Extract inputs from task data
-            inputs = []
-            if task_data and isinstance(task_data, dict) and 'input' in task_data:
-                inputs = task_data.get('input', [])
-            
-            # Update the task using SQL instead of trying to modify the Row object
-            await session.execute(
                 text("""
-                UPDATE tasks 
-                SET worker_uid = :worker_uid, 
-                    status = 'running',
-                    started_at = :now,
-                    updated_at = :now
-                WHERE uid = :task_uid
+                WITH me AS (
+                    SELECT spec->>'docker_image' AS docker_image FROM workers WHERE uid = :worker_uid
+                )
+                SELECT
+                    (SELECT COUNT(*) FROM tasks
+                     WHERE status = 'pending' AND worker_uid = :worker_uid
+                     AND lease_expires_at > :now) AS leased,
+                    (SELECT COUNT(*) FROM tasks
+                     WHERE status = 'pending' AND gang_uid IS NULL
+                     AND (docker_image IS NULL OR docker_image = (SELECT docker_image FROM me))
+                     AND (lease_expires_at IS NULL OR lease_expires_at <= :now)) AS backlog,
+                    (SELECT COUNT(*) FROM workers
+                     WHERE status IN ('online', 'busy')
+                     AND spec->>'docker_image' = (SELECT docker_image FROM me)) AS active_workers
+                """),
+                {"worker_uid": worker_uid, "now": now}
+            )
+            counts = result.fetchone()
+            fair_share = counts.backlog // max(counts.active_workers, 1)
+            count = min(count, PREFETCH_MAX_PER_WORKER - counts.leased, fair_share)
+            if count <= 0:
+                return []
+
+            set_clause = "lease_expires_at = :lease_expires_at"
+            occupancy = ""
+            occupancy_join = "LEFT JOIN (SELECT NULL AS grid_uid, NULL AS old_status, NULL AS new_status) o ON TRUE"
+        else:
+            set_clause = "status = 'running', started_at = :now, lease_expires_at = NULL, preempt_requested_at = NULL"
+            occupancy = "," + occupancy_ctes("started")
+            occupancy_join = "LEFT JOIN occupancy o ON TRUE"
+
+        # Functions at their limit are skipped, functions that can only take part of
+        # the claim get at most their allowance of the tasks scanned
+        grants = function_limits.acquire(count)
+        blocked = [uid for uid, allowance in grants.items() if allowance <= 0]
+        partial = {uid: allowance for uid, allowance in grants.items() if 0 < allowance < count}
+        claimed_per_function = {}
+
+        try:
+            # Claim the oldest pending tasks of the highest priority class that are not
+            # leased to another worker, skipping rows other workers are claiming. Tiled tasks are only claimed
+            # around their grid slot, until they waited TOPOLOGY_STEAL_SECONDS.
+            # Idle warm pool workers claim nothing until they are bound to a grid, and
+            # tasks of a function with an image only go to workers running that image.
+            # Gang ranks are only handed out by lib/gang.py once their gang is released
+            result = await session.execute(
+                text(f"""
+                WITH me AS (
+                    SELECT grid_uid, grid_x, grid_y, pool_key, spec->>'docker_image' AS docker_image
+                    FROM workers WHERE uid = :worker_uid
+                ),
+                scanned AS (
+                    SELECT t.uid, t.function_uid, t.priority, t.created_at,
+                        CASE
+                            WHEN t.slot_x IS NULL THEN 0
+                            WHEN f.grid_uid = me.grid_uid THEN GREATEST(ABS(t.slot_x - me.grid_x), ABS(t.slot_y - me.grid_y))
+                        END AS distance
+                    FROM tasks t
+                    LEFT JOIN functions f ON f.uid = t.function_uid
+                    LEFT JOIN me ON TRUE
+                    WHERE t.status = 'pending'
+                    AND t.gang_uid IS NULL
+                    AND me.pool_key IS NULL
+                    AND (t.function_uid IS NULL OR t.function_uid <> ALL(CAST(:blocked AS text[])))
+                    AND (t.docker_image IS NULL OR t.docker_image = me.docker_image)
+                    AND (t.lease_expires_at IS NULL OR t.lease_expires_at <= :now)
+                    AND (
+                        t.slot_x IS NULL
+                        OR (f.grid_uid = me.grid_uid
+                            AND t.slot_x BETWEEN me.grid_x - :radius AND me.grid_x + :radius
+                            AND t.slot_y BETWEEN me.grid_y - :radius AND me.grid_y + :radius)
+                        OR t.created_at <= :steal_before
+                    )
+                    ORDER BY t.priority DESC, distance NULLS LAST, t.created_at
+                    LIMIT :scan
+                    FOR UPDATE OF t SKIP LOCKED
+                ),
+                allowed AS (
+                    SELECT s.*, a.allowance,
+                        row_number() OVER (PARTITION BY s.function_uid ORDER BY s.priority DESC, s.distance NULLS LAST, s.created_at) AS nth
+                    FROM scanned s
+                    LEFT JOIN unnest(CAST(:partial_uids AS text[]), CAST(:partial_allowances AS integer[]))
+                        AS a(function_uid, allowance) ON a.function_uid = s.function_uid
+                ),
+                claimed AS (
+                    UPDATE tasks
+                    SET worker_uid = :worker_uid,
+                        {set_clause},
+                        updated_at = :now
+                    WHERE uid IN (
+                        SELECT uid FROM allowed
+                        WHERE allowance IS NULL OR nth <= allowance
+                        ORDER BY priority DESC, distance NULLS LAST, created_at
+                        LIMIT :count
+                    )
+                    RETURNING uid, function_uid, data, slot_x, slot_y,
+                        (SELECT grid_uid FROM functions WHERE functions.uid = tasks.function_uid) AS task_grid_uid
+                ),
+                started AS (
+                    SELECT :worker_uid AS worker_uid, function_uid, 1 AS delta FROM claimed
+                ){occupancy}
+                SELECT c.*, me.grid_uid AS worker_grid_uid, me.grid_x AS worker_x, me.grid_y AS worker_y,
+                    o.grid_uid, o.old_status, o.new_status
+                FROM claimed c
+                LEFT JOIN me ON TRUE
+                {occupancy_join}
                 """),
                 {
                     "worker_uid": worker_uid,
-                    "now": datetime.utcnow(),
-                    "task_uid": task_uid
+                    "now": now,
+                    "lease_expires_at": now + timedelta(seconds=PREFETCH_LEASE_SECONDS),
+                    "count": count,
+                    "radius": TOPOLOGY_RADIUS,
+                    "steal_before": now - timedelta(seconds=TOPOLOGY_STEAL_SECONDS),
+                    "blocked": blocked,
+                    "partial_uids": list(partial),
+                    "partial_allowances": list(partial.values()),
+                    "scan": count * LIMITS_SCAN_FACTOR if partial else count
                 }
             )
-            
+            rows = result.fetchall()
+
             await session.commit()
-            
-            # Return the function_uid and inputs for the worker
-            return {
+            for row in rows:
+                claimed_per_function[row.function_uid] = claimed_per_function.get(row.function_uid, 0) + 1
+        finally:
+            function_limits.release(grants, claimed_per_function)
+
+        # Every row carries the claiming worker's transition
+        report_occupancy(rows[:1])
+
+        for row in rows:
+            distance = None
+            if row.slot_x is not None:
+                distance = TOPOLOGY_RADIUS + 1
+                if row.worker_x is not None and row.task_grid_uid == row.worker_grid_uid:
+                    distance = max(abs(row.slot_x - row.worker_x), abs(row.slot_y - row.worker_y))
+            locality.record(row.worker_grid_uid, distance)
+
+        # Return the function_uid, inputs and checkpoint of each task for the worker
+        return [
+            {
+                "task_uid": row.uid,
+                "function_uid": row.function_uid,
+                "inputs": get_task_inputs(row.data),
+                "checkpoint": get_task_checkpoint(row.data)
+            }
+            for row in rows
+        ]
+
+async def start_leased_task(task_uid, worker_uid):
+    """Start a task leased to a worker, returns False if the lease was lost"""
+    async for session in get_session():
+        result = await session.execute(
+            text(f"""
+            WITH started AS (
+                UPDATE tasks
+                SET status = 'running',
+                    started_at = :now,
+                    lease_expires_at = NULL,
+                    preempt_requested_at = NULL,
+                    updated_at = :now
+                WHERE uid = :task_uid
+                AND worker_uid = :worker_uid
+                AND status = 'pending'
+                RETURNING worker_uid, function_uid, 1 AS delta
+            ),{occupancy_ctes("started")}
+            SELECT (SELECT COUNT(*) FROM started) AS started, o.grid_uid, o.old_status, o.new_status
+            FROM (SELECT 1) AS one
+            LEFT JOIN occupancy o ON TRUE
+            """),
+            {
                 "task_uid": task_uid,
-                "function_uid": function_uid,
-                "inputs": inputs
+                "worker_uid": worker_uid,
+                "now": datetime.utcnow()
             }
+        )
+        row = result.fetchone()
+        await session.commit()
+
+        report_occupancy([row])
+        return row.started == 1
+
+async def assign_task_to_worker(worker_uid):
+    """Assign a task to a worker"""
+    try:
+        tasks = await assign_tasks_to_worker(worker_uid, 1)
+
+        if not tasks:
+            # No pending tasks found
+            return {"error": "No pending tasks available"}
+
+        return tasks[0]
     except Exception as e:
         logger.error(f"Error assigning task to worker {worker_uid}: {e}")
         import traceback
@@ -156,7 +346,13 @@ async def assign_task_to_worker(worker_uid):
         return {"error": str(e)}
 
 async def update_task_status(task_uid, status, result=None, error=None, worker_uid=None):
-    """Update a task's status and result"""
+    """Update a task's status and result
+
+    With a worker_uid only a task running on or leased to that worker is
+    updated (a prefetched task can fail while it is prepared), so a worker
+    reporting a task that was requeued or preempted meanwhile can't
+    overwrite its next run. Returns None for such stale reports.
+    """
     try:
         async for session in get_session():
             # Build update query
@@ -179,19 +375,51 @@ async def update_task_status(task_uid, status, result=None, error=None, worker_u
                 update_clauses.append("error = :error")
                 params["error"] = error
             
+            owner_clause = ""
             if worker_uid is not None:
-                update_clauses.append("worker_uid = :worker_uid")
+                owner_clause = "AND worker_uid = :worker_uid AND status IN ('running', 'pending')"
                 params["worker_uid"] = worker_uid
             
-            # Execute update
+            # Execute update, a task that starts or stops running changes its worker's occupancy
             query = f"""
-                UPDATE tasks 
-                SET {', '.join(update_clauses)}
-                WHERE uid = :task_uid
+                WITH prev AS (
+                    SELECT uid, status, worker_uid FROM tasks
+                    WHERE uid = :task_uid {owner_clause}
+                    FOR UPDATE
+                ),
+                updated AS (
+                    UPDATE tasks
+                    SET {', '.join(update_clauses)}
+                    FROM prev
+                    WHERE tasks.uid = prev.uid
+                    RETURNING tasks.function_uid, tasks.status, tasks.worker_uid,
+                        prev.status AS old_status, prev.worker_uid AS old_worker_uid
+                ),
+                transitions AS (
+                    SELECT old_worker_uid AS worker_uid, function_uid, -1 AS delta FROM updated WHERE old_status = 'running'
+                    UNION ALL
+                    SELECT worker_uid, function_uid, 1 AS delta FROM updated WHERE status = 'running'
+                ),{occupancy_ctes("transitions")}
+                SELECT u.function_uid, u.status AS task_status, u.old_status AS task_old_status,
+                    u.old_worker_uid, o.grid_uid, o.old_status, o.new_status
+                FROM updated u
+                LEFT JOIN occupancy o ON TRUE
             """
+            params["now"] = params["updated_at"]
             
-            await session.execute(text(query), params)
+            result = await session.execute(text(query), params)
+            rows = result.fetchall()
             await session.commit()
+            if not rows:
+                owner = f" running on or leased to worker {worker_uid}" if worker_uid is not None else ""
+                logger.warning(f"Task {task_uid} not found{owner}, ignoring its {status} report")
+                return None
+            report_occupancy([row for row in rows if row.grid_uid is not None])
+            # Running and leased tasks hold a concurrency slot, see lib/limits.py
+            reported = rows[0]
+            if reported.old_worker_uid is not None and reported.task_old_status in ("running", "pending") \
+                    and reported.task_status not in ("running", "pending"):
+                function_limits.finished(reported.function_uid)
             
             # If task is completed or failed, update function status if all tasks are done
             if status in ["completed", "failed"]:
@@ -0,0 +1,168 @@
+import os
+import logging
+import collections
+from sqlalchemy import text
+from db import get_session
+
+logger = logging.getLogger(__name__)
+
+# Tasks within this many slots of a worker count as local to it
+TOPOLOGY_RADIUS = int(os.environ.get("TOPOLOGY_RADIUS", "1"))
+
+# Tiled tasks waiting longer than this can be taken by any worker
+TOPOLOGY_STEAL_SECONDS = float(os.environ.get("TOPOLOGY_STEAL_SECONDS", "30"))
+
+def grid_slot(index, length):
+    """(x, y) slot of the index-th worker of a grid, row by row"""
+    return index % length, index // length
+
+def get_input_tile(item):
+    """Tile coordinates of a task input tagged with "tile": [x, y]"""
+    if isinstance(item, dict) and isinstance(item.get("tile"), (list, tuple)) and len(item["tile"]) == 2:
+        try:
+            return int(item["tile"][0]), int(item["tile"][1])
+        except (TypeError, ValueError):
+            return None
+    return None
+
+def block_slot(tile, extent, length, width):
+    """Slot of a tile when the tile extent is cut into at most length x width blocks
+
+    Neighbouring tiles fall in the same or in neighbouring blocks. Extents
+    smaller than the grid map one tile per slot, so they stay compact.
+    """
+    x, y = max(tile[0], 0), max(tile[1], 0)
+    extent_x, extent_y = extent
+    if extent_x > length:
+        x = x * length // extent_x
+    if extent_y > width:
+        y = y * width // extent_y
+    return min(x, length - 1), min(y, width - 1)
+
+class SlotIndex:
+    """Live workers of a grid by slot, with nearest slot lookups
+
+    Slots are bucketed in square cells so a nearest lookup only visits the
+    cells around a slot instead of every worker of the grid.
+    """
+
+    def __init__(self, length, width, cell_size=8):
+        self.length = length
+        self.width = width
+        self.cell_size = cell_size
+        self.workers = {}
+        self.cells = collections.defaultdict(set)
+
+    def _cell(self, x, y):
+        return x // self.cell_size, y // self.cell_size
+
+    def add(self, x, y, worker_uid):
+        self.workers[(x, y)] = worker_uid
+        self.cells[self._cell(x, y)].add((x, y))
+
+    def __len__(self):
+        return len(self.workers)
+
+    def nearest(self, x, y):
+        """Live slot closest to (x, y) by Chebyshev distance, None if there's none"""
+        if (x, y) in self.workers:
+            return x, y
+        if not self.workers:
+            return None
+
+        cx, cy = self._cell(x, y)
+        max_ring = max(self.length, self.width) // self.cell_size + 1
+        best, best_distance = None, None
+        for ring in range(max_ring + 1):
+            for i in range(cx - ring, cx + ring + 1):
+                for j in range(cy - ring, cy + ring + 1):
+                    if max(abs(i - cx), abs(j - cy)) != ring:
+                        continue
+                    for slot in self.cells.get((i, j), ()):
+                        distance = max(abs(slot[0] - x), abs(slot[1] - y))
+                        if best is None or distance < best_distance or (distance == best_distance and slot < best):
+                            best, best_distance = slot, distance
+            # Slots in further rings are at least ring * cell_size away
+            if best is not None and best_distance <= ring * self.cell_size:
+                break
+        return best
+
+async def load_slot_index(grid_uid):
+    """Slot index of a grid's live workers, None if the grid doesn't exist"""
+    async for session in get_session():
+        result = await session.execute(
+            text("SELECT length, width FROM grids WHERE uid = :uid"),
+            {"uid": grid_uid}
+        )
+        grid = result.fetchone()
+        if not grid:
+            return None
+
+        index = SlotIndex(grid.length, grid.width)
+        result = await session.execute(
+            text("""
+            SELECT uid, grid_x, grid_y FROM workers
+            WHERE grid_uid = :grid_uid
+            AND grid_x IS NOT NULL
+            AND status IN ('online', 'busy')
+            """),
+            {"grid_uid": grid_uid}
+        )
+        for worker in result.fetchall():
+            index.add(worker.grid_x, worker.grid_y, worker.uid)
+        return index
+
+async def place_tiles(grid_uid, tiles):
+    """Slot of each tile (or None for untiled tasks) for a grid's live workers
+
+    Tiles are mapped to slots block by block, then moved to the nearest slot
+    that has a live worker. Without live workers the block slot is kept, so
+    the tasks wait for the workers that will come up there.
+    """
+    tagged = [tile for tile in tiles if tile is not None]
+    if not tagged:
+        return [None] * len(tiles)
+
+    index = await load_slot_index(grid_uid)
+    if index is None:
+        return [None] * len(tiles)
+
+    extent = (max(x for x, _ in tagged) + 1, max(y for _, y in tagged) + 1)
+    slots = []
+    for tile in tiles:
+        if tile is None:
+            slots.append(None)
+            continue
+        slot = block_slot(tile, extent, index.length, index.width)
+        slots.append(index.nearest(*slot) or slot)
+    return slots
+
+class LocalityStats:
+    """Distance between the slot of claimed tiled tasks and the claiming worker, per grid"""
+
+    def __init__(self):
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def record(self, grid_uid, distance):
+        if distance is None:
+            key = "untiled"
+        elif distance == 0:
+            key = "local"
+        elif distance <= TOPOLOGY_RADIUS:
+            key = "adjacent"
+        else:
+            key = "remote"
+        self.counts[grid_uid][key] += 1
+
+    def snapshot(self, grid_uid):
+        counts = self.counts.get(grid_uid, collections.Counter())
+        tiled = counts["local"] + counts["adjacent"] + counts["remote"]
+        return {
+            "local": counts["local"],
+            "adjacent": counts["adjacent"],
+            "remote": counts["remote"],
+            "untiled": counts["untiled"],
+            "remote_ratio": round(counts["remote"] / tiled, 3) if tiled else 0.0
+        }
+
+locality = LocalityStats()
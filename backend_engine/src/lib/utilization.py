@@ -0,0 +1,163 @@
+import os
+import asyncio
+import logging
+import collections
+from datetime import datetime
+from sqlalchemy import text
+from db import get_session
+
+logger = logging.getLogger(__name__)
+
+# Grid counters are written by a single task at most once per interval,
+# whatever the number of worker changes in between
+GRID_UTILIZATION_INTERVAL = float(os.environ.get("GRID_UTILIZATION_INTERVAL", "2"))
+
+class UtilizationAggregator:
+    """Worker and busy worker count changes of each grid since the last flush"""
+
+    def __init__(self):
+        self.deltas = collections.defaultdict(lambda: [0, 0])
+        self.recount = set()
+
+    def worker_added(self, grid_uid, status=None):
+        """Count a worker created in, or moved to, a grid"""
+        if grid_uid:
+            delta = self.deltas[grid_uid]
+            delta[0] += 1
+            delta[1] += 1 if status == "busy" else 0
+
+    def worker_removed(self, grid_uid, status=None):
+        """Count a worker deleted from, or moved out of, a grid"""
+        if grid_uid:
+            delta = self.deltas[grid_uid]
+            delta[0] -= 1
+            delta[1] -= 1 if status == "busy" else 0
+
+    def status_changed(self, grid_uid, old_status, new_status):
+        """Count a worker status transition"""
+        if grid_uid and (old_status == "busy") != (new_status == "busy"):
+            self.deltas[grid_uid][1] += 1 if new_status == "busy" else -1
+
+    def mark_dirty(self, grid_uid):
+        """Recount a grid's workers at the next flush, for bulk changes of unknown transitions"""
+        if grid_uid:
+            self.recount.add(grid_uid)
+
+    def take(self):
+        """Take the pending changes for a flush"""
+        deltas, self.deltas = self.deltas, collections.defaultdict(lambda: [0, 0])
+        recount, self.recount = self.recount, set()
+        # A recount supersedes the deltas of the same grid
+        deltas = {uid: delta for uid, delta in deltas.items() if uid not in recount and any(delta)}
+        return deltas, recount
+
+    def restore(self, deltas, recount):
+        """Put back the changes of a failed flush"""
+        for grid_uid, (workers, busy) in deltas.items():
+            delta = self.deltas[grid_uid]
+            delta[0] += workers
+            delta[1] += busy
+        self.recount |= recount
+
+utilization = UtilizationAggregator()
+
+def status_value(status):
+    """Plain string of a worker status read from the database"""
+    return status.value if hasattr(status, "value") else status
+
+async def flush_grid_utilization():
+    """Apply the pending counter changes in one UPDATE and recount the dirty grids in another
+
+    Returns the number of grids updated.
+    """
+    deltas, recount = utilization.take()
+    if not deltas and not recount:
+        return 0
+
+    updated = 0
+    try:
+        async for session in get_session():
+            now = datetime.utcnow()
+            if deltas:
+                grid_uids = list(deltas)
+                result = await session.execute(
+                    text("""
+                    UPDATE grids AS g
+                    SET worker_count = GREATEST(COALESCE(g.worker_count, 0) + d.workers, 0),
+                        busy_workers = GREATEST(COALESCE(g.busy_workers, 0) + d.busy, 0),
+                        utilization = CASE WHEN COALESCE(g.worker_count, 0) + d.workers > 0
+                            THEN GREATEST(COALESCE(g.busy_workers, 0) + d.busy, 0) * 100.0 / (COALESCE(g.worker_count, 0) + d.workers)
+                            ELSE 0
+                        END,
+                        updated_at = :now
+                    FROM unnest(
+                        CAST(:uids AS text[]),
+                        CAST(:workers AS integer[]),
+                        CAST(:busy AS integer[])
+                    ) AS d(uid, workers, busy)
+                    WHERE g.uid = d.uid
+                    """),
+                    {
+                        "uids": grid_uids,
+                        "workers": [deltas[uid][0] for uid in grid_uids],
+                        "busy": [deltas[uid][1] for uid in grid_uids],
+                        "now": now
+                    }
+                )
+                updated += result.rowcount
+
+            if recount:
+                result = await session.execute(
+                    text("""
+                    UPDATE grids AS g
+                    SET worker_count = c.workers,
+                        busy_workers = c.busy,
+                        utilization = CASE WHEN c.workers > 0 THEN c.busy * 100.0 / c.workers ELSE 0 END,
+                        updated_at = :now
+                    FROM (
+                        SELECT g2.uid,
+                            COUNT(w.uid) AS workers,
+                            COUNT(w.uid) FILTER (WHERE w.status = 'busy') AS busy
+                        FROM grids g2
+                        LEFT JOIN workers w ON w.grid_uid = g2.uid
+                        WHERE g2.uid = ANY(CAST(:uids AS text[]))
+                        GROUP BY g2.uid
+                    ) AS c
+                    WHERE g.uid = c.uid
+                    """),
+                    {"uids": list(recount), "now": now}
+                )
+                updated += result.rowcount
+
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error updating the utilization of {len(deltas) + len(recount)} grids: {e}")
+        utilization.restore(deltas, recount)
+        return 0
+
+    return updated
+
+async def recount_all_grids():
+    """Recount the workers of every grid, e.g. after an engine restart lost pending changes"""
+    async for session in get_session():
+        result = await session.execute(text("SELECT uid FROM grids"))
+        for grid in result.fetchall():
+            utilization.mark_dirty(grid.uid)
+    await flush_grid_utilization()
+
+async def run_utilization_aggregator():
+    """Repair the workers' occupancy, then write the grid counters every GRID_UTILIZATION_INTERVAL"""
+    from lib.occupancy import repair_occupancy
+
+    try:
+        await repair_occupancy()
+    except Exception as e:
+        logger.error(f"Error repairing worker occupancy: {e}")
+    try:
+        await recount_all_grids()
+    except Exception as e:
+        logger.error(f"Error recounting grid workers: {e}")
+
+    while True:
+        await asyncio.sleep(GRID_UTILIZATION_INTERVAL)
+        await flush_grid_utilization()
@@ -0,0 +1,310 @@
+import os
+import json
+import asyncio
+import logging
+import collections
+from uuid import uuid4
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from db import get_session
+from lib.utilization import utilization, status_value
+from lib.failure_detector import failure_detector
+from lib.provisioning import new_worker, insert_workers
+
+logger = logging.getLogger(__name__)
+
+# Seconds between pool refills when no binding wakes the refill up
+WARM_POOL_INTERVAL = float(os.environ.get("WARM_POOL_INTERVAL", "10"))
+
+# Pool workers not online this long after being created are replaced
+WARM_POOL_BOOT_SECONDS = int(os.environ.get("WARM_POOL_BOOT_SECONDS", "600"))
+
+def pool_key(docker_image, cpu_total, memory_total):
+    """Key of the warm pool of an image and resource class"""
+    return f"{docker_image}|{float(cpu_total):g}|{int(memory_total)}"
+
+def worker_pool_key(worker):
+    """Warm pool a new worker dict (see provisioning.new_worker) can be bound from, None for GPU workers"""
+    if worker.get("gpu_id"):
+        return None
+    return pool_key(worker["spec"]["docker_image"], worker["cpu_total"], worker["memory_total"])
+
+class WarmPoolStats:
+    """Workers bound to a warm pod and cold starts, per pool key"""
+
+    def __init__(self):
+        self.bound = collections.Counter()
+        self.cold = collections.Counter()
+
+warm_pool_stats = WarmPoolStats()
+
+_refill = None
+
+def request_refill():
+    """Refill the pools now rather than at the next interval"""
+    if _refill is not None:
+        _refill.set()
+
+async def bind_warm_workers(workers):
+    """Bind new worker dicts to ready warm pool workers of their image and resource class
+
+    A bound worker dict takes the UID, status and spec of its pool worker,
+    whose row is renamed and moved to the worker's grid and slot. Its pod is
+    already running, so it starts claiming tasks right away, a label job
+    gives its objects the grid label. Returns the bound workers, the others
+    need a cold start.
+    """
+    from lib.k8ssdk import deployment_queue
+
+    groups = collections.defaultdict(list)
+    for worker in workers:
+        key = worker_pool_key(worker)
+        if key:
+            groups[key].append(worker)
+    if not groups:
+        return []
+
+    bound = []
+    now = datetime.utcnow()
+    async for session in get_session():
+        for key, group in groups.items():
+            result = await session.execute(
+                text("""
+                SELECT uid FROM workers
+                WHERE pool_key = :key AND status = 'online'
+                ORDER BY last_heartbeat DESC NULLS LAST
+                LIMIT :count
+                FOR UPDATE SKIP LOCKED
+                """),
+                {"key": key, "count": len(group)}
+            )
+            uids = [row.uid for row in result.fetchall()]
+            if not uids:
+                continue
+
+            group = group[:len(uids)]
+            result = await session.execute(
+                text("""
+                UPDATE workers AS w
+                SET name = b.name,
+                    grid_uid = b.grid_uid,
+                    grid_x = b.grid_x,
+                    grid_y = b.grid_y,
+                    pool_key = NULL,
+                    spec = CAST(
+                        CAST(COALESCE(w.spec, '{}') AS jsonb)
+                        || jsonb_build_object('statefulset', COALESCE(w.spec->>'statefulset', 'vinci4dworker-' || w.name))
+                        AS json
+                    ),
+                    updated_at = :now
+                FROM unnest(
+                    CAST(:uids AS text[]),
+                    CAST(:names AS text[]),
+                    CAST(:grid_uids AS text[]),
+                    CAST(:grid_xs AS integer[]),
+                    CAST(:grid_ys AS integer[])
+                ) AS b(uid, name, grid_uid, grid_x, grid_y)
+                WHERE w.uid = b.uid
+                RETURNING w.uid, w.status, w.spec
+                """),
+                {
+                    "uids": uids,
+                    "names": [worker["name"] for worker in group],
+                    "grid_uids": [worker["grid_uid"] for worker in group],
+                    "grid_xs": [worker["grid_x"] for worker in group],
+                    "grid_ys": [worker["grid_y"] for worker in group],
+                    "now": now
+                }
+            )
+            rows = {row.uid: row for row in result.fetchall()}
+            for uid, worker in zip(uids, group):
+                row = rows[uid]
+                worker["uid"] = uid
+                worker["status"] = status_value(row.status)
+                worker["spec"] = json.loads(row.spec) if isinstance(row.spec, str) else row.spec
+                worker["pool_key"] = None
+                bound.append(worker)
+        await session.commit()
+
+    bound_ids = {id(worker) for worker in bound}
+    for worker in bound:
+        utilization.worker_added(worker["grid_uid"], worker["status"])
+    for worker in workers:
+        key = worker_pool_key(worker)
+        if key:
+            (warm_pool_stats.bound if id(worker) in bound_ids else warm_pool_stats.cold)[key] += 1
+    if bound:
+        logger.info(f"Bound {len(bound)} workers to warm pods")
+        await deployment_queue.submit("label", bound)
+        request_refill()
+    return bound
+
+async def queue_deletes(removed):
+    """Forget deleted pool workers and queue the deletion of their StatefulSets"""
+    from lib.k8ssdk import deployment_queue
+
+    for worker in removed:
+        failure_detector.forget(worker.uid)
+    if removed:
+        await deployment_queue.submit(
+            "delete", [{"uid": worker.uid, "name": worker.name, "grid_uid": None, "spec": worker.spec} for worker in removed]
+        )
+
+async def refill_pools():
+    """Replace dead pool workers, create the missing ones and remove the surplus
+
+    Returns the number of pool workers created.
+    """
+    from lib.k8ssdk import deployment_queue
+
+    now = datetime.utcnow()
+    created = []
+    async for session in get_session():
+        result = await session.execute(text("SELECT * FROM warm_pools"))
+        pools = {pool.key: pool for pool in result.fetchall()}
+
+        # Workers of removed pools, and ones that never came up or went down
+        result = await session.execute(
+            text("""
+            DELETE FROM workers
+            WHERE pool_key IS NOT NULL
+            AND (
+                NOT (pool_key = ANY(CAST(:keys AS text[])))
+                OR (status IN ('offline', 'error') AND created_at < :booted_before)
+            )
+            RETURNING uid, name, spec
+            """),
+            {"keys": list(pools), "booted_before": now - timedelta(seconds=WARM_POOL_BOOT_SECONDS)}
+        )
+        removed = result.fetchall()
+
+        result = await session.execute(
+            text("SELECT pool_key, COUNT(*) AS count FROM workers WHERE pool_key IS NOT NULL GROUP BY pool_key")
+        )
+        counts = {row.pool_key: row.count for row in result.fetchall()}
+
+        for key, pool in pools.items():
+            missing = pool.size - counts.get(key, 0)
+            if missing > 0:
+                data = {"docker_image": pool.docker_image, "cpu_total": pool.cpu_total, "memory_total": pool.memory_total}
+                created.extend(new_worker(f"pool-{uuid4().hex[:12]}", None, data, pool_key=key) for _ in range(missing))
+            elif missing < 0:
+                # Remove surplus idle workers, the ones still booting first
+                result = await session.execute(
+                    text("""
+                    DELETE FROM workers
+                    WHERE uid IN (
+                        SELECT uid FROM workers
+                        WHERE pool_key = :key
+                        ORDER BY status = 'online', created_at DESC
+                        LIMIT :count
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING uid, name, spec
+                    """),
+                    {"key": key, "count": -missing}
+                )
+                removed.extend(result.fetchall())
+
+        if created:
+            await insert_workers(created, session)
+        await session.commit()
+
+    await queue_deletes(removed)
+    if created:
+        await deployment_queue.submit("deploy", created)
+        logger.info(f"Created {len(created)} warm pool workers")
+    return len(created)
+
+async def run_warm_pool():
+    """Keep the warm pools filled, every WARM_POOL_INTERVAL or right after workers were bound"""
+    global _refill
+    _refill = asyncio.Event()
+    while True:
+        try:
+            await refill_pools()
+        except Exception as e:
+            logger.error(f"Error refilling warm pools: {e}")
+        try:
+            await asyncio.wait_for(_refill.wait(), timeout=WARM_POOL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _refill.clear()
+
+async def get_pools():
+    """Configured warm pools with their ready and booting workers"""
+    async for session in get_session():
+        result = await session.execute(
+            text("""
+            SELECT p.*,
+                COUNT(w.uid) FILTER (WHERE w.status = 'online') AS ready,
+                COUNT(w.uid) FILTER (WHERE w.status != 'online') AS booting
+            FROM warm_pools p
+            LEFT JOIN workers w ON w.pool_key = p.key
+            GROUP BY p.key
+            ORDER BY p.key
+            """)
+        )
+        return [
+            {
+                "key": pool.key,
+                "docker_image": pool.docker_image,
+                "cpu_total": pool.cpu_total,
+                "memory_total": pool.memory_total,
+                "size": pool.size,
+                "ready": pool.ready,
+                "booting": pool.booting,
+                "bound": warm_pool_stats.bound[pool.key],
+                "cold_starts": warm_pool_stats.cold[pool.key]
+            }
+            for pool in result.fetchall()
+        ]
+    return []
+
+async def set_pool(data):
+    """Create, resize or (with size 0) remove the warm pool of an image and resource class
+
+    Returns the pools, None if the settings are invalid.
+    """
+    try:
+        docker_image = data.get("docker_image", "python:3.11-slim")
+        cpu_total = float(data.get("cpu_total", 4.0))
+        memory_total = int(data.get("memory_total", 8192))
+        size = int(data["size"])
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"Invalid warm pool settings {data}: {e}")
+        return None
+    if size < 0 or cpu_total <= 0 or memory_total <= 0:
+        logger.error(f"Invalid warm pool settings {data}")
+        return None
+
+    key = pool_key(docker_image, cpu_total, memory_total)
+    now = datetime.utcnow()
+    try:
+        async for session in get_session():
+            if size == 0:
+                await session.execute(text("DELETE FROM warm_pools WHERE key = :key"), {"key": key})
+            else:
+                await session.execute(
+                    text("""
+                    INSERT INTO warm_pools (key, docker_image, cpu_total, memory_total, size, created_at, updated_at)
+                    VALUES (:key, :docker_image, :cpu_total, :memory_total, :size, :now, :now)
+                    ON CONFLICT (key) DO UPDATE SET size = EXCLUDED.size, updated_at = EXCLUDED.updated_at
+                    """),
+                    {
+                        "key": key,
+                        "docker_image": docker_image,
+                        "cpu_total": cpu_total,
+                        "memory_total": memory_total,
+                        "size": size,
+                        "now": now
+                    }
+                )
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error updating warm pool {key}: {e}")
+        return None
+
+    logger.info(f"Warm pool {key} set to {size} workers")
+    request_refill()
+    return await get_pools()
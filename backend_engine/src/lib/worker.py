@@ -1,10 +1,15 @@
 import logging
 from sqlalchemy import text
 from datetime import datetime
-from db import Worker, WorkerStatus, get_session
+from db import Worker, get_session
+from lib.heartbeat import record_heartbeat, record_registration
+from lib.failure_detector import failure_detector, fail_workers
+from lib.utilization import utilization, status_value
+from lib.provisioning import ProvisioningProgress, provisioning, new_worker, insert_workers, provision_workers
+from lib.warmpool import bind_warm_workers
+from lib.workergroup import delete_group_worker
 import asyncio
 from uuid import uuid4
-import os
 
 logger = logging.getLogger(__name__)
 
@@ -44,7 +49,10 @@ async def get_all_workers(filters=None):
                 "last_heartbeat": worker.last_heartbeat.isoformat() if worker.last_heartbeat else None,
                 "created_at": worker.created_at.isoformat() if worker.created_at else None,
                 "updated_at": worker.updated_at.isoformat() if worker.updated_at else None,
-                "spec": worker.spec
+                "spec": worker.spec,
+                "telemetry": worker.telemetry,
+                "grid_x": worker.grid_x,
+                "grid_y": worker.grid_y
             }
             workers_list.append(worker_dict)
     
@@ -76,65 +84,50 @@ async def get_worker_by_uid(uid):
             "last_heartbeat": worker.last_heartbeat.isoformat() if worker.last_heartbeat else None,
             "created_at": worker.created_at.isoformat() if worker.created_at else None,
             "updated_at": worker.updated_at.isoformat() if worker.updated_at else None,
-            "spec": worker.spec
+            "spec": worker.spec,
+            "telemetry": worker.telemetry,
+            "grid_x": worker.grid_x,
+            "grid_y": worker.grid_y,
+            "observed_state": worker.observed_state,
+            "observed_at": worker.observed_at.isoformat() if worker.observed_at else None,
+            "group_ordinal": worker.group_ordinal,
+            "running_tasks": worker.running_tasks,
+            "cpu_reserved": worker.cpu_reserved,
+            "memory_reserved": worker.memory_reserved
         }
         
         return worker_dict
 
-async def set_worker_online(uid):
-    """Set a worker's status to online"""
-    try:
-        logger.info(f"Setting worker {uid} online")
-        
-        # Use direct SQL update instead of ORM to avoid immutability issues
-        async for session in get_session():
-            # Update worker status using SQL
-            await session.execute(
-                text("""
-                UPDATE workers 
-                SET status = 'online', 
-                    last_heartbeat = :now,
-                    updated_at = :now
-                WHERE uid = :uid
-                """),
-                {
-                    "uid": uid,
-                    "now": datetime.utcnow()
-                }
-            )
-            
-            try:
-                await session.commit()
-                logger.info(f"Worker {uid} set to online successfully")
-                return True
-            except Exception as commit_error:
-                logger.error(f"Error committing worker status update: {commit_error}")
-                await session.rollback()
-                raise
-    except Exception as e:
-        logger.error(f"Error setting worker {uid} online: {e}")
-        return False
+async def set_worker_online(uid, registration=None):
+    """Set a worker's status to online, keeping the boot timing it registered with
+
+    Registrations are buffered with the heartbeats and written at the next flush.
+    """
+    logger.info(f"Setting worker {uid} online")
+    record_registration(uid, registration)
+    return True
 
 async def set_worker_offline(uid):
-    """Set a worker status to offline"""
+    """Set a worker status to offline, requeueing its leased and running tasks like a failed worker"""
     try:
         async for session in get_session():
             result = await session.execute(
-                text("SELECT * FROM workers WHERE uid = :uid"),
+                text("SELECT uid, status FROM workers WHERE uid = :uid"),
                 {"uid": uid}
             )
             worker = result.fetchone()
             
-            if not worker:
-                logger.error(f"Worker {uid} not found")
-                return False
-            
-            worker.status = WorkerStatus.OFFLINE
-            worker.updated_at = datetime.utcnow()
-            await session.commit()
-            
-            logger.info(f"Worker {uid} set to offline")
-            return True
+        if not worker:
+            logger.error(f"Worker {uid} not found")
+            return False
+        
+        await fail_workers([uid], reason="requested", statuses=("online", "busy", "suspect", "error"))
+        
+        # Taken offline on purpose, the failure detector must not bring it back
+        failure_detector.forget(uid)
+        
+        logger.info(f"Worker {uid} set to offline")
+        return True
     except Exception as e:
         logger.error(f"Error setting worker {uid} offline: {e}")
         return False
@@ -154,6 +147,23 @@ async def create_worker(data):
                 logger.error(f"Worker with name {data['name']} already exists")
                 return None
         
+        # Bind a ready warm pod of the same image and size, if its pool has one
+        if data.get("auto_deploy", True):
+            bound = await bind_warm_workers([new_worker(data["name"], data["grid_uid"], data)])
+            if bound:
+                worker = bound[0]
+                logger.info(f"Worker {worker['uid']} bound to a warm pod")
+                return {
+                    "uid": worker["uid"],
+                    "name": worker["name"],
+                    "grid_uid": worker["grid_uid"],
+                    "status": worker["status"],
+                    "cpu_total": worker["cpu_total"],
+                    "memory_total": worker["memory_total"],
+                    "docker_image": worker["spec"].get("docker_image", "python:3.11-slim"),
+                    "warm": True
+                }
+        
         # Create worker object
         worker = Worker(
             uid=str(uuid4()),
@@ -180,9 +190,7 @@ async def create_worker(data):
             session.add(worker)
             await session.commit()
             
-            # Update grid utilization
-            from lib.grid import update_grid_utilization
-            asyncio.create_task(update_grid_utilization(data["grid_uid"]))
+            utilization.worker_added(worker.grid_uid, worker.status)
             
             # Create worker response
             worker_response = {
@@ -199,9 +207,7 @@ async def create_worker(data):
             # Deploy worker to Kubernetes if auto_deploy is enabled
             if data.get("auto_deploy", True):
                 try:
-                    from lib.k8ssdk import K8sDeployer
-                    namespace = os.environ.get("K8S_NAMESPACE", "default")
-                    deployer = K8sDeployer(namespace=namespace)
+                    from lib.k8ssdk import deployment_queue
                     
                     # Convert SQLAlchemy model to dict for deployer
                     worker_dict = {
@@ -215,8 +221,8 @@ async def create_worker(data):
                         "spec": worker.spec
                     }
                     
-                    # Deploy worker asynchronously
-                    asyncio.create_task(deploy_worker_async(deployer, worker_dict))
+                    # Deploy worker in the background through the deployment queue
+                    await deployment_queue.submit("deploy", [worker_dict])
                 except Exception as e:
                     logger.error(f"Error setting up worker deployment: {e}")
             
@@ -225,73 +231,92 @@ async def create_worker(data):
         logger.error(f"Error creating worker: {e}")
         return None
 
-async def deploy_worker_async(deployer, worker):
-    """Deploy a worker asynchronously"""
-    try:
-        # Run the deployment in a thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, deployer.deploy_worker, worker)
-        
-        if result:
-            logger.info(f"Worker {worker['uid']} deployed successfully")
-        else:
-            logger.error(f"Failed to deploy worker {worker['uid']}")
-    except Exception as e:
-        logger.error(f"Error deploying worker {worker['uid']}: {e}")
-
 async def create_workers_batch(data):
-    """Create multiple workers at once"""
-    results = []
-    
+    """Create multiple workers at once, inserted in bulk and deployed in the background"""
     # Create the specified number of workers
-    count = data.get("count", 1)
+    count = int(data.get("count", 1))
     
     # Use name_prefix if provided, otherwise use name as prefix
     base_name = data.get("name_prefix", data.get("name", "worker"))
+    workers = [new_worker(f"{base_name}-{i+1}", data["grid_uid"], data) for i in range(count)]
     
-    for i in range(count):
-        worker_data = data.copy()
-        worker_data["name"] = f"{base_name}-{i+1}"
-        
-        # Create the worker
-        worker = await create_worker(worker_data)
-        results.append(worker)
+    try:
+        async for session in get_session():
+            # Check that none of the names are taken
+            result = await session.execute(
+                text("SELECT name FROM workers WHERE name = ANY(CAST(:names AS text[]))"),
+                {"names": [worker["name"] for worker in workers]}
+            )
+            taken = [row.name for row in result.fetchall()]
+            if taken:
+                logger.error(f"Workers with names {', '.join(taken)} already exist")
+                return []
+            
+            await insert_workers(workers, session)
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error creating {count} workers: {e}")
+        return []
+    
+    for worker in workers:
+        utilization.worker_added(worker["grid_uid"], worker["status"])
+    
+    progress = ProvisioningProgress(data["grid_uid"], count)
+    progress.created = count
+    provisioning[data["grid_uid"]] = progress
+    asyncio.create_task(provision_workers(workers, progress, data.get("auto_deploy", True)))
     
-    return results
+    return [
+        {
+            "uid": worker["uid"],
+            "name": worker["name"],
+            "grid_uid": worker["grid_uid"],
+            "status": worker["status"],
+            "cpu_total": worker["cpu_total"],
+            "memory_total": worker["memory_total"],
+            "docker_image": worker["spec"]["docker_image"]
+        }
+        for worker in workers
+    ]
 
 async def associate_worker_with_grid(worker_uid, grid_uid):
     """Associate a worker with a grid"""
     async for session in get_session():
-        # Check if worker exists
+        # Check if grid exists
         result = await session.execute(
-            text("SELECT * FROM workers WHERE uid = :uid"),
-            {"uid": worker_uid}
+            text("SELECT uid FROM grids WHERE uid = :uid"),
+            {"uid": grid_uid}
         )
-        worker = result.fetchone()
-        
-        if not worker:
-            logger.error(f"Worker {worker_uid} not found")
+        if not result.fetchone():
+            logger.error(f"Grid {grid_uid} not found")
             return False
         
-        # Check if grid exists
+        # Move the worker, keeping its previous grid for the utilization counters
         result = await session.execute(
-            text("SELECT * FROM grids WHERE uid = :uid"),
-            {"uid": grid_uid}
+            text("""
+            WITH prev AS (
+                SELECT uid, grid_uid, status FROM workers WHERE uid = :uid FOR UPDATE
+            )
+            UPDATE workers AS w
+            SET grid_uid = :grid_uid, updated_at = :now
+            FROM prev
+            WHERE w.uid = prev.uid
+            RETURNING prev.grid_uid AS old_grid_uid, prev.status AS status
+            """),
+            {"uid": worker_uid, "grid_uid": grid_uid, "now": datetime.utcnow()}
         )
-        grid = result.fetchone()
+        worker = result.fetchone()
         
-        if not grid:
-            logger.error(f"Grid {grid_uid} not found")
+        if not worker:
+            logger.error(f"Worker {worker_uid} not found")
             return False
         
-        # Update worker's grid_uid
-        worker.grid_uid = grid_uid
-        worker.updated_at = datetime.utcnow()
         await session.commit()
         
-        # Update grid utilization
-        from lib.grid import update_grid_utilization
-        asyncio.create_task(update_grid_utilization(grid_uid))
+        if worker.old_grid_uid != grid_uid:
+            status = status_value(worker.status)
+            utilization.worker_removed(worker.old_grid_uid, status)
+            utilization.worker_added(grid_uid, status)
         
         logger.info(f"Worker {worker_uid} associated with grid {grid_uid}")
         return True
@@ -313,32 +338,35 @@ async def delete_worker(uid):
                 logger.error(f"Worker {uid} not found")
                 return False
             
-            # Store grid_uid and name for later use
+            # Replicas of a worker group are removed by scaling its StatefulSet down
+            if worker.group_ordinal is not None:
+                return await delete_group_worker(worker.grid_uid, uid)
+            
+            # Store grid_uid, name and spec for later use
             grid_uid = worker.grid_uid
             worker_name = worker.name
+            worker_spec = worker.spec
             
             # Delete the worker
-            await session.execute(
-                text("DELETE FROM workers WHERE uid = :uid"),
+            result = await session.execute(
+                text("DELETE FROM workers WHERE uid = :uid RETURNING status"),
                 {"uid": uid}
             )
+            deleted = result.fetchone()
             await session.commit()
             
             logger.info(f"Worker {uid} deleted successfully from database")
+            failure_detector.forget(uid)
             
-            # Update grid utilization if worker was part of a grid
-            if grid_uid:
-                from lib.grid import update_grid_utilization
-                asyncio.create_task(update_grid_utilization(grid_uid))
+            if deleted:
+                utilization.worker_removed(grid_uid, status_value(deleted.status))
             
-            # Delete worker from Kubernetes
+            # Delete worker from Kubernetes in the background through the deployment queue
             try:
-                from lib.k8ssdk import K8sDeployer
-                namespace = os.environ.get("K8S_NAMESPACE", "default")
-                deployer = K8sDeployer(namespace=namespace)
-                
-                # Delete worker asynchronously
-                asyncio.create_task(delete_worker_async(deployer, uid, worker_name))
+                from lib.k8ssdk import deployment_queue
+                await deployment_queue.submit(
+                    "delete", [{"uid": uid, "name": worker_name, "grid_uid": grid_uid, "spec": worker_spec}]
+                )
             except Exception as e:
                 logger.error(f"Error setting up worker deletion from Kubernetes: {e}")
             
@@ -347,58 +375,9 @@ async def delete_worker(uid):
         logger.error(f"Error deleting worker {uid}: {e}")
         return False
 
-async def delete_worker_async(deployer, worker_uid, worker_name=None):
-    """Delete a worker from Kubernetes asynchronously"""
-    try:
-        # Run the deletion in a thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        
-        # Pass both UID and name to the delete function
-        if worker_name:
-            result = await loop.run_in_executor(
-                None, 
-                lambda: deployer.delete_worker(worker_uid, worker_name)
-            )
-        else:
-            result = await loop.run_in_executor(
-                None,
-                lambda: deployer.delete_worker(worker_uid)
-            )
-        
-        if result:
-            logger.info(f"Worker {worker_uid} deleted successfully from Kubernetes")
-        else:
-            logger.error(f"Failed to delete worker {worker_uid} from Kubernetes")
-    except Exception as e:
-        logger.error(f"Error deleting worker {worker_uid} from Kubernetes: {e}")
+async def update_worker_heartbeat(uid, heartbeat=None):
+    """Record a worker's heartbeat and reported telemetry, written at the next flush
 
-async def update_worker_heartbeat(uid):
-    """Update a worker's heartbeat timestamp"""
-    try:
-        logger.info(f"Updating heartbeat for worker {uid}")
-        
-        # Use direct SQL update
-        async for session in get_session():
-            await session.execute(
-                text("""
-                UPDATE workers 
-                SET last_heartbeat = :now,
-                    updated_at = :now
-                WHERE uid = :uid
-                """),
-                {
-                    "uid": uid,
-                    "now": datetime.utcnow()
-                }
-            )
-            
-            try:
-                await session.commit()
-                return True
-            except Exception as commit_error:
-                logger.error(f"Error committing worker heartbeat update: {commit_error}")
-                await session.rollback()
-                raise
-    except Exception as e:
-        logger.error(f"Error updating heartbeat for worker {uid}: {e}")
-        return False
+    Returns False for UIDs a flush found no worker for.
+    """
+    return record_heartbeat(uid, heartbeat)
@@ -0,0 +1,244 @@
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import text
+from db import get_session
+from lib.utilization import utilization, status_value
+from lib.failure_detector import failure_detector
+from lib.heartbeat import record_registration
+from lib.topology import grid_slot
+from lib.provisioning import new_worker, insert_workers
+
+logger = logging.getLogger(__name__)
+
+# Value of the "mode" initialization setting that deploys a grid as one worker group
+GROUP_MODE = "group"
+
+def group_name(grid_uid):
+    """StatefulSet and Service of a grid's worker group"""
+    return f"vinci4dgroup-{grid_uid}"
+
+def load_group(worker_group):
+    """Worker group settings of a grid row, None for grids with one StatefulSet per worker"""
+    return json.loads(worker_group) if isinstance(worker_group, str) else worker_group
+
+def new_group(data, replicas):
+    """Image and resources shared by the replicas of a worker group"""
+    return {
+        "docker_image": data.get("docker_image", "python:3.11-slim"),
+        "cpu_total": float(data.get("cpu_total", 4.0)),
+        "memory_total": int(data.get("memory_total", 8192)),
+        "gpu_id": data.get("gpu_id"),
+        "gpu_memory": data.get("gpu_memory"),
+        "replicas": replicas
+    }
+
+def group_payload(grid_uid, group):
+    """Deployment job payload of a worker group, see K8sDeployer.render_worker_group"""
+    name = group_name(grid_uid)
+    return {
+        "uid": name,
+        "name": None,
+        "grid_uid": grid_uid,
+        "cpu_total": group["cpu_total"],
+        "memory_total": group["memory_total"],
+        "gpu_id": group.get("gpu_id"),
+        "gpu_memory": group.get("gpu_memory"),
+        "replicas": group["replicas"],
+        "spec": {"docker_image": group["docker_image"], "statefulset": name}
+    }
+
+def group_worker(grid, group, ordinal):
+    """Worker row of the replica with a pod ordinal, on the grid slot of the same index"""
+    slot = grid_slot(ordinal, grid.length) if ordinal < grid.length * grid.width else None
+    return new_worker(f"{grid.name}-worker-{ordinal+1}", grid.uid, group, slot, group_ordinal=ordinal)
+
+async def lock_group(session, grid_uid):
+    """Grid row and worker group settings, locked until the session commits"""
+    result = await session.execute(
+        text("SELECT uid, name, length, width, worker_group FROM grids WHERE uid = :uid FOR UPDATE"),
+        {"uid": grid_uid}
+    )
+    grid = result.fetchone()
+    return grid, load_group(grid.worker_group) if grid else None
+
+async def set_group(session, grid_uid, group):
+    await session.execute(
+        text("UPDATE grids SET worker_group = CAST(:group AS json), updated_at = :now WHERE uid = :uid"),
+        {"group": json.dumps(group), "now": datetime.utcnow(), "uid": grid_uid}
+    )
+
+async def queue_scale(grid_uid, group):
+    """Queue the replicas patch of a worker group, returns its future"""
+    from lib.k8ssdk import deployment_queue
+
+    payload = group_payload(grid_uid, group)
+    futures = await deployment_queue.submit("scale", [payload])
+    logger.info(f"Worker group of grid {grid_uid} scaling to {group['replicas']} replicas")
+    return futures[payload["uid"]]
+
+async def provision_group(grid_uid, group, progress, deploy=True):
+    """Deploy a grid's worker group and record the outcome for all its workers in progress"""
+    from lib.k8ssdk import deployment_queue
+
+    error = None
+    if deploy:
+        progress.state = "deploying"
+        payload = group_payload(grid_uid, group)
+        try:
+            futures = await deployment_queue.submit("group", [payload])
+            error = await futures[payload["uid"]]
+        except Exception as e:
+            error = str(e)
+
+        if error is None:
+            progress.deployed = progress.created
+        else:
+            progress.failed = progress.created
+            progress.errors.append({"worker_uid": payload["uid"], "name": payload["uid"], "error": error})
+
+    progress.finish("failed" if error else ("done" if deploy else "created"))
+    logger.info(f"Provisioned worker group of grid {grid_uid} with {group['replicas']} replicas: {progress.state}")
+    return progress
+
+async def add_group_workers(grid_uid, count):
+    """Add replicas to a grid's worker group with one replicas patch, returns the number added"""
+    async for session in get_session():
+        grid, group = await lock_group(session, grid_uid)
+        if not group:
+            logger.error(f"Grid {grid_uid} has no worker group")
+            return 0
+
+        start = group["replicas"]
+        workers = [group_worker(grid, group, ordinal) for ordinal in range(start, start + count)]
+        await insert_workers(workers, session)
+        group["replicas"] = start + count
+        await set_group(session, grid_uid, group)
+        await session.commit()
+
+    for worker in workers:
+        utilization.worker_added(grid_uid, worker["status"])
+    await queue_scale(grid_uid, group)
+    return count
+
+async def shrink_group(session, grid_uid, group, removed_uids, replicas):
+    """Delete the rows of the replicas at and above an ordinal and lower the group's replicas"""
+    result = await session.execute(
+        text("DELETE FROM workers WHERE uid = ANY(CAST(:uids AS text[])) RETURNING uid, status"),
+        {"uids": removed_uids}
+    )
+    removed = result.fetchall()
+    group["replicas"] = replicas
+    await set_group(session, grid_uid, group)
+    await session.commit()
+
+    for worker in removed:
+        utilization.worker_removed(grid_uid, status_value(worker.status))
+        failure_detector.forget(worker.uid)
+    await queue_scale(grid_uid, group)
+    return len(removed)
+
+async def remove_group_workers(grid_uid, count):
+    """Remove up to count idle replicas from the top of a grid's worker group
+
+    A StatefulSet scales down from its highest ordinal, so only the idle
+    replicas above the highest busy one can go. Returns the number removed.
+    """
+    async for session in get_session():
+        grid, group = await lock_group(session, grid_uid)
+        if not group:
+            logger.error(f"Grid {grid_uid} has no worker group")
+            return 0
+
+        result = await session.execute(
+            text("""
+            SELECT w.uid, w.group_ordinal,
+                w.status = 'busy' OR EXISTS (
+                    SELECT 1 FROM tasks t
+                    WHERE t.worker_uid = w.uid AND t.status IN ('pending', 'running')
+                ) AS active
+            FROM workers w
+            WHERE w.grid_uid = :grid_uid AND w.group_ordinal IS NOT NULL
+            ORDER BY w.group_ordinal DESC
+            LIMIT :count
+            FOR UPDATE OF w
+            """),
+            {"grid_uid": grid_uid, "count": count}
+        )
+        idle = []
+        for worker in result.fetchall():
+            if worker.active:
+                break
+            idle.append(worker)
+        if not idle:
+            return 0
+
+        return await shrink_group(session, grid_uid, group, [worker.uid for worker in idle], idle[-1].group_ordinal)
+    return 0
+
+async def delete_group_worker(grid_uid, worker_uid):
+    """Delete a replica of a worker group, only the highest ordinal can be deleted"""
+    async for session in get_session():
+        grid, group = await lock_group(session, grid_uid)
+        if not group:
+            logger.error(f"Grid {grid_uid} has no worker group")
+            return False
+
+        result = await session.execute(
+            text("""
+            SELECT uid, group_ordinal FROM workers
+            WHERE grid_uid = :grid_uid AND group_ordinal IS NOT NULL
+            ORDER BY group_ordinal DESC
+            LIMIT 1
+            """),
+            {"grid_uid": grid_uid}
+        )
+        top = result.fetchone()
+        if not top or top.uid != worker_uid:
+            logger.error(f"Worker {worker_uid} is not the highest ordinal of its group, scale the group down instead")
+            return False
+
+        await shrink_group(session, grid_uid, group, [worker_uid], top.group_ordinal)
+        logger.info(f"Worker {worker_uid} deleted from the worker group of grid {grid_uid}")
+        return True
+    return False
+
+async def register_group_worker(grid_uid, ordinal, registration=None):
+    """UID of the worker group replica with a pod ordinal, creating its row if it has none
+
+    The replica is set online like any registering worker. Returns None if
+    the ordinal is outside the group's replicas.
+    """
+    async for session in get_session():
+        result = await session.execute(
+            text("SELECT uid FROM workers WHERE grid_uid = :grid_uid AND group_ordinal = :ordinal"),
+            {"grid_uid": grid_uid, "ordinal": ordinal}
+        )
+        worker = result.fetchone()
+        if worker:
+            uid = worker.uid
+        else:
+            # Rows are created with the group, this replica's was removed by hand
+            grid, group = await lock_group(session, grid_uid)
+            if not group or not 0 <= ordinal < group["replicas"]:
+                logger.error(f"Grid {grid_uid} has no worker group replica {ordinal}")
+                return None
+
+            result = await session.execute(
+                text("SELECT uid FROM workers WHERE grid_uid = :grid_uid AND group_ordinal = :ordinal"),
+                {"grid_uid": grid_uid, "ordinal": ordinal}
+            )
+            worker = result.fetchone()
+            if worker:
+                uid = worker.uid
+            else:
+                new = group_worker(grid, group, ordinal)
+                await insert_workers([new], session)
+                await session.commit()
+                utilization.worker_added(grid_uid, new["status"])
+                uid = new["uid"]
+                logger.info(f"Created worker {uid} for replica {ordinal} of the worker group of grid {grid_uid}")
+
+    logger.info(f"Worker group replica {ordinal} of grid {grid_uid} registered as worker {uid}")
+    record_registration(uid, registration)
+    return uid
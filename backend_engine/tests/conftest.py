@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The engine's modules import each other from backend_engine/src (lib.*, db)
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
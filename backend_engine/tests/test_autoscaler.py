@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+from lib.autoscaler import DEFAULT_AUTOSCALE, desired_workers, get_autoscale_settings
+
+def settings(**overrides):
+    return {**DEFAULT_AUTOSCALE, "enabled": True, "min_workers": 0, "max_workers": 100, "target_drain_seconds": 100, **overrides}
+
+def metrics(**overrides):
+    return {
+        "pending": 0, "running": 0, "throughput": 0, "arrival_rate": 0, "avg_duration": None,
+        "workers": 0, "live_workers": 0, "slots_per_worker": 1, **overrides
+    }
+
+def test_settings_defaults():
+    grid = SimpleNamespace(autoscale={"enabled": True, "min_workers": 2}, length=4, width=5)
+    result = get_autoscale_settings(grid)
+    assert result["enabled"] is True
+    assert result["min_workers"] == 2
+    assert result["max_workers"] == 20
+    assert result["target_drain_seconds"] == DEFAULT_AUTOSCALE["target_drain_seconds"]
+
+def test_idle_grid_goes_to_min_workers():
+    assert desired_workers(settings(min_workers=3), metrics())[0] == 3
+
+def test_drains_backlog_from_durations():
+    # 2 slots of 10 second tasks: 0.2 tasks/s per worker, 1000 pending over 100 s need 10 tasks/s
+    desired, reason = desired_workers(settings(), metrics(pending=1000, avg_duration=10, slots_per_worker=2))
+    assert desired == 50
+    assert "1000 pending" in reason
+
+def test_keeps_up_with_arrivals():
+    desired, _ = desired_workers(settings(), metrics(pending=100, arrival_rate=4, avg_duration=10, slots_per_worker=2))
+    # 4 tasks/s arriving plus 1 task/s of backlog
+    assert desired == 25
+
+def test_service_rate_from_throughput_without_durations():
+    desired, _ = desired_workers(settings(), metrics(pending=300, throughput=2, live_workers=4))
+    # 0.5 tasks/s per worker for 3 tasks/s of backlog
+    assert desired == 6
+
+def test_without_history_one_slot_per_task():
+    desired, reason = desired_workers(settings(), metrics(pending=7, running=3, slots_per_worker=4))
+    assert desired == 3
+    assert "no duration history" in reason
+
+def test_never_below_running_tasks():
+    desired, _ = desired_workers(settings(), metrics(pending=1, running=40, avg_duration=1, slots_per_worker=4))
+    assert desired == 10
+
+def test_bounded_to_max_workers():
+    desired, reason = desired_workers(settings(max_workers=20), metrics(pending=100000, avg_duration=10))
+    assert desired == 20
+    assert "bounded to [0, 20]" in reason
+
+def test_bounded_to_min_workers():
+    desired, reason = desired_workers(settings(min_workers=5), metrics(pending=1, avg_duration=1))
+    assert desired == 5
+    assert "bounded" in reason
+
+def test_zero_slots_per_worker_counts_as_one():
+    desired, _ = desired_workers(settings(), metrics(pending=4, slots_per_worker=0))
+    assert desired == 4
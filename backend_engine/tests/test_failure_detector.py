@@ -0,0 +1,56 @@
+import math
+import pytest
+from lib.failure_detector import FailureDetector, phi, PHI_SUSPECT_THRESHOLD, PHI_OFFLINE_THRESHOLD
+
+def test_phi_on_time_heartbeat():
+    # Half of the heartbeats are still to come at the mean
+    assert phi(10, 10, 2) == pytest.approx(math.log10(2), abs=1e-3)
+    assert phi(0, 10, 2) < 0.01
+
+def test_phi_grows_with_delay():
+    levels = [phi(elapsed, 10, 2) for elapsed in range(0, 30)]
+    assert levels == sorted(levels)
+    assert phi(25, 10, 2) > PHI_OFFLINE_THRESHOLD
+
+def test_phi_wider_spread_is_more_tolerant():
+    assert phi(15, 10, 5) < phi(15, 10, 1)
+
+def heartbeats(detector, uid, times):
+    for now in times:
+        detector.heartbeat(uid, now)
+
+def test_regular_worker_is_not_suspected():
+    detector = FailureDetector()
+    heartbeats(detector, "w1", range(0, 100, 10))
+    assert detector.evaluate(now=100) == ([], [])
+
+def test_silent_worker_is_suspected_then_taken_offline():
+    detector = FailureDetector()
+    heartbeats(detector, "w1", range(0, 100, 10))
+    last = 90
+
+    suspect_at = next(now for now in range(last, last + 120) if detector.phi("w1", now) >= PHI_SUSPECT_THRESHOLD)
+    assert detector.evaluate(now=suspect_at) == (["w1"], [])
+
+    offline_at = next(now for now in range(suspect_at, last + 120) if detector.phi("w1", now) >= PHI_OFFLINE_THRESHOLD)
+    assert detector.evaluate(now=offline_at) == ([], ["w1"])
+
+def test_suspected_worker_is_reported_once():
+    detector = FailureDetector()
+    heartbeats(detector, "w1", range(0, 100, 10))
+    now = next(now for now in range(90, 300) if detector.phi("w1", now) >= PHI_SUSPECT_THRESHOLD)
+    detector.suspected.add("w1")
+    assert detector.evaluate(now=now) == ([], [])
+
+def test_failed_worker_coming_back():
+    detector = FailureDetector()
+    heartbeats(detector, "w1", [0, 10])
+    detector.failed.add("w1")
+    assert detector.heartbeat("w1", 200) is True
+    assert detector.heartbeat("w1", 210) is False
+
+def test_forget_stops_watching():
+    detector = FailureDetector()
+    heartbeats(detector, "w1", [0, 10, 20])
+    detector.forget("w1")
+    assert detector.evaluate(now=1000) == ([], [])
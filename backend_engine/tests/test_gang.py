@@ -0,0 +1,28 @@
+import pytest
+from lib.gang import check_gangs, plan_gangs
+
+def test_check_gangs():
+    check_gangs(8, 4)
+    check_gangs(5, None)
+    check_gangs(5, 1)
+    with pytest.raises(ValueError, match="don't split into gangs of 4"):
+        check_gangs(6, 4)
+
+def test_functions_without_gangs():
+    assert plan_gangs("f1", 3, None) == ([], [None, None, None])
+    assert plan_gangs("f1", 2, 1) == ([], [None, None])
+
+def test_consecutive_ranks_per_gang():
+    gangs, ranks = plan_gangs("f1", 6, 3)
+    assert len(gangs) == 2
+    assert len({gang.uid for gang in gangs}) == 2
+    assert all(gang.function_uid == "f1" and gang.size == 3 and gang.attempts == 0 for gang in gangs)
+    assert [(rank["gang_uid"], rank["gang_rank"]) for rank in ranks] == [
+        (gangs[0].uid, 0), (gangs[0].uid, 1), (gangs[0].uid, 2),
+        (gangs[1].uid, 0), (gangs[1].uid, 1), (gangs[1].uid, 2)
+    ]
+    assert all(rank["gang_size"] == 3 for rank in ranks)
+
+def test_partial_gang_is_rejected():
+    with pytest.raises(ValueError):
+        plan_gangs("f1", 7, 3)
@@ -0,0 +1,114 @@
+import pytest
+import lib.limits
+from lib.limits import FunctionLimits
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(lib.limits.time, "monotonic", clock)
+    return clock
+
+def test_unlimited_functions_get_no_grants(clock):
+    limits = FunctionLimits()
+    assert limits.acquire(10) == {}
+    limits.configure("f1", max_concurrency=None, rate_limit=None)
+    assert limits.acquire(10) == {}
+
+def test_concurrency_limit(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=3)
+    grants = limits.acquire(10)
+    assert grants == {"f1": 3}
+    # The allowance is reserved until released
+    assert limits.acquire(10) == {"f1": 0}
+
+    limits.release(grants, {"f1": 2})
+    assert limits.running["f1"] == 2
+    assert limits.acquire(10) == {"f1": 1}
+
+def test_finished_tasks_free_concurrency(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=2)
+    limits.release(limits.acquire(2), {"f1": 2})
+    assert limits.acquire(1) == {"f1": 0}
+    limits.release({"f1": 0}, {})
+    limits.finished("f1")
+    assert limits.acquire(5) == {"f1": 1}
+
+def test_token_bucket_burst_and_refill(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", rate_limit=2, rate_burst=5)
+    grants = limits.acquire(10)
+    assert grants == {"f1": 5}
+    limits.release(grants, {"f1": 5})
+    assert limits.acquire(10) == {"f1": 0}
+
+    clock.now += 1.5
+    assert limits.acquire(10) == {"f1": 3}
+
+def test_token_bucket_caps_at_burst(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", rate_limit=1)
+    # Burst defaults to the rate
+    clock.now += 3600
+    assert limits.acquire(10) == {"f1": 1}
+
+def test_unused_tokens_are_given_back(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", rate_limit=1, rate_burst=4)
+    grants = limits.acquire(4)
+    limits.release(grants, {"f1": 1})
+    assert limits.snapshot("f1") == {"running": 1, "tokens": 3}
+
+def test_both_limits(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=2, rate_limit=10, rate_burst=10)
+    assert limits.acquire(5) == {"f1": 2}
+
+def test_reconfigure_keeps_tokens_within_burst(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", rate_limit=10, rate_burst=10)
+    limits.configure("f1", rate_limit=10, rate_burst=3)
+    assert limits.acquire(10) == {"f1": 3}
+
+def test_clearing_limits(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=1, rate_limit=1)
+    limits.configure("f1")
+    assert limits.acquire(10) == {}
+    assert limits.snapshot("f1") == {"running": 0, "tokens": None}
+
+def test_cancelled_function_runs_nothing(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=5)
+    limits.release(limits.acquire(5), {"f1": 4})
+    limits.cancelled("f1")
+    assert limits.running["f1"] == 0
+    assert limits.acquire(10) == {"f1": 5}
+
+def test_reconcile_keeps_changes_made_while_counting(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=10)
+    limits.release(limits.acquire(3), {"f1": 3})
+    changes_before = dict(limits.changes)
+
+    # Claimed 2 and finished 1 while the recount of 5 ran
+    limits.release(limits.acquire(2), {"f1": 2})
+    limits.finished("f1")
+    limits.reconcile("f1", 5, changes_before)
+    assert limits.running["f1"] == 6
+
+def test_reconcile_never_goes_negative(clock):
+    limits = FunctionLimits()
+    limits.configure("f1", max_concurrency=10)
+    changes_before = dict(limits.changes)
+    limits.finished("f1", 3)
+    limits.reconcile("f1", 1, changes_before)
+    assert limits.running["f1"] == 0
@@ -0,0 +1,26 @@
+import pytest
+from lib.priority import PRIORITY_CLASSES, priority_name, priority_value
+
+def test_class_names():
+    assert priority_value("low") < priority_value("normal") < priority_value("high") < priority_value("urgent")
+    assert priority_value("HIGH") == PRIORITY_CLASSES["high"]
+
+def test_default_is_normal():
+    assert priority_value(None) == PRIORITY_CLASSES["normal"]
+
+def test_numbers():
+    assert priority_value(5) == 5
+    assert priority_value("-3") == -3
+
+@pytest.mark.parametrize("priority", ["critical", "", [1], 1.5j])
+def test_invalid_priorities(priority):
+    with pytest.raises(ValueError, match="priority must be one of"):
+        priority_value(priority)
+
+def test_priority_name():
+    assert priority_name(PRIORITY_CLASSES["urgent"]) == "urgent"
+    assert priority_name(7) == 7
+
+def test_name_round_trip():
+    for name in PRIORITY_CLASSES:
+        assert priority_name(priority_value(name)) == name
@@ -0,0 +1,49 @@
+import random
+from lib.topology import SlotIndex, grid_slot, get_input_tile, block_slot
+
+def test_grid_slot_fills_rows():
+    assert [grid_slot(i, 3) for i in range(7)] == [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1), (0, 2)]
+
+def test_grid_slot_is_unique_per_index():
+    slots = {grid_slot(i, 5) for i in range(5 * 4)}
+    assert len(slots) == 20
+    assert all(0 <= x < 5 and 0 <= y < 4 for x, y in slots)
+
+def test_get_input_tile():
+    assert get_input_tile({"tile": [2, 3]}) == (2, 3)
+    assert get_input_tile({"tile": ("4", "5")}) == (4, 5)
+    assert get_input_tile({"tile": [1]}) is None
+    assert get_input_tile({"tile": ["a", 1]}) is None
+    assert get_input_tile([1, 2]) is None
+
+def test_block_slot_keeps_small_extents():
+    assert block_slot((2, 1), (3, 2), 4, 4) == (2, 1)
+
+def test_block_slot_scales_large_extents():
+    # 100 x 100 tiles on a 10 x 10 grid, 10 x 10 tiles per slot
+    assert block_slot((0, 0), (100, 100), 10, 10) == (0, 0)
+    assert block_slot((19, 55), (100, 100), 10, 10) == (1, 5)
+    assert block_slot((99, 99), (100, 100), 10, 10) == (9, 9)
+    assert block_slot((-1, 200), (100, 100), 10, 10) == (0, 9)
+
+def test_nearest_slot():
+    index = SlotIndex(20, 20, cell_size=4)
+    assert index.nearest(3, 3) is None
+    index.add(0, 0, "a")
+    index.add(10, 10, "b")
+    assert index.nearest(10, 10) == (10, 10)
+    assert index.nearest(2, 3) == (0, 0)
+    assert index.nearest(8, 7) == (10, 10)
+    assert index.nearest(19, 0) == (10, 10)
+
+def test_nearest_slot_matches_brute_force():
+    rng = random.Random(7)
+    index = SlotIndex(40, 30, cell_size=8)
+    slots = {(rng.randrange(40), rng.randrange(30)) for _ in range(25)}
+    for slot in slots:
+        index.add(*slot, f"w{slot}")
+
+    for x in range(40):
+        for y in range(30):
+            best = min(slots, key=lambda s: (max(abs(s[0] - x), abs(s[1] - y)), s))
+            assert index.nearest(x, y) == best
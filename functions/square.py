@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+
+def main(inputs):
+    """
+    Squares every input of the task.
+
+    Called once per task with the task's input batch, returns one output
+    per input in the same order.
+    """
+    return [int(value) ** 2 for value in inputs]
+
+if __name__ == "__main__":
+    # Subprocess mode: inputs arrive as JSON lines on stdin, one output
+    # per input is written as a JSON line to $VINCI4D_OUTPUT
+    inputs = [json.loads(line) for line in sys.stdin if line.strip()]
+    with open(os.environ["VINCI4D_OUTPUT"], "w") as f:
+        for output in main(inputs):
+            f.write(json.dumps(output) + "\n")